@@ -1,2 +1,3 @@
 from .settings import settings
+from .metrics import metrics
 from .database import database
\ No newline at end of file
@@ -1,5 +1,7 @@
 from app.database import Database
+from app.common.settings import settings
+from app.common.metrics import database_duration
 
 
-# initializes the database
-database = Database()
+# initializes the database; the time taken by its reads and writes is recorded in the metrics
+database = Database(settings.DATABASE_PATH, database_duration)
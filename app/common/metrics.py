@@ -0,0 +1,32 @@
+from app.metrics import MetricsRegistry
+from app.common.settings import settings
+
+
+# initializes the metrics registry; METRICS_ENABLED and SERVER_TIMING turn the collection on and off
+metrics = MetricsRegistry(is_enabled=settings.METRICS_ENABLED, is_timing_enabled=settings.SERVER_TIMING)
+
+# the metrics collected by the app; gauges of values kept elsewhere are registered by the /metrics router
+request_duration = metrics.histogram(
+    "file_server_request_duration_seconds", "Time taken to answer requests.", ("route", "method")
+)
+received_bytes = metrics.counter("file_server_received_bytes_total", "Bytes of request bodies received.", ("route",))
+sent_bytes = metrics.counter("file_server_sent_bytes_total", "Bytes of response bodies sent.", ("route",))
+quota_check_duration = metrics.histogram(
+    "file_server_quota_check_duration_seconds", "Time taken to check and reserve daily limits.", timing_name="quota"
+)
+index_lookup_duration = metrics.histogram(
+    "file_server_index_lookup_duration_seconds", "Time taken to look up saved files.", timing_name="lookup"
+)
+hash_duration = metrics.histogram(
+    "file_server_hash_duration_seconds", "Time taken to hash uploaded files.", timing_name="hash"
+)
+disk_write_duration = metrics.histogram(
+    "file_server_disk_write_duration_seconds", "Time taken to write uploaded files.", timing_name="write"
+)
+database_duration = metrics.histogram(
+    "file_server_database_duration_seconds", "Time taken by database reads and writes.", ("operation",), "db"
+)
+bandwidth_wait_duration = metrics.counter(
+    "file_server_bandwidth_wait_seconds_total", "Time transfers were held back by bandwidth shaping.", ("direction",)
+)
+cleanup_duration = metrics.histogram("file_server_cleanup_duration_seconds", "Time taken by clean up checks.")
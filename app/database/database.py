@@ -1,92 +1,190 @@
-import os, datetime, json
-
-base_db_template = {
-    "hosts_info": {
-        "date_created": "yyyy-mm-dd",
-        "hosts": {
-            "sample_host": {
-                "used_size": 0,
-            }
-        },
-    },
-}
+import datetime, sqlite3, threading, contextlib
+
+from app.metrics import Histogram
+
+# the table keeps one row per host per day; the date is the leading column of the primary key,
+# so everything done for the current day (and dropping the previous days) is an indexed lookup
+schema = """
+CREATE TABLE IF NOT EXISTS hosts (
+    date TEXT NOT NULL,
+    host TEXT NOT NULL,
+    used_size INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (date, host)
+)
+"""
+
+# values shared by all the worker processes, by name; ex: the time of the last activity
+state_schema = """
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+)
+"""
 
 # this database is used to track how much size the client with the same IP has used
-# it uses a JSON file to keep the records
+# it uses a SQLite file in WAL mode to keep the records, so threads and worker processes can share it safely;
+# every change is a single transaction and sizes are incremented in place instead of rewriting the whole database
 class Database:
-    path: str = "./db.json"  # static path to the JSON database
-
-    # contructor; check database file validity
-    def __init__(self):
-        is_db_valid = self.__check_if_valid()
-        if not os.path.exists(self.path) or not is_db_valid:
-            self.__initialize_db()
-
+    path: str  # path to the SQLite database file
+    current_date: str  # the date the records are currently kept for
+    local: threading.local  # every thread gets its own connection
+    duration: Histogram | None  # records the time taken by reads and writes, by operation
+
+    # contructor; creates the database file and the table if they do not exist yet
+    def __init__(self, path: str = "./db.sqlite3", duration: Histogram | None = None):
+        self.path = path
+        self.current_date = ""
+        self.local = threading.local()
+        self.duration = duration
         self.__clear_hosts_if_outdated()
 
-    # creates a deep copy of the base_db_template variable; this serves as the database template
-    def __get_base_db_template_copy(self) -> dict:
-        return json.loads(json.dumps(base_db_template))
-
-    # checks the database for corruption; asserts that all properties exist; crude way of type checking
-    def __check_if_valid(self):
-        try:
-            db: dict = {}
-            with open(self.path, "r") as f:
-                db = json.loads(f.read())
-
-            assert "hosts_info" in db.keys()
-            assert "date_created" in db["hosts_info"].keys()
-            assert "hosts" in db["hosts_info"].keys()
-
-            for host in db["hosts_info"]["hosts"].keys():
-                assert "used_size" in db["hosts_info"]["hosts"][host].keys()
-                assert type(db["hosts_info"]["hosts"][host]["used_size"]) is int
-
-            return True
-        except:
-            return False
-
-    # if the hosts_info's date of creation does not match the current date,
-    # it remove all the records to reset the client's upload and download limits
-    def __clear_hosts_if_outdated(self):
-        db: dict = None
-        with open(self.path, "r") as f:
-            db = json.loads(f.read())
-
-        current_date = str(datetime.datetime.now().date())
-        if db["hosts_info"]["date_created"] != current_date:
-            hosts_info = self.__get_base_db_template_copy()["hosts_info"]
-            hosts_info["date_created"] = str(current_date)
-            db["hosts_info"] = hosts_info
-            self.set_db(db)
-
-    # initializes the database file
-    def __initialize_db(self):
-        db = self.__get_base_db_template_copy()
-        db["hosts_info"]["date_created"] = str(datetime.datetime.now().date())
-        with open(self.path, "w+") as f:
-            f.write(json.dumps(db))
-
-    # writes the passed database value to the file
+    # returns a context manager that records the time taken by the read or the write in its block
+    def __time(self, operation: str):
+        if self.duration is None:
+            return contextlib.nullcontext()
+
+        return self.duration.time((operation,))
+
+    # returns the connection of the current thread; opens it on first use
+    def __get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # isolation_level=None disables the implicit transactions; every transaction below is explicit
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(schema)
+            connection.execute(state_schema)
+            self.local.connection = connection
+
+        return connection
+
+    # returns the current date as a string; the records of any other date are outdated
+    def __get_current_date(self) -> str:
+        return str(datetime.datetime.now().date())
+
+    # if the date changed since the last call,
+    # it removes the records of the previous days to reset the client's upload and download limits
+    def __clear_hosts_if_outdated(self) -> str:
+        current_date = self.__get_current_date()
+        if self.current_date != current_date:
+            connection = self.__get_connection()
+            connection.execute("DELETE FROM hosts WHERE date < ?", (current_date,))
+            self.current_date = current_date
+
+        return current_date
+
+    # returns how much size the host has used for the current date
+    def get_host_used_size(self, host: str) -> int:
+        with self.__time("read"):
+            current_date = self.__clear_hosts_if_outdated()
+            connection = self.__get_connection()
+            row = connection.execute(
+                "SELECT used_size FROM hosts WHERE date = ? AND host = ?", (current_date, host)
+            ).fetchone()
+            return row[0] if row else 0
+
+    # atomically adds the size to the host's used size for the current date
+    def increment_host_used_size(self, host: str, size: int):
+        self.increment_hosts_used_size({host: size})
+
+    # atomically adds the sizes to the used size of every host in a single transaction
+    def increment_hosts_used_size(self, sizes: dict[str, int]):
+        with self.__time("write"):
+            current_date = self.__clear_hosts_if_outdated()
+            connection = self.__get_connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(
+                    """
+                    INSERT INTO hosts (date, host, used_size) VALUES (?, ?, ?)
+                    ON CONFLICT (date, host) DO UPDATE SET used_size = used_size + excluded.used_size
+                    """,
+                    [(current_date, host, size) for host, size in sizes.items()],
+                )
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    # adds the size to the host's used size only if it stays within the limit;
+    # the check and the increment happen in one transaction so concurrent requests cannot both pass the check
+    # returns whether the size was reserved and the host's used size before the reservation
+    def reserve_host_used_size(self, host: str, size: int, limit: int) -> tuple[bool, int]:
+        with self.__time("write"):
+            current_date = self.__clear_hosts_if_outdated()
+            connection = self.__get_connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR IGNORE INTO hosts (date, host, used_size) VALUES (?, ?, 0)", (current_date, host)
+                )
+                row = connection.execute(
+                    "SELECT used_size FROM hosts WHERE date = ? AND host = ?", (current_date, host)
+                ).fetchone()
+                used_size = row[0]
+                is_reserved = used_size + size <= limit
+                if is_reserved:
+                    connection.execute(
+                        "UPDATE hosts SET used_size = used_size + ? WHERE date = ? AND host = ?",
+                        (size, current_date, host),
+                    )
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+            return is_reserved, used_size
+
+    # writes the passed database value; replaces the records of the current date
     def set_db(self, db: dict):
-        with open(self.path, "w+") as f:
-            f.write(json.dumps(db))
-
-    # performs checks and returns the database from the JSON files
+        with self.__time("write"):
+            current_date = self.__clear_hosts_if_outdated()
+            hosts: dict = db["hosts_info"]["hosts"]
+            connection = self.__get_connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM hosts WHERE date = ?", (current_date,))
+                connection.executemany(
+                    "INSERT INTO hosts (date, host, used_size) VALUES (?, ?, ?)",
+                    [(current_date, host, int(info["used_size"])) for host, info in hosts.items()],
+                )
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+    # returns the records of the current date in the same shape the JSON database used
     def get_db(self) -> dict:
-        is_db_valid = self.__check_if_valid()
-        if not os.path.exists(self.path) or not is_db_valid:
-            self.__initialize_db()
-
-        self.__clear_hosts_if_outdated()
-
-        with open(self.path, "r") as f:
-            db = json.loads(f.read())
-            return db
-
-    # deletes the database file and creates a new one
+        with self.__time("read"):
+            current_date = self.__clear_hosts_if_outdated()
+            connection = self.__get_connection()
+            rows = connection.execute("SELECT host, used_size FROM hosts WHERE date = ?", (current_date,)).fetchall()
+            hosts = {host: {"used_size": used_size} for host, used_size in rows}
+            return {"hosts_info": {"date_created": current_date, "hosts": hosts}}
+
+    # returns the time of the last activity seen by any process; 0 if none was written yet
+    def get_last_activity(self) -> float:
+        with self.__time("read"):
+            connection = self.__get_connection()
+            row = connection.execute("SELECT value FROM state WHERE name = 'last_activity'").fetchone()
+            return row[0] if row else 0.0
+
+    # writes the time of the last activity; a time older than the one already written is ignored,
+    # so the processes can write their own last activity in any order
+    def update_last_activity(self, timestamp: float):
+        with self.__time("write"):
+            connection = self.__get_connection()
+            connection.execute(
+                """
+                INSERT INTO state (name, value) VALUES ('last_activity', ?)
+                ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)
+                """,
+                (timestamp,),
+            )
+
+    # removes all the records; the file is kept since other connections may still have it open
     def reset_database(self):
-        if os.path.exists(self.path) and os.path.isfile(self.path):
-            os.remove(self.path)
-            self.__initialize_db()
+        with self.__time("write"):
+            connection = self.__get_connection()
+            connection.execute("DELETE FROM hosts")
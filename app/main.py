@@ -3,9 +3,11 @@ from fastapi.responses import RedirectResponse
 from fastapi_utils.tasks import repeat_every
 from app.middlewares.limits import LimitsMiddleware
 
-from app.routers import files
-from app.utils import ActivityHandler, SavedFilesHandler
-from app.middlewares import ActivityMiddleware
+from app.routers import files, uploads, metrics
+from app.utils import ActivityHandler, SavedFilesHandler, UploadSessionHandler, HashingHandler, cleanup_lock
+from app.utils import saved_files_index, quota_handler, eviction_handler
+from app.common.metrics import cleanup_duration
+from app.middlewares import ActivityMiddleware, MetricsMiddleware, BandwidthMiddleware
 from app.common import settings
 
 app = FastAPI()
@@ -20,19 +22,85 @@ def home():
 
 # add middlewares
 app.add_middleware(ActivityMiddleware)  # middleware used for updating last activity
+app.add_middleware(BandwidthMiddleware)  # middleware pacing the bodies of every host; inside the limits check
 app.add_middleware(LimitsMiddleware)  # middleware for validating daily upload/download limit
+app.add_middleware(MetricsMiddleware)  # outermost middleware; times every request, including the limits check
 
 # add subroutes
 app.include_router(files.router)  # subrouting for /files API
+app.include_router(uploads.router)  # subrouting for /uploads API; resumable uploads
+app.include_router(metrics.router)  # /metrics API for monitoring
+
+
+# index the saved files once at startup so looking up a file never has to scan the upload folder
+@app.on_event("startup")
+def build_saved_files_index():
+    saved_files_index.build()
+
+
+# start the hashing processes before the first upload needs them; does nothing unless HASH_ENGINE is process
+@app.on_event("startup")
+def start_hashing():
+    HashingHandler.start()
 
 
 # check every 10 secs if cleanup can proceed;
-# if last activity was more than the time specified in the CLEANUP_AFTER_MINS_INACTIVITY environment variable, cleanup will proceed
+# if STORAGE_BUDGET_MB or FILE_TTL_MINS is set, the least recently used files are evicted a small batch at a time;
+# otherwise, if last activity was more than the time specified in the CLEANUP_AFTER_MINS_INACTIVITY environment variable,
+# every file is removed
+# resumable uploads that did not receive anything for UPLOAD_SESSION_EXPIRY_MINS are removed on every check,
+# along with the temporary files of abandoned uploads
+# with several workers, only the worker holding the cleanup lock cleans up; if it dies, the next one to check takes over
 @app.on_event("startup")
 @repeat_every(seconds=10)
 def clean_up():
+    if not cleanup_lock.hold():
+        return
+
+    with cleanup_duration.time():
+        clean_up_once()
+
+
+# runs a single clean up check
+def clean_up_once():
+    upload_session_handler = UploadSessionHandler()
+    upload_session_handler.clean_up_expired_sessions()
+
+    if eviction_handler.is_enabled():
+        saved_files_handler = SavedFilesHandler()
+        saved_files_handler.evict_files()
+        return
+
     last_activity_mins = ActivityHandler.get_mins_from_last_activity()
     if last_activity_mins >= settings.CLEANUP_AFTER_MINS_INACTIVITY:
         ActivityHandler.update_last_activity()
+        ActivityHandler.flush_last_activity()
         saved_files_handler = SavedFilesHandler()
         saved_files_handler.clean_up_files()
+
+
+# write the used sizes kept in memory by the quota handler and the last activity of this worker to the database,
+# and the downloads recorded for the eviction to the access times of the files, every QUOTA_FLUSH_INTERVAL_SECS;
+# the journal of the index snapshot is folded into a new snapshot once it grew too large
+@app.on_event("startup")
+@repeat_every(seconds=settings.QUOTA_FLUSH_INTERVAL_SECS)
+def flush_shared_state():
+    quota_handler.flush()
+    ActivityHandler.flush_last_activity()
+    SavedFilesHandler().save_accesses()
+    saved_files_index.compact_snapshot()
+
+
+# write whatever is left before the server stops
+@app.on_event("shutdown")
+def flush_shared_state_on_shutdown():
+    quota_handler.flush()
+    ActivityHandler.flush_last_activity()
+    SavedFilesHandler().save_accesses()
+    saved_files_index.compact_snapshot()
+
+
+# stop the hashing processes
+@app.on_event("shutdown")
+def stop_hashing():
+    HashingHandler.shutdown()
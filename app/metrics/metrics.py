@@ -0,0 +1,231 @@
+import bisect, time, threading, contextlib, contextvars
+from typing import Callable
+
+# latency buckets in seconds, from half a millisecond to a minute
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# the phases timed during the current request, as (name, duration in seconds); None outside of a timed request.
+# the list is shared with the threads the request hands work to, as long as they run in a copy of its context
+request_timings: contextvars.ContextVar[list[tuple[str, float]] | None] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+# returned instead of a timer when metrics are disabled; entering and leaving it does nothing
+null_timer = contextlib.nullcontext()
+
+
+# formats label names and values the way prometheus expects them; ex: {route="files",method="GET"}
+def format_labels(label_names: tuple[str, ...], labels: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# a value that only goes up; ex: the number of bytes received
+class Counter:
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+    is_enabled: bool
+    lock: threading.Lock
+    values: dict[tuple[str, ...], float]  # labels -> value
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], is_enabled: bool) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.is_enabled = is_enabled
+        self.lock = threading.Lock()
+        self.values = {}
+
+    # adds the amount to the value of the labels
+    def inc(self, amount: float = 1, labels: tuple[str, ...] = ()):
+        if not self.is_enabled:
+            return
+
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    # returns the lines of the counter in the prometheus text format
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+
+        return lines
+
+
+# the distribution of durations in buckets; ex: the latency of the requests of a route
+# durations recorded during a request are also added to the request's timings, under timing_name
+class Histogram:
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+    is_enabled: bool
+    timing_name: str  # name of the phase in the Server-Timing header; empty to leave it out
+    buckets: tuple[float, ...]
+    lock: threading.Lock
+    bucket_counts: dict[tuple[str, ...], list[int]]  # labels -> count of every bucket, plus one for larger values
+    sums: dict[tuple[str, ...], float]  # labels -> sum of all the observed values
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...],
+        is_enabled: bool,
+        timing_name: str = "",
+        buckets: tuple[float, ...] = default_buckets,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.is_enabled = is_enabled
+        self.timing_name = timing_name
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.bucket_counts = {}
+        self.sums = {}
+
+    # adds the value to the distribution of the labels
+    def observe(self, value: float, labels: tuple[str, ...] = ()):
+        if not self.is_enabled:
+            return
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            bucket_counts = self.bucket_counts.get(labels)
+            if bucket_counts is None:
+                bucket_counts = self.bucket_counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            bucket_counts[index] += 1
+            self.sums[labels] += value
+
+    # observes a duration and adds it to the timings of the current request
+    def record(self, duration: float, labels: tuple[str, ...] = ()):
+        if not self.is_enabled:
+            return
+
+        self.observe(duration, labels)
+        timings = request_timings.get()
+        if timings is not None and self.timing_name:
+            timings.append((self.timing_name, duration))
+
+    # returns a context manager that records how long its block takes
+    def time(self, labels: tuple[str, ...] = ()):
+        if not self.is_enabled:
+            return null_timer
+
+        return Timer(self, labels)
+
+    # returns the lines of the histogram in the prometheus text format; bucket counts are cumulative
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, bucket_counts in sorted(self.bucket_counts.items()):
+                cumulative_count = 0
+                for bucket, count in zip(self.buckets + (float("inf"),), bucket_counts):
+                    cumulative_count += count
+                    le = "+Inf" if bucket == float("inf") else repr(bucket)
+                    bucket_labels = format_labels(self.label_names, labels, f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative_count}")
+
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {self.sums[labels]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative_count}")
+
+        return lines
+
+
+# records how long the block of a with statement takes into a histogram
+class Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple[str, ...]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.record(time.perf_counter() - self.start, self.labels)
+
+
+# a value read when the metrics are collected; ex: the number of saved files
+class Gauge:
+    name: str
+    help: str
+    type: str  # gauge, or counter for totals kept somewhere else
+    collect: Callable[[], float]
+
+    def __init__(self, name: str, help: str, collect: Callable[[], float], type: str = "gauge") -> None:
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.type = type
+
+    # returns the lines of the gauge in the prometheus text format
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", f"{self.name} {self.collect()}"]
+
+
+# keeps every metric of the process and renders them for /metrics in the prometheus text format.
+# when it is disabled, counters and histograms ignore what they are given and timers do nothing,
+# so the instrumented code pays a single attribute check; gauges are read on collection only and always work
+class MetricsRegistry:
+    is_enabled: bool
+    is_timing_enabled: bool  # whether the Server-Timing header is added to the responses
+    metrics: list[Counter | Histogram | Gauge]
+
+    def __init__(self, is_enabled: bool = True, is_timing_enabled: bool = False) -> None:
+        self.is_enabled = is_enabled
+        self.is_timing_enabled = is_timing_enabled
+        self.metrics = []
+
+    # creates and registers a counter
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        counter = Counter(name, help, label_names, self.is_enabled)
+        self.metrics.append(counter)
+        return counter
+
+    # creates and registers a histogram; durations recorded by it show up in Server-Timing under timing_name
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), timing_name: str = "") -> Histogram:
+        histogram = Histogram(name, help, label_names, self.is_enabled or self.is_timing_enabled, timing_name)
+        self.metrics.append(histogram)
+        return histogram
+
+    # registers a gauge read from the function when the metrics are collected
+    def gauge(self, name: str, help: str, collect: Callable[[], float], type: str = "gauge") -> Gauge:
+        gauge = Gauge(name, help, collect, type)
+        self.metrics.append(gauge)
+        return gauge
+
+    # starts collecting the timings of the current request and returns the list they are added to
+    def start_request_timings(self) -> list[tuple[str, float]]:
+        timings: list[tuple[str, float]] = []
+        request_timings.set(timings)
+        return timings
+
+    # returns all the metrics in the prometheus text format
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+
+# formats the timings as a Server-Timing header value; durations of the same phase are added up
+# ex: quota;dur=0.05, hash;dur=12.3, total;dur=15.1 (durations in milliseconds)
+def format_server_timing(timings: list[tuple[str, float]], total: float) -> str:
+    durations: dict[str, float] = {}
+    for name, duration in timings:
+        durations[name] = durations.get(name, 0.0) + duration
+    durations["total"] = total
+
+    return ", ".join(f"{name};dur={round(duration * 1000, 3)}" for name, duration in durations.items())
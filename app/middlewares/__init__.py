@@ -1 +1,3 @@
-from .activity import ActivityMiddleware
\ No newline at end of file
+from .activity import ActivityMiddleware
+from .metrics import MetricsMiddleware
+from .bandwidth import BandwidthMiddleware
\ No newline at end of file
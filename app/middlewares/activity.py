@@ -1,17 +1,17 @@
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from app.utils import ActivityHandler
+from app.middlewares.scope import get_route
 
 
-# every time the /files subroute is hit, it will update the last activity to the current time
-class ActivityMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        base_url = str(request.base_url)
-        url = str(request.url)
-        route = url.replace(base_url, "").split("/")[0]
-        if route == "files":
+# every time the /files or /uploads subroutes are hit, it will update the last activity to the current time
+# it is a plain ASGI middleware; receive and send are passed through untouched
+class ActivityMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and get_route(scope) in ("files", "uploads"):
             ActivityHandler.update_last_activity()
 
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
@@ -0,0 +1,54 @@
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils import bandwidth_handler
+from app.utils.downloads import zero_copy_extension
+from app.middlewares.scope import get_client_host
+
+max_zero_copy_size = 256 * 1024  # zero-copy sends are handed to the server in pieces of this size when they are paced
+
+
+# paces the bodies of requests and responses with the buckets of the bandwidth handler, see BandwidthHandler;
+# the next piece of the body is only received, or sent, once the buckets allow it. a zero-copy send hands the
+# whole file to the server at once, so it is split into pieces first
+# it is a plain ASGI middleware; it only wraps receive and send, and does nothing unless a rate is set
+class BandwidthMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not bandwidth_handler.is_enabled():
+            await self.app(scope, receive, send)
+            return
+
+        host = get_client_host(scope)  # client's ip address
+        received_size = 0
+        sent_size = 0
+
+        async def receive_paced() -> Message:
+            nonlocal received_size
+            message = await receive()
+            if message["type"] == "http.request":
+                size = len(message.get("body", b""))
+                await bandwidth_handler.pace("upload", host, size, received_size)
+                received_size += size
+            return message
+
+        async def send_paced(message: Message):
+            nonlocal sent_size
+            if message["type"] == "http.response.body":
+                size = len(message.get("body", b""))
+                await bandwidth_handler.pace("download", host, size, sent_size)
+                sent_size += size
+            elif message["type"] == zero_copy_extension and message.get("count") is not None:
+                offset, end = message.get("offset", 0), message.get("offset", 0) + message["count"]
+                while end - offset > max_zero_copy_size:
+                    await bandwidth_handler.pace("download", host, max_zero_copy_size, sent_size)
+                    await send({**message, "offset": offset, "count": max_zero_copy_size, "more_body": True})
+                    offset += max_zero_copy_size
+                    sent_size += max_zero_copy_size
+                await bandwidth_handler.pace("download", host, end - offset, sent_size)
+                sent_size += end - offset
+                message = {**message, "offset": offset, "count": end - offset}
+            await send(message)
+
+        await self.app(scope, receive_paced, send_paced)
@@ -1,91 +1,302 @@
-import os
+from typing import Awaitable, Callable
 
-from fastapi import Request, status
+from fastapi import status
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from pydantic import ValidationError
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.common import settings
+from app.models.requests import ArchiveRequest
+from app.utils import SavedFilesHandler, DownloadHandler, ExecutorHandler, ArchiveHandler, quota_handler
+from app.common.metrics import quota_check_duration
+from app.middlewares.scope import get_path_parts, get_client_host
+
+quota_reserve_block_size = 4 * 1000 * 1000  # size reserved at once while an upload body arrives
+
+
+# gives back size reserved for the host that was not used; releases written to the database right away run on the
+# metadata pool, like the reservations
+async def release_host_used_size(host: str, size: int):
+    if quota_handler.is_write_through():
+        await ExecutorHandler.run_metadata(quota_handler.release, host, size)
+    else:
+        quota_handler.release(host, size)
+
+
+# raised by the body of an upload once the host went over its daily limit; the route stops reading it
+class QuotaExceededError(Exception):
+    pass
+
+
+# counts the bytes of an upload body as they arrive and charges them to the host's daily size before the app sees
+# them. the size declared by Content-Length is reserved up front; the body goes beyond it only when there is no
+# Content-Length (chunked uploads), in which case more is reserved a block at a time. once the host has no size
+# remaining, every call raises QuotaExceededError. release() gives back what was reserved but never received,
+# so a client that disconnects half way only pays for what it sent
+class UploadMeter:
+    host: str
+    receive: Receive
+    reserve: Callable[[str, int], Awaitable[tuple[bool, int]]]  # reserves a size for the host, see LimitsMiddleware
+    received_size: int
+    reserved_size: int
+    remaining_size: int  # size the host had remaining when the last reservation failed
+    is_over_limit: bool
+
+    def __init__(self, host: str, receive: Receive, reserve: Callable[[str, int], Awaitable[tuple[bool, int]]]):
+        self.host = host
+        self.receive = receive
+        self.reserve = reserve
+        self.received_size = 0
+        self.reserved_size = 0
+        self.remaining_size = 0
+        self.is_over_limit = False
+
+    # reserves the size before anything is received; returns whether it was reserved
+    async def reserve_upfront(self, size: int) -> bool:
+        is_reserved, self.remaining_size = await self.reserve(self.host, size)
+        if is_reserved:
+            self.reserved_size += size
+        return is_reserved
+
+    # reserves at least the size needed; a whole block if the host has that much remaining, only what is needed
+    # otherwise, so the last bytes of the host's daily size can still be used
+    async def __reserve_more(self, needed_size: int) -> bool:
+        if needed_size < quota_reserve_block_size and await self.reserve_upfront(quota_reserve_block_size):
+            return True
+
+        return await self.reserve_upfront(needed_size)
+
+    async def __call__(self) -> Message:
+        if self.is_over_limit:
+            raise QuotaExceededError()
+
+        message = await self.receive()
+        if message["type"] != "http.request":
+            return message
+
+        self.received_size += len(message.get("body", b""))
+        if self.received_size > self.reserved_size:
+            if not await self.__reserve_more(self.received_size - self.reserved_size):
+                self.received_size -= len(message.get("body", b""))  # not accepted, not charged
+                self.is_over_limit = True
+                raise QuotaExceededError()
+
+        return message
+
+    # gives back the size that was reserved but not received
+    async def release(self):
+        unused_size = self.reserved_size - self.received_size
+        self.reserved_size = self.received_size
+        await release_host_used_size(self.host, unused_size)
+
+    # returns the message a client over its daily limit gets
+    def get_over_limit_message(self) -> str:
+        received_size_mb = self.received_size / (1000 * 1000)
+        remaining_size_mb = self.remaining_size / (1000 * 1000)
+        message = f"Upload size is over {round(received_size_mb, 2)} MB."
+        return f"{message} You only have {round(remaining_size_mb, 2)} MB remaining"
 
-from app.common import database, settings
-from app.utils import SavedFilesHandler
 
 # this middleware handles limits based on <DAILY_LIMIT_MB> environment variable
 # host is the IP of the client accessing the API
-class LimitsMiddleware(BaseHTTPMiddleware):
-    # access the database and return how much size the host had used for the current date
-    def __get_host_used_size(self, host: str):
-        db: dict = database.get_db()
-        hosts: dict = db["hosts_info"]["hosts"]
-
-        if host not in hosts.keys():
-            return 0
-
-        return hosts[host]["used_size"]
-
-    # return how much size the host has remaining
-    def __get_host_remaining_size(self, host):
-        daily_limit_mb = settings.DAILY_LIMIT_MB
-        daily_limit_bytes = daily_limit_mb * 1000 * 1000
-
-        used_size = self.__get_host_used_size(host)
-        return daily_limit_bytes - used_size
-
-    # access the database and increment the host's use size
-    def __increment_host_used_size(self, host: str, size: int):
-        db: dict = database.get_db()
-        hosts: dict = db["hosts_info"]["hosts"]
-
-        if not hosts.get(host):
-            hosts[host] = {"used_size": 0}
-
-        hosts[host]["used_size"] += size
-        database.set_db(db)
-
-    async def dispatch(self, request: Request, call_next):
-        base_url = str(request.base_url)
-        url = str(request.url)
-        route = url.replace(base_url, "").split("/")[0]
-        method = request.method
-        if route != "files" or method == "DELETE":
-            response = await call_next(request)
-            return response
-
-        # proceed if accessing /files api using GET and POST method
-
-        host = request.client.host  # client's ip address
-        remaining_size = self.__get_host_remaining_size(host)
-        remaining_size_mb = remaining_size / (1000 * 1000)
-
-        if request.method == "POST":
-            upload_size = int(request.headers.get("content-length"))  # get upload size from request header
-
-            # if upload size is more than the client's remaining daily size, 403 error along with message
-            if upload_size > remaining_size:
-                upload_size_mb = upload_size / (1000 * 1000)
-                message = f"Upload size is {round(upload_size_mb, 2)} MB. You only have {round(remaining_size_mb, 2)} MB remaining"
-                return JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
-            else:
-                self.__increment_host_used_size(host, upload_size)
-
-        if request.method == "GET":
-            public_key = ""
+# it is a plain ASGI middleware; it reads the scope, and only wraps receive and send to meter the body of uploads
+class LimitsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    # atomically check that the size fits in the host's remaining daily size and add it to the host's used size;
+    # return whether the size was reserved and how much size the host had remaining before
+    # reservations written to the database right away run on the metadata pool, they may wait for other workers
+    async def __reserve_host_used_size(self, host: str, size: int) -> tuple[bool, int]:
+        with quota_check_duration.time():
+            if quota_handler.is_write_through():
+                return await ExecutorHandler.run_metadata(quota_handler.reserve, host, size)
+
+            return quota_handler.reserve(host, size)
+
+    # reads the whole body of an archive request, as long as it is no larger than a list of ARCHIVE_MAX_FILES keys;
+    # returns None if it is larger
+    async def __read_archive_body(self, receive: Receive) -> bytes | None:
+        max_size = settings.ARCHIVE_MAX_FILES * 100 + 1024
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                return body
+            body += message.get("body", b"")
+            if len(body) > max_size:
+                return None
+            if not message.get("more_body", False):
+                return body
+
+    # returns the public keys an archive request asks for; empty if the body is not a valid archive request, it is
+    # validated with the same model as the route does, and the route rejects those without sending anything
+    def __get_archive_public_keys(self, body: bytes) -> list[str]:
+        try:
+            return ArchiveRequest.parse_raw(body).publicKeys
+        except ValidationError:
+            return []
+
+    # passes the upload to the app with its body metered. an upload declaring more than the host has remaining is
+    # rejected before its body is read; one going over while it arrives is cut short: the app stops reading the body,
+    # whatever it answers is dropped, and the client gets a 403 instead. only the bytes received are charged
+    async def __handle_upload(self, scope: Scope, receive: Receive, send: Send, host: str):
+        meter = UploadMeter(host, receive, self.__reserve_host_used_size)
+        content_length = Headers(scope=scope).get("content-length", "")
+        upload_size = int(content_length) if content_length.isdigit() else 0
+
+        # if upload size is more than the client's remaining daily size, 403 error along with message
+        if not await meter.reserve_upfront(upload_size):
+            upload_size_mb = upload_size / (1000 * 1000)
+            remaining_size_mb = meter.remaining_size / (1000 * 1000)
+            message = f"Upload size is {round(upload_size_mb, 2)} MB. You only have {round(remaining_size_mb, 2)} MB remaining"
+            response = JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
+            await response(scope, receive, send)
+            return
+
+        is_response_started = False
+
+        async def send_unless_over_limit(message: Message):
+            nonlocal is_response_started
+            if meter.is_over_limit:
+                return
+            is_response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, meter, send_unless_over_limit)
+        except Exception:
+            if not meter.is_over_limit:
+                raise
+        finally:
+            await meter.release()
+
+        if meter.is_over_limit:
+            if is_response_started:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            message = meter.get_over_limit_message()
+            response = JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
+            await response(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path_parts = get_path_parts(scope)
+        route = path_parts[0]
+        method = scope["method"]
+
+        # uploads are files sent to /files using POST (multipart) or PUT (raw body)
+        # and chunks of resumable uploads sent to /uploads using PUT;
+        # every chunk is charged on its own, so a resumed upload only pays for the chunks it sends again
+        # archives are several files downloaded at once by sending their public keys to /files/archive using POST
+        is_archive = route == "files" and method == "POST" and path_parts[1:] == ["archive"]
+        is_upload = not is_archive and (
+            (route == "files" and method in ("POST", "PUT")) or (route == "uploads" and method == "PUT")
+        )
+        is_download = route == "files" and method == "GET"
+        if not is_upload and not is_download and not is_archive:
+            await self.app(scope, receive, send)
+            return
+
+        host = get_client_host(scope)  # client's ip address
+
+        # the whole batch is charged at once with the size of all the files; the body is read here to know which
+        # files they are, then handed to the route as if it was never read
+        if is_archive:
+            body = await self.__read_archive_body(receive)
+            if body is None:
+                message = f"An archive can contain at most {settings.ARCHIVE_MAX_FILES} files"
+                response = JSONResponse({"details": message}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+                await response(scope, receive, send)
+                return
+
+            public_keys = self.__get_archive_public_keys(body)
+            archive_size = None
+            if public_keys:
+                archive_size = await ExecutorHandler.run_metadata(ArchiveHandler.get_contents_size, public_keys)
+
+            # nothing is charged if the request is not valid or any file is missing; the route answers the error
+            if archive_size is not None:
+                is_reserved, remaining_size = await self.__reserve_host_used_size(host, archive_size)
+                if not is_reserved:
+                    archive_size_mb = archive_size / (1000 * 1000)
+                    remaining_size_mb = remaining_size / (1000 * 1000)
+                    message = f"Archive size is {round(archive_size_mb, 2)} MB. You only have {round(remaining_size_mb, 2)} MB remaining"
+                    response = JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
+                    await response(scope, receive, send)
+                    return
+
+            is_body_sent = False
+
+            async def receive_body() -> Message:
+                nonlocal is_body_sent
+                if not is_body_sent:
+                    is_body_sent = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+
+            # the route may still fail before sending the archive, ex: a file was removed in the meantime;
+            # the archive is not charged then
+            is_charged = archive_size is not None
+
+            async def send_released_on_error(message: Message):
+                nonlocal is_charged
+                if message["type"] == "http.response.start":
+                    if message["status"] >= 400 and is_charged:
+                        await release_host_used_size(host, archive_size)
+                    is_charged = False  # from here on, the archive is being sent
+                await send(message)
+
             try:
-                public_key = url.replace(base_url, "").split("/")[1]
-            except:
-                pass
+                await self.app(scope, receive_body, send_released_on_error)
+            except Exception:
+                if is_charged:
+                    await release_host_used_size(host, archive_size)
+                raise
+            return
+
+        # the body of an upload is charged as it arrives; see UploadMeter
+        if is_upload:
+            await self.__handle_upload(scope, receive, send, host)
+            return
+
+        if is_download:
+            public_key = path_parts[1] if len(path_parts) > 1 else ""
 
             if public_key:
                 # use the saved files handler to determine info about the file the client wants to download
+                # a cached file needs no stat; the lookup is not counted, the route counts it
                 saved_files_handler = SavedFilesHandler()
-                filepath = saved_files_handler.get_filepath_using_public_key(public_key)
-                filesize = saved_files_handler.get_file_size(filepath)
+                filepath, _, cached_file = await saved_files_handler.find_download(public_key, is_counted=False)
+                filesize = 0
+                if filepath:
+                    # only the bytes that will actually be served are charged;
+                    # nothing for a 304 not modified and only the requested ranges for a 206 partial content
+                    try:
+                        if cached_file is not None:
+                            download_handler = DownloadHandler(filepath, public_key, Headers(scope=scope), cached_file)
+                        else:
+                            download_handler = await ExecutorHandler.run_metadata(
+                                DownloadHandler, filepath, public_key, Headers(scope=scope)
+                            )
+                        filesize = download_handler.get_served_size()
+                    except FileNotFoundError:
+                        pass  # removed by another worker process; the route answers not found
+                is_reserved, remaining_size = await self.__reserve_host_used_size(host, filesize)
 
                 # if file size is more than the client's remaining daily size, 403 error along with message
-                if filesize > remaining_size:
+                if not is_reserved:
                     file_size_mb = filesize / (1000 * 1000)
+                    remaining_size_mb = remaining_size / (1000 * 1000)
                     message = f"File size is {round(file_size_mb, 2)} MB. You only have {round(remaining_size_mb, 2)} MB remaining"
-                    return JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
-                else:
-                    self.__increment_host_used_size(host, filesize)
+                    response = JSONResponse({"details": message}, status_code=status.HTTP_403_FORBIDDEN)
+                    await response(scope, receive, send)
+                    return
 
-        # if everything works fine, pass along the response to the next middleware or to the route function
-        response = await call_next(request)
-        return response
+        # if everything works fine, pass along the request to the next middleware or to the route function
+        await self.app(scope, receive, send)
@@ -0,0 +1,52 @@
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.common import metrics
+from app.common.metrics import request_duration, received_bytes, sent_bytes
+from app.metrics import format_server_timing
+from app.utils.downloads import zero_copy_extension
+from app.middlewares.scope import get_route
+
+# routes get their own label; anything else is counted as "other", so unknown paths cannot grow the labels forever
+known_routes = ("files", "uploads", "metrics", "docs", "openapi.json", "")
+
+
+# times every request and counts the bytes it received and sent, by route and method
+# if SERVER_TIMING is enabled, the phases timed during the request are also sent back in a Server-Timing header
+# it is a plain ASGI middleware; it only wraps receive and send to count the bytes going through them
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or (not metrics.is_enabled and not metrics.is_timing_enabled):
+            await self.app(scope, receive, send)
+            return
+
+        route = get_route(scope)
+        route = route if route in known_routes else "other"
+        timings = metrics.start_request_timings()
+        start = time.perf_counter()
+
+        async def receive_counted() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                received_bytes.inc(len(message.get("body", b"")), (route,))
+            return message
+
+        async def send_counted(message: Message):
+            if message["type"] == "http.response.start" and metrics.is_timing_enabled:
+                headers = MutableHeaders(scope=message)
+                headers.append("server-timing", format_server_timing(timings, time.perf_counter() - start))
+            elif message["type"] == "http.response.body":
+                sent_bytes.inc(len(message.get("body", b"")), (route,))
+            elif message["type"] == zero_copy_extension:
+                sent_bytes.inc(message.get("count") or 0, (route,))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_counted, send_counted)
+        finally:
+            request_duration.observe(time.perf_counter() - start, (route, scope["method"]))
@@ -0,0 +1,19 @@
+from starlette.types import Scope
+
+
+# returns the parts of the requested path; ex: /files/<public_key> -> ["files", "<public_key>"]
+# the path comes straight from the ASGI scope, so the query string is never part of it
+def get_path_parts(scope: Scope) -> list[str]:
+    path: str = scope["path"]
+    return path.split("/")[1:]
+
+
+# returns the first part of the requested path; ex: /files/<public_key> -> files
+def get_route(scope: Scope) -> str:
+    return get_path_parts(scope)[0]
+
+
+# returns the ip address of the client; empty if the server does not provide it
+def get_client_host(scope: Scope) -> str:
+    client = scope.get("client")
+    return client[0] if client else ""
@@ -0,0 +1,21 @@
+from typing import Literal
+from pydantic import BaseModel, conlist
+
+from app.common import settings
+
+# the request body to send when starting a resumable upload
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int  # size of the whole file in bytes
+    chunkSize: int | None = None  # size of every chunk in bytes; the server picks one if it is not given
+
+
+# the request body to send when downloading several files as a single archive
+class ArchiveRequest(BaseModel):
+    publicKeys: conlist(str, min_items=1, max_items=settings.ARCHIVE_MAX_FILES)
+    format: Literal["zip", "tar"] = "zip"
+
+
+# the request body to send when deleting several files at once
+class BatchDeleteRequest(BaseModel):
+    privateKeys: conlist(str, min_items=1, max_items=settings.BATCH_MAX_FILES)
@@ -4,3 +4,43 @@ from pydantic import BaseModel
 class FileUploadResponse(BaseModel):
     privateKey: str
     publicKey: str
+
+
+# the response model to return when a resumable upload is started or its status is requested
+# the chunks are given as [first, last] index ranges, both included, so the response stays small for large files
+class UploadSessionResponse(BaseModel):
+    uploadId: str
+    filename: str
+    size: int
+    chunkSize: int
+    chunkCount: int
+    receivedCount: int
+    missingCount: int
+    receivedChunks: list[list[int]]
+    missingChunks: list[list[int]]
+
+
+# the status of one of the files of a batch upload; the keys are only there if the file was saved
+class BatchUploadItem(BaseModel):
+    filename: str
+    status: int
+    publicKey: str | None = None
+    privateKey: str | None = None
+    detail: str | None = None
+
+
+# the response model to return when the client uploads several files at once
+class BatchUploadResponse(BaseModel):
+    files: list[BatchUploadItem]
+
+
+# the status of one of the files of a batch delete
+class BatchDeleteItem(BaseModel):
+    privateKey: str
+    status: int
+    detail: str
+
+
+# the response model to return when the client deletes several files at once
+class BatchDeleteResponse(BaseModel):
+    files: list[BatchDeleteItem]
@@ -1,8 +1,12 @@
-from fastapi import APIRouter, UploadFile, HTTPException, status
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi import APIRouter, Request, UploadFile, HTTPException, status
+from fastapi.responses import JSONResponse, Response
 
-from app.utils import FileUploadHandler, SavedFilesHandler
-from app.models.responses import FileUploadResponse
+from app.common import settings
+from app.utils import FileUploadHandler, StreamUploadHandler, SavedFilesHandler, DownloadHandler, ExecutorHandler
+from app.utils import BatchUploadHandler
+from app.utils import ArchiveHandler, file_cache, saved_files_index, eviction_handler
+from app.models.requests import ArchiveRequest, BatchDeleteRequest
+from app.models.responses import FileUploadResponse, BatchUploadResponse, BatchDeleteResponse
 
 # tags is useful for swagger documentation; to group routes together
 router = APIRouter(prefix="/files", tags=["Files"])
@@ -11,31 +15,91 @@ router = APIRouter(prefix="/files", tags=["Files"])
 not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
 
 # this route handles the file upload
+# the routes of this file are async; the blocking work runs on the dedicated pools of the executor handler,
+# so large transfers cannot take the threads that lookups and small files need
 @router.post("/", response_model=FileUploadResponse)
-def upload_file(file: UploadFile):
-    # when a file is uploaded, pass it to the file upload handler to handle uploaded file
-    file_upload_handler = FileUploadHandler(file)
-    file_upload_handler.save_file()  # this will save the file
+async def upload_file(file: UploadFile):
+    # when a file is uploaded, pass it to the file upload handler to handle uploaded file; this hashes the file
+    file_upload_handler: FileUploadHandler = await ExecutorHandler.run_hashing(FileUploadHandler, file)
+    await ExecutorHandler.run_transfer(file_upload_handler.file_size, file_upload_handler.save_file)  # saves the file
 
     # return a response along with the public and private keys
     return JSONResponse({"publicKey": file_upload_handler.public_key, "privateKey": file_upload_handler.private_key})
 
 
+# this route handles several files uploaded at once, as the "files" fields of a multipart body;
+# the whole request is charged once and all the files are added to the index at once.
+# every file gets its own status, along with its keys if it was saved
+@router.post("/batch", response_model=BatchUploadResponse)
+async def upload_files(files: list[UploadFile], request: Request):
+    if len(files) > settings.BATCH_MAX_FILES:
+        detail = f"A batch can contain at most {settings.BATCH_MAX_FILES} files"
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+
+    content_length = request.headers.get("content-length")
+    batch_upload_handler = BatchUploadHandler(files)
+    await ExecutorHandler.run_transfer(int(content_length) if content_length else None, batch_upload_handler.save_files)
+    return JSONResponse({"files": batch_upload_handler.results})
+
+
+# this route handles a file upload sent as the raw request body, named by the url parameter filename
+# the body is streamed straight into the saved file; cheaper than a multipart upload for large files
+@router.put("/{filename}", response_model=FileUploadResponse)
+async def upload_raw_file(filename: str, request: Request):
+    content_length = request.headers.get("content-length")
+    stream_upload_handler = StreamUploadHandler(filename, int(content_length) if content_length else None)
+    await stream_upload_handler.save_stream(request.stream())  # this will save the file
+
+    # return a response along with the public and private keys
+    return JSONResponse({"publicKey": stream_upload_handler.public_key, "privateKey": stream_upload_handler.private_key})
+
+
+# this route handles the download of several files as a single zip or tar archive, built while it is sent;
+# every file keeps the filename it was uploaded with. if any of the files is not found, nothing is sent
+@router.post("/archive")
+async def download_archive(archive_request: ArchiveRequest):
+    archive_handler = ArchiveHandler(archive_request.publicKeys, archive_request.format)
+    missing_public_keys = await ExecutorHandler.run_metadata(archive_handler.open_files)
+    if missing_public_keys:
+        detail = {"message": "File not found", "publicKeys": missing_public_keys}
+        return JSONResponse({"detail": detail}, status_code=status.HTTP_404_NOT_FOUND)
+
+    return archive_handler.create_response()  # the files are closed once the archive is sent
+
+
+# this route handles the deletion of several files at once, one reference for every private key;
+# every private key gets its own status
+@router.delete("/batch", response_model=BatchDeleteResponse)
+async def delete_files(delete_request: BatchDeleteRequest):
+    saved_files_handler = SavedFilesHandler()
+    are_deleted = await ExecutorHandler.run_metadata(saved_files_handler.delete_saved_files, delete_request.privateKeys)
+
+    results = []
+    for private_key, is_deleted in zip(delete_request.privateKeys, are_deleted):
+        if is_deleted:
+            results.append({"privateKey": private_key, "status": status.HTTP_200_OK, "detail": "Delete successful"})
+        else:
+            results.append({"privateKey": private_key, "status": status.HTTP_404_NOT_FOUND, "detail": "File not found"})
+
+    return JSONResponse({"files": results})
+
+
 # this route handles the file deletion; accepts a url parameter called private_key
 @router.delete("/{private_key}")
-def delete_file(private_key: str, response: Response):
+async def delete_file(private_key: str, response: Response):
     # the private key will always be 64 characters long; if not automatically return 404 not found error
     if len(private_key) != 64:
         response.status_code = status.HTTP_404_NOT_FOUND
         return not_found_exception
 
-    # use the saved files handler to get the filename using the private key
+    # use the saved files handler to get the filename using the private key; with several workers a miss reads
+    # the key file the worker that saved it wrote
     saved_files_handler = SavedFilesHandler()
-    filename = saved_files_handler.get_filename_using_private_key(private_key)
+    filename = await ExecutorHandler.run_metadata(saved_files_handler.get_filename_using_private_key, private_key)
 
     # if a filename is found use the handler to delete the file and return a sucess status
     if filename:
-        saved_files_handler.delete_saved_file(filename)
+        await ExecutorHandler.run_metadata(saved_files_handler.delete_saved_file, filename)
         return JSONResponse({"detail": "Delete successful"})
 
     # if filename does not exist, return a not found error
@@ -43,22 +107,39 @@ def delete_file(private_key: str, response: Response):
     return not_found_exception
 
 
-# this route handles file download
+# this route handles file download; supports conditional requests (If-None-Match, If-Modified-Since)
+# and range requests (Range, If-Range) so clients and caches do not have to download the whole file again
 @router.get("/{public_key}")
-def get_file(public_key: str, response: Response):
+async def get_file(public_key: str, request: Request, response: Response):
     # the public key will always be 64 characters long; if not automatically return 404 not found error
     if len(public_key) != 64:
         response.status_code = status.HTTP_404_NOT_FOUND
         return not_found_exception
 
-    # use the saved files handler to get the filepath using the public key
+    # use the saved files handler to get the filepath, the original filename when the file was uploaded
+    # and the cached contents using the public key
     saved_files_handler = SavedFilesHandler()
-    filepath = saved_files_handler.get_filepath_using_public_key(public_key)
+    filepath, filename, cached_file = await saved_files_handler.find_download(public_key)
 
-    # if a filepath exists, use the handler to get the original filename when the file was uploaded and return it
+    # if a filepath exists, return the file
     if filepath:
-        filename = saved_files_handler.get_original_filename(filepath)
-        return FileResponse(filepath, filename=filename)  # returns the file along with the original filename
+        try:
+            # small files are served from the file cache; a file that is not cached yet is read into it if it fits,
+            # but only when its contents are sent, a not modified response does not need them
+            if cached_file is None:
+                download_handler = await ExecutorHandler.run_metadata(
+                    DownloadHandler, filepath, public_key, request.headers
+                )
+                if not download_handler.is_not_modified():
+                    cached_file = await ExecutorHandler.run_metadata(file_cache.load, public_key, filepath)
+
+            if cached_file is not None:
+                download_handler = DownloadHandler(filepath, public_key, request.headers, cached_file)
+            eviction_handler.touch(public_key)  # the least recently downloaded files are evicted first
+            return download_handler.create_response(filename)  # returns the file along with the original filename
+        except FileNotFoundError:
+            # the file was removed by another worker process; forget it and return a not found error
+            await ExecutorHandler.run_metadata(saved_files_index.sync_record, public_key)
 
     # # if filepath does not exist, return a not found error
     response.status_code = status.HTTP_404_NOT_FOUND
@@ -0,0 +1,73 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from app.common import metrics
+from app.utils import saved_files_index, file_cache, eviction_handler, upload_flights
+
+# tags is useful for swagger documentation; to group routes together
+router = APIRouter(tags=["Metrics"])
+
+
+# returns the share of the uploads whose contents were already saved
+def get_dedup_hit_ratio() -> float:
+    upload_count, dedup_hit_count = saved_files_index.get_dedup_counts()
+    return dedup_hit_count / upload_count if upload_count else 0
+
+
+# the values kept by the handlers themselves are read when the metrics are collected
+metrics.gauge(
+    "file_server_uploads_total",
+    "Uploads saved since the server started.",
+    lambda: saved_files_index.get_dedup_counts()[0],
+    "counter",
+)
+metrics.gauge(
+    "file_server_dedup_hits_total",
+    "Uploads whose contents were already saved and were not written again.",
+    lambda: saved_files_index.get_dedup_counts()[1],
+    "counter",
+)
+metrics.gauge(
+    "file_server_coalesced_uploads_total",
+    "Uploads that waited for another upload of the same contents to write them.",
+    lambda: upload_flights.wait_count,
+    "counter",
+)
+metrics.gauge(
+    "file_server_dedup_hit_ratio", "Share of the uploads whose contents were already saved.", get_dedup_hit_ratio
+)
+metrics.gauge(
+    "file_server_file_cache_hits_total",
+    "Downloads served from the in-memory file cache.",
+    lambda: file_cache.get_hit_counts()[0],
+    "counter",
+)
+metrics.gauge(
+    "file_server_file_cache_misses_total",
+    "Downloads of files that were not in the file cache.",
+    lambda: file_cache.get_hit_counts()[1],
+    "counter",
+)
+metrics.gauge(
+    "file_server_file_cache_bytes", "Size of the contents kept in the file cache.", lambda: file_cache.cached_size
+)
+metrics.gauge(
+    "file_server_evicted_files_total",
+    "Saved contents removed by the eviction since the server started.",
+    lambda: eviction_handler.evicted_count,
+    "counter",
+)
+metrics.gauge(
+    "file_server_stored_files", "Contents saved in the upload folder.", lambda: saved_files_index.get_stored_counts()[0]
+)
+metrics.gauge(
+    "file_server_stored_bytes",
+    "Size of the contents saved in the upload folder.",
+    lambda: saved_files_index.get_stored_counts()[1],
+)
+
+
+# returns the metrics in the prometheus text format
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
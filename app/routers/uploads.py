@@ -0,0 +1,122 @@
+from fastapi import APIRouter, Request, HTTPException, status
+from fastapi.responses import JSONResponse
+
+from app.utils import ExecutorHandler, UploadSessionHandler, UploadSession, UploadSessionNotFoundError, UploadSessionInvalidError
+from app.models.requests import UploadSessionRequest
+from app.models.responses import FileUploadResponse, UploadSessionResponse
+
+# tags is useful for swagger documentation; to group routes together
+router = APIRouter(prefix="/uploads", tags=["Uploads"])
+
+# exceptions to be returned if the upload session is not found or the request does not match it
+not_found_exception = HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+invalid_exception = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid upload")
+incomplete_exception = HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Some chunks are missing")
+
+
+# returns the [first, last] ranges of the received chunks and of the missing ones; received_chunks must be sorted
+def get_chunk_ranges(received_chunks: list[int], chunk_count: int) -> tuple[list[list[int]], list[list[int]]]:
+    received_ranges, missing_ranges = [], []
+    next_index = 0
+    for index in received_chunks:
+        if index == next_index and received_ranges:
+            received_ranges[-1][1] = index
+        else:
+            if index != next_index:
+                missing_ranges.append([next_index, index - 1])
+            received_ranges.append([index, index])
+        next_index = index + 1
+
+    if next_index < chunk_count:
+        missing_ranges.append([next_index, chunk_count - 1])
+
+    return received_ranges, missing_ranges
+
+
+# returns the response with the information about the session and which chunks were received
+def get_session_response(session: UploadSession, received_chunks: list[int]) -> dict:
+    chunk_count = session.get_chunk_count()
+    received_ranges, missing_ranges = get_chunk_ranges(received_chunks, chunk_count)
+    return {
+        "uploadId": session.upload_id,
+        "filename": session.filename,
+        "size": session.size,
+        "chunkSize": session.chunk_size,
+        "chunkCount": chunk_count,
+        "receivedCount": len(received_chunks),
+        "missingCount": chunk_count - len(received_chunks),
+        "receivedChunks": received_ranges,
+        "missingChunks": missing_ranges,
+    }
+
+
+# this route starts a resumable upload; the file is then sent in numbered chunks of chunkSize bytes
+@router.post("/", response_model=UploadSessionResponse)
+async def create_upload(upload: UploadSessionRequest):
+    upload_session_handler = UploadSessionHandler()
+    try:
+        session = await ExecutorHandler.run_metadata(
+            upload_session_handler.create_session, upload.filename, upload.size, upload.chunkSize
+        )
+    except UploadSessionInvalidError:
+        raise invalid_exception
+
+    return JSONResponse(get_session_response(session, []))
+
+
+# this route returns which chunks of the upload were received; used to resume an interrupted upload
+@router.get("/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload(upload_id: str):
+    upload_session_handler = UploadSessionHandler()
+    try:
+        session = await ExecutorHandler.run_metadata(upload_session_handler.get_session, upload_id)
+        received_chunks = await ExecutorHandler.run_metadata(upload_session_handler.get_received_chunks, upload_id)
+    except UploadSessionNotFoundError:
+        raise not_found_exception
+
+    return JSONResponse(get_session_response(session, received_chunks))
+
+
+# this route receives one chunk; the request body is the raw bytes of the chunk
+# chunks can be sent in any order and in parallel; a chunk sent again replaces the previous one
+@router.put("/{upload_id}/chunks/{index}")
+async def put_chunk(upload_id: str, index: int, request: Request):
+    upload_session_handler = UploadSessionHandler()
+    try:
+        await upload_session_handler.write_chunk(upload_id, index, request.stream())
+    except UploadSessionNotFoundError:
+        raise not_found_exception
+    except UploadSessionInvalidError:
+        raise invalid_exception
+
+    return JSONResponse({"detail": "Chunk received", "index": index})
+
+
+# this route joins the chunks into the uploaded file once all of them were received
+# returns the public and private keys, the same as a regular upload of the file would
+@router.post("/{upload_id}/complete", response_model=FileUploadResponse)
+async def complete_upload(upload_id: str):
+    upload_session_handler = UploadSessionHandler()
+    try:
+        # the size of the file is not known before the session is read, so joining the chunks runs as a large transfer
+        public_key, private_key = await ExecutorHandler.run_transfer(
+            None, upload_session_handler.complete_session, upload_id
+        )
+    except UploadSessionNotFoundError:
+        raise not_found_exception
+    except UploadSessionInvalidError:
+        raise incomplete_exception
+
+    return JSONResponse({"publicKey": public_key, "privateKey": private_key})
+
+
+# this route cancels the upload and removes the chunks received so far
+@router.delete("/{upload_id}")
+async def delete_upload(upload_id: str):
+    upload_session_handler = UploadSessionHandler()
+    try:
+        await ExecutorHandler.run_metadata(upload_session_handler.remove_session, upload_id)
+    except UploadSessionNotFoundError:
+        raise not_found_exception
+
+    return JSONResponse({"detail": "Upload cancelled"})
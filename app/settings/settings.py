@@ -1,6 +1,7 @@
 from dotenv import load_dotenv
 from pydantic import BaseSettings
 from pathlib import Path
+from typing import Literal
 
 # loads all the environment variables inside the .env file
 load_dotenv()
@@ -16,3 +17,41 @@ class Settings(BaseSettings):
     PORT: int  # port used for the server
     DAILY_LIMIT_MB: int  # upload and download limit for the client with the same IP address
     CLEANUP_AFTER_MINS_INACTIVITY: int  # value in minutes of inactivity; used to determine if clean up will be ran
+    DATABASE_PATH: str = "./db.sqlite3"  # path to the SQLite database that keeps track of the daily limits
+    UPLOAD_CHUNK_SIZE_KB: int = 1024  # size in kilobytes of the chunks an upload is read and written in
+    QUOTA_FLUSH_INTERVAL_SECS: int = 5  # how often the used sizes kept in memory are written to the database
+    QUOTA_MAX_UNFLUSHED_MB: int = 100  # most size that can be reserved before the used sizes are written to the database
+    DOWNLOAD_CHUNK_SIZE_KB: int = 256  # size in kilobytes of the chunks a download is read in when it cannot be zero-copy
+    ZERO_COPY_DOWNLOADS: bool = True  # hand downloads to the server as a file descriptor if it supports zerocopysend
+    UPLOAD_SESSION_CHUNK_SIZE_MB: int = 8  # chunk size of resumable uploads when the client does not pick one
+    UPLOAD_SESSION_MAX_CHUNK_SIZE_MB: int = 64  # largest chunk size a client can pick for a resumable upload
+    UPLOAD_SESSION_EXPIRY_MINS: int = 1440  # resumable uploads that receive nothing for this long are removed
+    UPLOAD_SESSION_MAX_SIZE_MB: int = 10000  # largest file that can be sent as a resumable upload
+    UPLOAD_SESSION_MAX_CHUNKS: int = 10000  # most chunks a resumable upload can be split in
+    METADATA_POOL_SIZE: int = 16  # threads for lookups, stats, deletions and the reads and writes of small files
+    TRANSFER_POOL_SIZE: int = 8  # threads for the reads and writes of large files
+    HASH_POOL_SIZE: int = 4  # threads for hashing uploaded files
+    LARGE_TRANSFER_MB: int = 8  # files larger than this are read and written on the transfer pool
+    HASH_ENGINE: Literal["thread", "process"] = "thread"  # process hashes large uploads in worker processes
+    HASH_PROCESS_MIN_MB: int = 64  # with the process engine, uploads of at least this size are hashed in a process
+    HASH_PROCESS_COUNT: int = 0  # number of hashing processes; 0 uses one per CPU
+    FILE_CACHE_MB: int = 64  # memory the contents of small downloaded files can take in the cache; 0 disables it
+    FILE_CACHE_MAX_FILE_KB: int = 1024  # files larger than this are never cached
+    WORKERS: int = 1  # worker processes started by run.prod.py; 0 starts one per CPU
+    STORAGE_BUDGET_MB: int = 0  # least recently used files are removed above this size; 0 is no limit
+    FILE_TTL_MINS: int = 0  # files nobody uploaded or downloaded for this long are removed; 0 keeps them
+    EVICTION_BATCH_SIZE: int = 100  # most files removed by one clean up check
+    EVICTION_RESCAN_MINS: int = 60  # with several workers and INDEX_SNAPSHOT off, how often the clean up rescans
+    METRICS_ENABLED: bool = True  # collect the latencies and sizes exported by /metrics
+    SERVER_TIMING: bool = False  # add a Server-Timing header with the time taken by every phase of a request
+    ARCHIVE_MAX_FILES: int = 1000  # most files a single archive download can ask for
+    BATCH_MAX_FILES: int = 1000  # most files a single batch upload or batch delete can contain
+    INDEX_SNAPSHOT: bool = True  # keep the index on the disk so starting the server does not scan the upload folder
+    INDEX_JOURNAL_MAX_MB: int = 64  # the changes of the index are folded into a new snapshot once they take this much
+    STORAGE_COMPRESSION: Literal["none", "gzip", "zstd"] = "none"  # compress compressible uploads; zstd needs zstandard
+    STORAGE_COMPRESSION_LEVEL: int = 3  # higher levels save more room and take more time
+    STORAGE_COMPRESSION_MIN_SAVING: int = 10  # contents that shrink by less than this percent are stored as they are
+    BANDWIDTH_HOST_KB_PER_SEC: int = 0  # most kilobytes a host uploads, and downloads, per second; 0 is no limit
+    BANDWIDTH_HOST_BURST_KB: int = 1024  # kilobytes a host can transfer at once before it is paced
+    BANDWIDTH_GLOBAL_KB_PER_SEC: int = 0  # most kilobytes uploaded, and downloaded, per second in all; 0 is no limit
+    BANDWIDTH_GLOBAL_BURST_KB: int = 4096  # kilobytes every host together can transfer at once before being paced
@@ -1 +1,14 @@
+from .executors import *
+from .workers import *
+from .hashing import *
+from .cache import *
+from .eviction import *
+from .snapshots import *
+from .flights import *
+from .compression import *
 from .utils import *
+from .quota import *
+from .bandwidth import *
+from .downloads import *
+from .archives import *
+from .sessions import *
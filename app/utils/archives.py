@@ -0,0 +1,237 @@
+import os, time, tarfile, zipfile
+from typing import BinaryIO, Iterator
+
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app.common import settings
+from app.utils.executors import ExecutorHandler
+from app.utils.eviction import eviction_handler
+from app.utils.compression import CompressionHandler
+from app.utils.utils import SavedFilesHandler, saved_files_index
+
+archive_media_types = {"zip": "application/zip", "tar": "application/x-tar"}
+zip_min_timestamp = 315532800  # zip dates start in 1980
+
+
+# a saved file going into an archive, opened before the archive starts so it cannot be removed halfway through
+class ArchiveEntry:
+    public_key: str
+    filename: str  # the name of the file inside the archive
+    file: BinaryIO
+    size: int  # size of the original contents, which is what goes into the archive
+    last_modified: int
+    encoding: str  # what the contents are stored with; they are decompressed into the archive
+
+    def __init__(self, public_key: str, filename: str, file: BinaryIO, encoding: str = "", size: int = 0) -> None:
+        file_stat = os.fstat(file.fileno())
+        self.public_key = public_key
+        self.filename = filename
+        self.file = file
+        self.size = size if encoding else file_stat.st_size
+        self.last_modified = int(file_stat.st_mtime)
+        self.encoding = encoding
+
+
+# what zipfile writes the archive to; it keeps the bytes until they are taken and sent, so only the current chunk
+# of the archive is ever held in memory. it cannot seek, so zipfile writes the sizes after the contents of every file
+class ArchiveBuffer:
+    buffer: bytearray
+    position: int
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    # returns the bytes written since the last call
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+# builds a zip or tar archive of several saved files on the fly, one chunk at a time, so the archive is never
+# written anywhere or held in memory as a whole. the contents are stored as they are, they are not compressed.
+# every file keeps the filename it was uploaded with; names used more than once get a number appended
+class ArchiveHandler:
+    public_keys: list[str]
+    format: str  # zip or tar
+    entries: list[ArchiveEntry]
+    chunk_size: int
+
+    def __init__(self, public_keys: list[str], format: str) -> None:
+        self.public_keys = public_keys
+        self.format = format
+        self.entries = []
+        self.chunk_size = settings.DOWNLOAD_CHUNK_SIZE_KB * 1024
+
+    # returns the size of the contents saved under the public keys, which is what the archive charges;
+    # None if any of them is not saved. nothing is opened, the sizes come from the index
+    @staticmethod
+    def get_contents_size(public_keys: list[str]) -> int | None:
+        size = 0
+        for public_key in public_keys:
+            record = saved_files_index.get_record(public_key) if len(public_key) == 64 else None
+            if record is None:
+                return None
+            size += record.size
+
+        return size
+
+    # returns a name for the file inside the archive that is not used yet; path separators are dropped
+    # so a file can never be extracted outside of the folder the archive is extracted into
+    def __get_unique_filename(self, filename: str, public_key: str, used_filenames: set[str]) -> str:
+        filename = filename.replace("\\", "/").split("/")[-1].strip()
+        if filename in ("", ".", ".."):
+            filename = public_key
+
+        name, extension = os.path.splitext(filename)
+        unique_filename = filename
+        count = 1
+        while unique_filename in used_filenames:
+            unique_filename = f"{name} ({count}){extension}"
+            count += 1
+
+        used_filenames.add(unique_filename)
+        return unique_filename
+
+    # opens every file of the archive; returns the public keys that are not saved, in which case nothing is kept open
+    def open_files(self) -> list[str]:
+        saved_files_handler = SavedFilesHandler()
+        missing_public_keys = []
+        used_filenames: set[str] = set()
+        for public_key in self.public_keys:
+            filepath = saved_files_handler.get_filepath_using_public_key(public_key) if len(public_key) == 64 else ""
+            try:
+                if not filepath:
+                    raise FileNotFoundError()
+                file = open(filepath, "rb")
+            except FileNotFoundError:
+                if filepath:
+                    saved_files_index.sync_record(public_key)  # removed by another worker process
+                missing_public_keys.append(public_key)
+                continue
+
+            filename = saved_files_handler.get_original_filename(filepath)
+            filename = self.__get_unique_filename(filename, public_key, used_filenames)
+            record = saved_files_index.get_record(public_key)
+            encoding, size = (record.encoding, record.size) if record is not None else ("", 0)
+            self.entries.append(ArchiveEntry(public_key, filename, file, encoding, size))
+
+        if missing_public_keys:
+            self.close_files()
+
+        return missing_public_keys
+
+    # closes every file of the archive
+    def close_files(self):
+        for entry in self.entries:
+            entry.file.close()
+        self.entries = []
+
+    # yields the contents of the file in chunks
+    def __read_entry(self, entry: ArchiveEntry) -> Iterator[bytes]:
+        if entry.encoding:
+            yield from CompressionHandler.decompress(entry.encoding, entry.file)
+            return
+
+        position = 0
+        while position < entry.size:
+            chunk = os.pread(entry.file.fileno(), min(self.chunk_size, entry.size - position), position)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    # yields the archive as a tar; every file is a header, the contents, and padding up to the next block
+    def __generate_tar(self) -> Iterator[bytes]:
+        for entry in self.entries:
+            tar_info = tarfile.TarInfo(entry.filename)
+            tar_info.size = entry.size
+            tar_info.mtime = entry.last_modified
+            tar_info.mode = 0o644
+            yield tar_info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            yield from self.__read_entry(entry)
+
+            padding = -entry.size % tarfile.BLOCKSIZE
+            if padding:
+                yield tarfile.NUL * padding
+
+        yield tarfile.NUL * tarfile.BLOCKSIZE * 2  # the end of the archive
+
+    # yields the archive as a zip
+    def __generate_zip(self) -> Iterator[bytes]:
+        archive_buffer = ArchiveBuffer()
+        with zipfile.ZipFile(archive_buffer, "w", zipfile.ZIP_STORED) as archive:
+            for entry in self.entries:
+                date_time = time.localtime(max(entry.last_modified, zip_min_timestamp))[:6]
+                zip_info = zipfile.ZipInfo(entry.filename, date_time)
+                zip_info.file_size = entry.size  # lets zipfile know in advance whether the file needs zip64
+                with archive.open(zip_info, "w") as f:
+                    for chunk in self.__read_entry(entry):
+                        f.write(chunk)
+                        yield archive_buffer.take()
+                yield archive_buffer.take()
+
+        yield archive_buffer.take()
+
+    # yields the archive chunk by chunk; the files must be open
+    def generate(self) -> Iterator[bytes]:
+        if self.format == "tar":
+            return self.__generate_tar()
+
+        return self.__generate_zip()
+
+    # returns the response that streams the archive; it closes the files once it is sent
+    def create_response(self) -> Response:
+        for entry in self.entries:
+            eviction_handler.touch(entry.public_key)  # the least recently downloaded files are evicted first
+
+        headers = {"content-disposition": f'attachment; filename="files.{self.format}"'}
+        return ArchiveResponse(self, headers, archive_media_types[self.format])
+
+
+# streams an archive built by the archive handler; every chunk is built on the transfer pool
+class ArchiveResponse(Response):
+    archive_handler: ArchiveHandler
+
+    def __init__(self, archive_handler: ArchiveHandler, headers: dict[str, str], media_type: str) -> None:
+        self.archive_handler = archive_handler
+        self.status_code = 200
+        self.background = None
+        self.media_type = media_type
+        self.init_headers(headers)
+
+    # gathers the pieces of the archive until they make up a whole chunk, so small files and headers do not cost
+    # a trip to the transfer pool each; returns an empty chunk once the archive is complete
+    def __read_chunk(self, chunks: Iterator[bytes]) -> bytes:
+        chunk = bytearray()
+        for piece in chunks:
+            chunk += piece
+            if len(chunk) >= self.archive_handler.chunk_size:
+                break
+
+        return bytes(chunk)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        chunks = self.archive_handler.generate()
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            while chunk := await ExecutorHandler.run_transfer(None, self.__read_chunk, chunks):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            chunks.close()
+            self.archive_handler.close_files()
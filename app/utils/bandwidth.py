@@ -0,0 +1,112 @@
+import time, asyncio
+
+from app.common import settings
+from app.common.metrics import bandwidth_wait_duration
+from app.utils.workers import WorkersHandler
+
+small_transfer_size = 64 * 1024  # the first bytes of every request or response are never held back by the global bucket
+prune_interval_secs = 60  # how often the buckets of the hosts that stopped transferring are dropped
+
+
+# a token bucket: it fills up at rate bytes per second, up to burst bytes. a transfer takes its size from it
+# even if there is not enough, and waits until the bucket is back to zero; transfers taking from an empty bucket
+# wait in turn, each for the time it takes to refill what it took
+class TokenBucket:
+    tokens: float  # bytes that can be transferred right away; negative once transfers took more than there was
+    updated_at: float  # monotonic time tokens was last refilled
+
+    def __init__(self, burst: int, now: float) -> None:
+        self.tokens = burst
+        self.updated_at = now
+
+    # refills the bucket for the time elapsed, takes the size from it and returns how many seconds to wait
+    def take(self, size: int, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.updated_at) * rate) - size
+        self.updated_at = now
+        return max(0.0, -self.tokens / rate)
+
+    # returns whether the bucket refilled completely; a full bucket is the same as a new one
+    def is_full(self, rate: float, burst: float, now: float) -> bool:
+        return self.tokens + (now - self.updated_at) * rate >= burst
+
+
+# paces the bytes every host uploads and downloads, so a single host cannot take the whole bandwidth of the server.
+# every host gets a bucket of BANDWIDTH_HOST_KB_PER_SEC for each direction, and the whole server one of
+# BANDWIDTH_GLOBAL_KB_PER_SEC; a transfer waits for both. the first bytes of every request and response only wait
+# for the host's bucket, so small requests are not held back behind the large transfers of other hosts.
+# with several workers, every worker paces its own connections: the global rate is split evenly between them,
+# the host rate applies in every worker
+class BandwidthHandler:
+    host_buckets: dict[tuple[str, str], TokenBucket]  # (direction, host) -> bucket
+    global_buckets: dict[str, TokenBucket]  # direction -> bucket
+    pruned_at: float  # monotonic time the buckets of idle hosts were last dropped
+
+    def __init__(self) -> None:
+        self.host_buckets = {}
+        self.global_buckets = {}
+        self.pruned_at = time.monotonic()
+
+    # returns the rate and burst of the buckets of every host in bytes
+    def get_host_limits(self) -> tuple[float, float]:
+        return settings.BANDWIDTH_HOST_KB_PER_SEC * 1024, settings.BANDWIDTH_HOST_BURST_KB * 1024
+
+    # returns the rate and burst of the global buckets of this worker in bytes
+    def get_global_limits(self) -> tuple[float, float]:
+        worker_count = WorkersHandler.get_worker_count()
+        rate = settings.BANDWIDTH_GLOBAL_KB_PER_SEC * 1024 / worker_count
+        return rate, settings.BANDWIDTH_GLOBAL_BURST_KB * 1024 / worker_count
+
+    # returns whether any transfer is paced
+    def is_enabled(self) -> bool:
+        return settings.BANDWIDTH_HOST_KB_PER_SEC > 0 or settings.BANDWIDTH_GLOBAL_KB_PER_SEC > 0
+
+    # drops the buckets of the hosts that refilled them completely; they are created again on their next transfer
+    def __prune(self, now: float):
+        self.pruned_at = now
+        rate, burst = self.get_host_limits()
+        for key, bucket in list(self.host_buckets.items()):
+            if bucket.is_full(rate, burst, now):
+                del self.host_buckets[key]
+
+    # takes size bytes from the buckets of the host and of the server for a transfer in the direction ("upload"
+    # or "download") that already transferred transferred_size bytes; returns how many seconds it must wait
+    def take(self, direction: str, host: str, size: int, transferred_size: int) -> float:
+        now = time.monotonic()
+        wait_secs = 0.0
+
+        rate, burst = self.get_host_limits()
+        if rate > 0:
+            if now - self.pruned_at >= prune_interval_secs:
+                self.__prune(now)
+            bucket = self.host_buckets.get((direction, host))
+            if bucket is None:
+                bucket = self.host_buckets[(direction, host)] = TokenBucket(burst, now)
+            wait_secs = bucket.take(size, rate, burst, now)
+
+        rate, burst = self.get_global_limits()
+        if rate > 0:
+            bucket = self.global_buckets.get(direction)
+            if bucket is None:
+                bucket = self.global_buckets[direction] = TokenBucket(burst, now)
+            global_wait_secs = bucket.take(size, rate, burst, now)
+            # small transfers are still taken from the global bucket, the large ones wait for them
+            if transferred_size + size > small_transfer_size:
+                wait_secs = max(wait_secs, global_wait_secs)
+
+        return wait_secs
+
+    # waits until the transfer can go on; see take()
+    async def pace(self, direction: str, host: str, size: int, transferred_size: int):
+        wait_secs = self.take(direction, host, size, transferred_size)
+        if wait_secs > 0:
+            bandwidth_wait_duration.inc(wait_secs, (direction,))
+            await asyncio.sleep(wait_secs)
+
+    # drops every bucket
+    def reset(self):
+        self.host_buckets = {}
+        self.global_buckets = {}
+
+
+# the bandwidth handler shared by the whole process; buckets are only used from the event loop, they need no lock
+bandwidth_handler = BandwidthHandler()
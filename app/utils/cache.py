@@ -0,0 +1,113 @@
+import os, threading
+from collections import OrderedDict
+
+from app.common import settings
+from app.utils.workers import WorkersHandler
+
+
+# the contents of a saved file kept in memory, along with what a download needs to know about the file
+class CachedFile:
+    filepath: str
+    contents: bytes
+    last_modified: int  # modification time of the file in seconds, the same as DownloadHandler keeps
+
+    def __init__(self, filepath: str, contents: bytes, last_modified: int) -> None:
+        self.filepath = filepath
+        self.contents = contents
+        self.last_modified = last_modified
+
+
+# keeps the contents of small, frequently downloaded files in memory, so a download of a cached file
+# does not stat, open, read or close anything. the least recently downloaded files are dropped first
+# once the cached contents go over FILE_CACHE_MB; files larger than FILE_CACHE_MAX_FILE_KB are never cached.
+# saved contents never change under their public key, so an entry is only dropped when the contents are removed;
+# with several workers, another worker may remove them, so every hit checks that the file still exists
+class FileCache:
+    lock: threading.Lock
+    files: OrderedDict[str, CachedFile]  # cached files by public key, from the least to the most recently used
+    cached_size: int  # size in bytes of all the cached contents
+    hit_count: int
+    miss_count: int
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.cached_size = 0
+        self.hit_count = 0
+        self.miss_count = 0
+
+    # returns the most size in bytes the cached contents can take
+    def get_budget_bytes(self) -> int:
+        return settings.FILE_CACHE_MB * 1000 * 1000
+
+    # returns whether a file of the size can be cached
+    def is_cacheable(self, size: int) -> bool:
+        return size <= min(settings.FILE_CACHE_MAX_FILE_KB * 1024, self.get_budget_bytes())
+
+    # returns the cached file of the public key, or None if it is not cached;
+    # counted lookups mark the file as recently used and count as a hit or a miss
+    def get(self, public_key: str, is_counted: bool = True) -> CachedFile | None:
+        if self.get_budget_bytes() <= 0:
+            return None
+
+        cached_file = self.files.get(public_key)
+        # checked outside of the lock, so other lookups do not wait for the disk
+        is_removed = cached_file is not None and WorkersHandler.is_shared() and not os.path.exists(cached_file.filepath)
+        with self.lock:
+            if is_removed and self.files.get(public_key) is cached_file:
+                self.__remove(public_key)
+            cached_file = None if is_removed else self.files.get(public_key)
+
+            if is_counted:
+                if cached_file is None:
+                    self.miss_count += 1
+                else:
+                    self.hit_count += 1
+                    self.files.move_to_end(public_key)
+
+            return cached_file
+
+    # reads the file into the cache if it is small enough; returns the cached file, or None if it is not cacheable
+    def load(self, public_key: str, filepath: str) -> CachedFile | None:
+        file_stat = os.stat(filepath)
+        if self.get_budget_bytes() <= 0 or not self.is_cacheable(file_stat.st_size):
+            return None
+
+        with open(filepath, "rb") as f:
+            cached_file = CachedFile(filepath, f.read(), int(file_stat.st_mtime))
+
+        with self.lock:
+            self.__remove(public_key)
+            self.files[public_key] = cached_file
+            self.cached_size += len(cached_file.contents)
+            while self.cached_size > self.get_budget_bytes():
+                _, evicted_file = self.files.popitem(last=False)
+                self.cached_size -= len(evicted_file.contents)
+
+        return cached_file
+
+    # drops the file of the public key from the cache; the lock must be held
+    def __remove(self, public_key: str):
+        cached_file = self.files.pop(public_key, None)
+        if cached_file is not None:
+            self.cached_size -= len(cached_file.contents)
+
+    # drops the file of the public key from the cache; called when its contents are removed
+    def remove(self, public_key: str):
+        with self.lock:
+            self.__remove(public_key)
+
+    # drops every file from the cache
+    def clear(self):
+        with self.lock:
+            self.files = OrderedDict()
+            self.cached_size = 0
+
+    # returns how many counted lookups found the file in the cache and how many did not
+    def get_hit_counts(self) -> tuple[int, int]:
+        with self.lock:
+            return self.hit_count, self.miss_count
+
+
+# the cache shared by all the handlers in this process
+file_cache = FileCache()
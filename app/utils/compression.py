@@ -0,0 +1,144 @@
+import os, gzip, zlib, tempfile
+from typing import BinaryIO, Iterator
+
+from app.common import settings
+
+try:
+    import zstandard  # optional; STORAGE_COMPRESSION=zstd needs it
+except ImportError:
+    zstandard = None
+
+compression_chunk_size = 1024 * 1024  # size of the reads done while compressing or decompressing a file
+probe_size = 64 * 1024  # bytes looked at to tell whether contents are compressible
+
+# contents that are compressed already gain nothing from being compressed again; they are recognized by their
+# extension, or by the first bytes of the contents when the extension says nothing
+incompressible_extensions = set(
+    (
+        ".jpg .jpeg .png .gif .webp .avif .heic .mp3 .mp4 .m4a .m4v .mov .mkv .webm .ogg .opus .flac .aac "
+        ".zip .gz .tgz .bz2 .xz .zst .7z .rar .jar .apk .pdf .docx .xlsx .pptx .odt .epub .woff .woff2"
+    ).split()
+)
+incompressible_signatures = (
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG",
+    b"GIF8",
+    b"RIFF",  # webp, wav, avi
+    b"ID3",  # mp3
+    b"\xff\xfb",  # mp3 without tags
+    b"OggS",
+    b"fLaC",
+    b"%PDF",
+    b"PK\x03\x04",  # zip and the formats built on it
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"BZh",
+    b"\xfd7zXZ",
+    b"7z\xbc\xaf",
+    b"Rar!",
+)
+
+
+# compresses the saved contents when STORAGE_COMPRESSION is gzip or zstd, so text, CSV, JSON and logs take less
+# room in the upload folder. contents that are compressed already are recognized and stored as they are, as are
+# contents that do not shrink by at least STORAGE_COMPRESSION_MIN_SAVING percent. the public key is always the
+# hash of the original contents; the metadata of the saved contents records which encoding they were stored with
+class CompressionHandler:
+    # returns the encoding new contents are stored with; empty if they are stored as they are
+    @staticmethod
+    def get_encoding() -> str:
+        if settings.STORAGE_COMPRESSION == "gzip" or settings.STORAGE_COMPRESSION == "zstd" and zstandard is not None:
+            return settings.STORAGE_COMPRESSION
+
+        return ""
+
+    # returns whether the contents may shrink, from the filename and the first bytes of the contents: the known
+    # formats are recognized, and the other contents must shrink enough once quickly compressed
+    @staticmethod
+    def is_compressible(filename: str, head: bytes) -> bool:
+        if os.path.splitext(filename)[1].lower() in incompressible_extensions:
+            return False
+
+        if head.startswith(incompressible_signatures) or head[4:8] == b"ftyp":  # ftyp: mp4, mov, heic
+            return False
+
+        return CompressionHandler.is_worth_it(len(head), len(zlib.compress(head, 1)))
+
+    # returns whether the compressed contents are small enough to be kept instead of the original ones
+    @staticmethod
+    def is_worth_it(size: int, compressed_size: int) -> bool:
+        return compressed_size <= size * (100 - settings.STORAGE_COMPRESSION_MIN_SAVING) / 100
+
+    # returns a file object that compresses what is written to it into the file; closing it does not close the file
+    @staticmethod
+    def open_compressor(encoding: str, file: BinaryIO) -> BinaryIO:
+        level = settings.STORAGE_COMPRESSION_LEVEL
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor(level=level).stream_writer(file, closefd=False)
+
+        return gzip.GzipFile(fileobj=file, mode="wb", compresslevel=level, mtime=0)
+
+    # yields the decompressed contents of the file in chunks
+    @staticmethod
+    def decompress(encoding: str, file: BinaryIO) -> Iterator[bytes]:
+        if encoding == "zstd":
+            reader = zstandard.ZstdDecompressor().stream_reader(file, closefd=False)
+        else:
+            reader = gzip.GzipFile(fileobj=file, mode="rb")
+
+        with reader:
+            while chunk := reader.read(compression_chunk_size):
+                yield chunk
+
+    # compresses the file in place if it is worth it and returns the encoding it is stored with, empty if none;
+    # the compressed contents go to a temporary file next to it that replaces it once it is complete
+    @staticmethod
+    def compress_file(filepath: str, filename: str) -> str:
+        encoding = CompressionHandler.get_encoding()
+        if not encoding:
+            return ""
+
+        with open(filepath, "rb") as source:
+            if not CompressionHandler.is_compressible(filename, source.read(probe_size)):
+                return ""
+
+            source.seek(0)
+            directory, name = os.path.split(filepath)
+            fd, compressed_filepath = tempfile.mkstemp(prefix=name + "-", dir=directory)
+            try:
+                with open(fd, "wb") as f:
+                    with CompressionHandler.open_compressor(encoding, f) as compressor:
+                        while chunk := source.read(compression_chunk_size):
+                            compressor.write(chunk)
+                    compressed_size = f.tell()
+                is_worth_it = CompressionHandler.is_worth_it(os.fstat(source.fileno()).st_size, compressed_size)
+            except:
+                os.remove(compressed_filepath)
+                raise
+
+        if not is_worth_it:
+            os.remove(compressed_filepath)
+            return ""
+
+        os.replace(compressed_filepath, filepath)
+        return encoding
+
+    # returns whether a client sending the Accept-Encoding header takes contents in the encoding as they are
+    @staticmethod
+    def is_accepted(encoding: str, accept_encoding: str | None) -> bool:
+        is_accepted = False
+        for value in (accept_encoding or "").lower().split(","):
+            coding, _, parameters = value.partition(";")
+            coding = coding.strip().removeprefix("x-")  # x-gzip is the same as gzip
+            if coding != encoding and coding != "*":
+                continue
+
+            try:
+                quality = float(parameters.strip().removeprefix("q=")) if parameters.strip() else 1.0
+            except ValueError:
+                quality = 1.0
+            if coding != "*":
+                return quality > 0  # an explicit coding takes precedence over *
+            is_accepted = quality > 0
+
+        return is_accepted
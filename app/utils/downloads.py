@@ -0,0 +1,362 @@
+import io, os, mimetypes, email.utils
+from urllib.parse import quote
+
+from fastapi import status
+from fastapi.responses import Response
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+from app.common import settings
+from app.utils.executors import ExecutorHandler
+from app.utils.cache import CachedFile
+from app.utils.compression import CompressionHandler
+from app.utils.utils import saved_files_index
+
+# saved files never change; the public key is the hash of the contents, so they can be cached for as long as possible
+cache_control = "public, max-age=31536000, immutable"
+max_ranges = 32  # requests asking for more ranges than this get the whole file instead
+zero_copy_extension = "http.response.zerocopysend"  # ASGI extension for servers that can send a file descriptor
+
+
+# decides what a download request gets: the whole file, some ranges of it, or nothing if the client's copy is current
+# it is used by the limits middleware to charge only the bytes that will be served and by the route to build the response
+# contents stored compressed are sent as they are, with Content-Encoding, to clients whose Accept-Encoding takes
+# the encoding; the other clients get them decompressed on the fly, always whole since ranges cannot be served then
+class DownloadHandler:
+    filepath: str
+    public_key: str
+    file_size: int  # size of what is sent: the stored file, or the original contents if they are decompressed
+    last_modified: int  # modification time of the file in seconds; HTTP dates have no fractions of seconds
+    headers: Headers  # headers of the request
+    cached_file: CachedFile | None  # the contents kept in memory by the file cache, if the file is cached
+    encoding: str  # what the contents are stored with; empty if they are not compressed
+    content_encoding: str  # what the response is sent with; empty if the contents are sent decompressed
+
+    # a cached file is served from memory; the file is not even looked at
+    def __init__(
+        self, filepath: str, public_key: str, headers: Headers, cached_file: CachedFile | None = None
+    ) -> None:
+        self.filepath = filepath
+        self.public_key = public_key
+        self.headers = headers
+        self.cached_file = cached_file
+        if cached_file is not None:
+            self.file_size = len(cached_file.contents)
+            self.last_modified = cached_file.last_modified
+        else:
+            file_stat = os.stat(filepath)
+            self.file_size = file_stat.st_size
+            self.last_modified = int(file_stat.st_mtime)
+
+        record = saved_files_index.get_record(public_key)
+        self.encoding = record.encoding if record is not None else ""
+        self.content_encoding = ""
+        if self.encoding:
+            if CompressionHandler.is_accepted(self.encoding, headers.get("accept-encoding")):
+                self.content_encoding = self.encoding
+            else:
+                self.file_size = record.size
+
+    # returns whether the contents are decompressed while they are sent
+    def is_decompressed(self) -> bool:
+        return self.encoding != self.content_encoding
+
+    # the public key is the hash of the contents, which makes it a strong entity tag;
+    # the compressed contents are another representation of them, so they get another one
+    def get_etag(self) -> str:
+        if self.content_encoding:
+            return f'"{self.public_key}-{self.content_encoding}"'
+
+        return f'"{self.public_key}"'
+
+    # returns the modification time formatted as an HTTP date
+    def get_last_modified(self) -> str:
+        return email.utils.formatdate(self.last_modified, usegmt=True)
+
+    # parses an HTTP date into a timestamp; returns None if the date is invalid
+    def __parse_http_date(self, value: str) -> float | None:
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    # returns whether the client already has the current contents; If-None-Match takes precedence over If-Modified-Since
+    def is_not_modified(self) -> bool:
+        if_none_match = self.headers.get("if-none-match")
+        if if_none_match is not None:
+            etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+            return "*" in etags or self.get_etag() in etags
+
+        if_modified_since = self.headers.get("if-modified-since")
+        if if_modified_since is not None:
+            timestamp = self.__parse_http_date(if_modified_since)
+            return timestamp is not None and self.last_modified <= timestamp
+
+        return False
+
+    # returns whether a Range header should be honoured; If-Range makes it conditional on the client's copy being current
+    def __is_range_allowed(self) -> bool:
+        if_range = self.headers.get("if-range")
+        if if_range is None:
+            return True
+
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == self.get_etag()  # If-Range requires a strong comparison
+
+        timestamp = self.__parse_http_date(if_range)
+        return timestamp is not None and self.last_modified <= timestamp
+
+    # returns the requested ranges as (start, end) pairs, end excluded, sorted and with overlapping ranges merged
+    # returns None when the whole file should be served, and an empty list when no range can be satisfied
+    def get_ranges(self) -> list[tuple[int, int]] | None:
+        range_header = self.headers.get("range")
+        if not range_header or not self.__is_range_allowed() or self.is_decompressed():
+            return None
+
+        unit, _, range_specs = range_header.partition("=")
+        if unit.strip().lower() != "bytes":
+            return None
+
+        ranges = []
+        for range_spec in range_specs.split(","):
+            start, separator, end = range_spec.strip().partition("-")
+            if not separator:
+                return None  # a malformed header is ignored
+
+            try:
+                if not start:  # suffix range; the last <end> bytes
+                    start, end = max(self.file_size - int(end), 0), self.file_size
+                elif end:  # the last position is compared with the first before it is clamped to the size of the file
+                    start, end = int(start), int(end) + 1
+                else:  # open range; up to the end of the file
+                    start = int(start)
+                    end = max(start, self.file_size)
+            except ValueError:
+                return None
+
+            if start < 0 or end < start:
+                return None
+
+            # a range starting at or after the end of the file cannot be satisfied
+            if start < self.file_size and start < end:
+                ranges.append((start, min(end, self.file_size)))
+
+        if len(ranges) > max_ranges:
+            return None
+
+        merged_ranges: list[tuple[int, int]] = []
+        for start, end in sorted(ranges):
+            if merged_ranges and start <= merged_ranges[-1][1]:
+                merged_ranges[-1] = (merged_ranges[-1][0], max(end, merged_ranges[-1][1]))
+            else:
+                merged_ranges.append((start, end))
+
+        return merged_ranges
+
+    # returns how many bytes of the file the response will contain; used to charge the client's daily limit
+    def get_served_size(self) -> int:
+        if self.is_not_modified():
+            return 0
+
+        ranges = self.get_ranges()
+        if ranges is None:
+            return self.file_size
+
+        return sum(end - start for start, end in ranges)
+
+    # returns the headers every response of the file has; what is sent for compressed contents depends on
+    # Accept-Encoding, which caches are told with Vary
+    def __get_cache_headers(self) -> dict[str, str]:
+        headers = {"etag": self.get_etag(), "last-modified": self.get_last_modified(), "cache-control": cache_control}
+        if self.encoding:
+            headers["vary"] = "accept-encoding"
+
+        return headers
+
+    # builds the response: 304 if the client's copy is current, 416 if no range can be served,
+    # 206 with the requested ranges, or 200 with the whole file
+    def create_response(self, filename: str) -> Response:
+        headers = self.__get_cache_headers()
+        if self.is_not_modified():
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        ranges = self.get_ranges()
+        if ranges == []:
+            headers["content-range"] = f"bytes */{self.file_size}"
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+
+        media_type = mimetypes.guess_type(filename)[0] or "text/plain"
+
+        # same as starlette's FileResponse; non ascii filenames are sent encoded
+        quoted_filename = quote(filename)
+        if quoted_filename != filename:
+            headers["content-disposition"] = f"attachment; filename*=utf-8''{quoted_filename}"
+        else:
+            headers["content-disposition"] = f'attachment; filename="{filename}"'
+
+        contents = self.cached_file.contents if self.cached_file is not None else None
+        if self.is_decompressed():
+            return DecompressedFileResponse(self.filepath, self.encoding, self.file_size, headers, media_type, contents)
+
+        if self.content_encoding:
+            headers["content-encoding"] = self.content_encoding
+
+        status_code = status.HTTP_200_OK if ranges is None else status.HTTP_206_PARTIAL_CONTENT
+        ranges = ranges or [(0, self.file_size)]
+        return FileRangeResponse(self.filepath, ranges, self.file_size, status_code, headers, media_type, contents)
+
+
+# streams one or more ranges of a file; a single range is sent as is, many ranges as multipart/byteranges
+# if the server supports the ASGI zero-copy send extension, the open file descriptor is handed to the server
+# so the kernel copies the file to the socket (os.sendfile) without the contents ever passing through python;
+# otherwise the file is read in DOWNLOAD_CHUNK_SIZE_KB chunks. contents already in memory are sent as they are
+class FileRangeResponse(Response):
+    filepath: str
+    contents: bytes | None  # the contents of the file when they are cached
+    ranges: list[tuple[int, int]]
+    file_size: int
+    part_headers: list[bytes]  # the multipart header before every range; empty if there is only one range
+    closing_boundary: bytes
+    chunk_size: int
+
+    def __init__(
+        self,
+        filepath: str,
+        ranges: list[tuple[int, int]],
+        file_size: int,
+        status_code: int,
+        headers: dict[str, str],
+        media_type: str,
+        contents: bytes | None = None,
+    ) -> None:
+        self.filepath = filepath
+        self.contents = contents
+        self.ranges = ranges
+        self.file_size = file_size
+        self.status_code = status_code
+        self.background = None
+        self.part_headers = []
+        self.closing_boundary = b""
+        self.chunk_size = settings.DOWNLOAD_CHUNK_SIZE_KB * 1024
+
+        headers = {**headers, "accept-ranges": "bytes"}
+        content_length = sum(end - start for start, end in ranges)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            if status_code == status.HTTP_206_PARTIAL_CONTENT:
+                headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+            self.media_type = media_type
+        else:
+            boundary = os.urandom(16).hex()
+            for start, end in ranges:
+                part_header = f"--{boundary}\r\ncontent-type: {media_type}\r\ncontent-range: bytes {start}-{end - 1}/{file_size}\r\n\r\n"
+                self.part_headers.append(("\r\n" if self.part_headers else "").encode() + part_header.encode())
+
+            self.closing_boundary = f"\r\n--{boundary}--\r\n".encode()
+            content_length += sum(len(part_header) for part_header in self.part_headers) + len(self.closing_boundary)
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+
+        headers["content-length"] = str(content_length)
+        self.init_headers(headers)
+
+    # returns whether the ranges can be handed to the server as a file descriptor
+    def __can_zero_copy(self, scope: Scope) -> bool:
+        return settings.ZERO_COPY_DOWNLOADS and zero_copy_extension in scope.get("extensions", {})
+
+    # hands the ranges to the server; the server copies them from the file descriptor to the socket
+    async def __send_zero_copy(self, send: Send):
+        file = await ExecutorHandler.run_metadata(open, self.filepath, "rb")
+        try:
+            for i, (start, end) in enumerate(self.ranges):
+                if self.part_headers:
+                    await send({"type": "http.response.body", "body": self.part_headers[i], "more_body": True})
+
+                message = {"type": zero_copy_extension, "file": file, "offset": start, "count": end - start}
+                await send({**message, "more_body": True})
+        finally:
+            file.close()
+
+    # reads the ranges in chunks and sends every chunk as a body message; the reads run on the transfer pool
+    # for large files, and use positional reads so the file is never seeked
+    async def __send_chunked(self, send: Send):
+        file = await ExecutorHandler.run_metadata(open, self.filepath, "rb")
+        try:
+            for i, (start, end) in enumerate(self.ranges):
+                if self.part_headers:
+                    await send({"type": "http.response.body", "body": self.part_headers[i], "more_body": True})
+
+                position = start
+                while position < end:
+                    size = min(self.chunk_size, end - position)
+                    chunk = await ExecutorHandler.run_transfer(self.file_size, os.pread, file.fileno(), size, position)
+                    if not chunk:
+                        break
+                    position += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            file.close()
+
+    # sends the ranges of the contents kept in memory
+    async def __send_contents(self, send: Send):
+        contents = memoryview(self.contents)
+        for i, (start, end) in enumerate(self.ranges):
+            if self.part_headers:
+                await send({"type": "http.response.body", "body": self.part_headers[i], "more_body": True})
+
+            await send({"type": "http.response.body", "body": bytes(contents[start:end]), "more_body": True})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        if self.contents is not None:
+            await self.__send_contents(send)
+        elif self.__can_zero_copy(scope):
+            await self.__send_zero_copy(send)
+        else:
+            await self.__send_chunked(send)
+
+        await send({"type": "http.response.body", "body": self.closing_boundary, "more_body": False})
+
+
+# streams contents stored compressed to a client that does not take their encoding, decompressing them on the way;
+# every chunk is decompressed on the transfer pool. the whole contents are sent, the response has no ranges
+class DecompressedFileResponse(Response):
+    filepath: str
+    encoding: str
+    file_size: int  # size of the decompressed contents
+    contents: bytes | None  # the compressed contents when they are cached
+
+    def __init__(
+        self,
+        filepath: str,
+        encoding: str,
+        file_size: int,
+        headers: dict[str, str],
+        media_type: str,
+        contents: bytes | None = None,
+    ) -> None:
+        self.filepath = filepath
+        self.encoding = encoding
+        self.file_size = file_size
+        self.contents = contents
+        self.status_code = status.HTTP_200_OK
+        self.background = None
+        self.media_type = media_type
+        self.init_headers({**headers, "accept-ranges": "none", "content-length": str(file_size)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.contents is not None:
+            file = io.BytesIO(self.contents)
+        else:
+            file = await ExecutorHandler.run_metadata(open, self.filepath, "rb")
+
+        chunks = CompressionHandler.decompress(self.encoding, file)
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            while chunk := await ExecutorHandler.run_transfer(self.file_size, next, chunks, b""):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            chunks.close()
+            file.close()
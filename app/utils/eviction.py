@@ -0,0 +1,197 @@
+import os, time, heapq, threading
+
+from app.common import settings
+
+access_resolution_secs = 60  # an access is only recorded if the last recorded one is older than this
+
+
+# keeps the saved contents ordered by their last access (the upload or the last download), so the clean up can
+# remove the least recently used contents first without listing the upload folder. contents are removed when
+# nobody accessed them for FILE_TTL_MINS, or when the saved contents go over STORAGE_BUDGET_MB.
+# the order is a heap with lazy invalidation: an access pushes a new entry and the outdated one is skipped when popped.
+# the last access is also saved as the access time of the file, so it survives restarts and is seen by every worker
+class EvictionHandler:
+    lock: threading.Lock
+    last_accesses: dict[str, float]  # public key -> time of the last access
+    sizes: dict[str, int]  # public key -> size of the contents
+    heap: list[tuple[float, str]]  # (last access, public key); may hold outdated entries
+    stored_size: int  # size in bytes of all the saved contents
+    unsaved_accesses: set[str]  # public keys whose last access is not saved to the disk yet
+    evicted_count: int  # number of contents removed since the server started
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.last_accesses = {}
+        self.sizes = {}
+        self.heap = []
+        self.stored_size = 0
+        self.unsaved_accesses = set()
+        self.evicted_count = 0
+
+    # returns whether contents are evicted at all; if not, nothing is tracked
+    def is_enabled(self) -> bool:
+        return settings.STORAGE_BUDGET_MB > 0 or settings.FILE_TTL_MINS > 0
+
+    # returns the most size in bytes the saved contents can take; 0 if there is no budget
+    def get_budget_bytes(self) -> int:
+        return settings.STORAGE_BUDGET_MB * 1000 * 1000
+
+    # replaces everything tracked with the contents, public key -> (size, last access); used when the index is built
+    def reset(self, contents: dict[str, tuple[int, float]]):
+        with self.lock:
+            self.last_accesses = {}
+            self.sizes = {}
+            self.heap = []
+            self.stored_size = 0
+            self.unsaved_accesses = set()
+            if not self.is_enabled():
+                return
+
+            for public_key, (size, last_access) in contents.items():
+                self.last_accesses[public_key] = last_access
+                self.sizes[public_key] = size
+                self.stored_size += size
+            self.heap = [(last_access, public_key) for public_key, last_access in self.last_accesses.items()]
+            heapq.heapify(self.heap)
+
+    # pushes the entry of the last access; drops the outdated entries once they make up most of the heap.
+    # the lock must be held
+    def __push(self, public_key: str, last_access: float):
+        self.last_accesses[public_key] = last_access
+        heapq.heappush(self.heap, (last_access, public_key))
+        if len(self.heap) > 2 * len(self.last_accesses) + 1024:
+            self.heap = [(last_access, public_key) for public_key, last_access in self.last_accesses.items()]
+            heapq.heapify(self.heap)
+
+    # starts tracking newly saved contents; last_access defaults to now
+    def add(self, public_key: str, size: int, last_access: float | None = None):
+        if not self.is_enabled():
+            return
+
+        with self.lock:
+            if public_key in self.sizes:
+                return
+
+            self.sizes[public_key] = size
+            self.stored_size += size
+            self.__push(public_key, last_access if last_access is not None else time.time())
+
+    # tracks contents saved or accessed by another worker: starts tracking them if they are new, and records the
+    # access if it is later than the tracked one. size is None for an access, which is ignored for untracked contents.
+    # the lock must be held
+    def __track(self, public_key: str, size: int | None, last_access: float):
+        if public_key not in self.sizes:
+            if size is None:
+                return
+            self.sizes[public_key] = size
+            self.stored_size += size
+            self.__push(public_key, last_access)
+        elif last_access > self.last_accesses.get(public_key, 0):
+            self.__push(public_key, last_access)
+
+    # tracks contents saved or accessed by another worker, see __track
+    def track(self, public_key: str, size: int | None, last_access: float):
+        if not self.is_enabled():
+            return
+
+        with self.lock:
+            self.__track(public_key, size, last_access)
+
+    # tracks exactly the contents, public key -> (size, last access), saved by every worker; unlike reset(),
+    # the accesses recorded here that are later, or not saved yet, are kept
+    def sync(self, contents: dict[str, tuple[int, float]]):
+        if not self.is_enabled():
+            return
+
+        with self.lock:
+            for public_key in [public_key for public_key in self.sizes if public_key not in contents]:
+                self.stored_size -= self.sizes.pop(public_key)
+                self.last_accesses.pop(public_key, None)
+                self.unsaved_accesses.discard(public_key)
+            for public_key, (size, last_access) in contents.items():
+                self.__track(public_key, size, last_access)
+
+    # records an access of the contents; accesses closer than access_resolution_secs are not recorded again
+    # it never touches the disk; the access is saved by save_accesses()
+    def touch(self, public_key: str, accessed_at: float | None = None):
+        if not self.is_enabled():
+            return
+
+        accessed_at = accessed_at if accessed_at is not None else time.time()
+        with self.lock:
+            last_access = self.last_accesses.get(public_key)
+            if last_access is None or accessed_at - last_access < access_resolution_secs:
+                return
+
+            self.__push(public_key, accessed_at)
+            self.unsaved_accesses.add(public_key)
+
+    # stops tracking contents that were removed
+    def remove(self, public_key: str):
+        with self.lock:
+            size = self.sizes.pop(public_key, None)
+            if size is not None:
+                self.stored_size -= size
+            self.last_accesses.pop(public_key, None)
+            self.unsaved_accesses.discard(public_key)
+
+    # saves the recorded accesses as the access time of the files, at most max_count of them, and returns them;
+    # get_blob_path returns the path to the contents of a public key
+    def save_accesses(self, get_blob_path, max_count: int) -> dict[str, float]:
+        with self.lock:
+            public_keys = [self.unsaved_accesses.pop() for _ in range(min(max_count, len(self.unsaved_accesses)))]
+            last_accesses = [self.last_accesses.get(public_key) for public_key in public_keys]
+
+        saved_accesses = {}
+        for public_key, last_access in zip(public_keys, last_accesses):
+            if last_access is None:
+                continue
+            try:
+                blob_path = get_blob_path(public_key)
+                os.utime(blob_path, (last_access, os.stat(blob_path).st_mtime))
+                saved_accesses[public_key] = last_access
+            except OSError:
+                pass  # removed in the meantime
+
+        return saved_accesses
+
+    # pops the next contents to evict and returns their public key and last access; None if nothing must go yet.
+    # outdated entries are skipped; at most max_pops entries are looked at, so a call is always cheap
+    def pop_candidate(self, max_pops: int) -> tuple[str, float] | None:
+        ttl_secs = settings.FILE_TTL_MINS * 60
+        budget_bytes = self.get_budget_bytes()
+        now = time.time()
+        with self.lock:
+            for _ in range(max_pops):
+                if not self.heap:
+                    return None
+
+                last_access, public_key = self.heap[0]
+                if self.last_accesses.get(public_key) != last_access:
+                    heapq.heappop(self.heap)  # outdated entry
+                    continue
+
+                is_expired = ttl_secs > 0 and now - last_access >= ttl_secs
+                is_over_budget = budget_bytes > 0 and self.stored_size > budget_bytes
+                if not is_expired and not is_over_budget:
+                    return None
+
+                heapq.heappop(self.heap)
+                return public_key, last_access
+
+        return None
+
+    # puts back contents that turned out to be accessed later than tracked; ex: by another worker
+    def update(self, public_key: str, last_access: float):
+        with self.lock:
+            if public_key in self.sizes:
+                self.__push(public_key, last_access)
+
+    # returns the size in bytes of all the tracked contents
+    def get_stored_size(self) -> int:
+        with self.lock:
+            return self.stored_size
+
+
+# the eviction handler shared by the whole process
+eviction_handler = EvictionHandler()
@@ -0,0 +1,44 @@
+import asyncio, functools, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from app.common import settings
+
+# the blocking work of the file routes runs on these pools instead of starlette's shared default thread pool,
+# so a burst of large uploads or downloads can only ever occupy the transfer pool, while cheap lookups and
+# small files keep being served by the metadata pool; every pool is sized through the settings
+metadata_executor = ThreadPoolExecutor(max_workers=settings.METADATA_POOL_SIZE, thread_name_prefix="metadata")
+transfer_executor = ThreadPoolExecutor(max_workers=settings.TRANSFER_POOL_SIZE, thread_name_prefix="transfer")
+hash_executor = ThreadPoolExecutor(max_workers=settings.HASH_POOL_SIZE, thread_name_prefix="hash")
+
+
+# runs blocking functions on the dedicated pools from async code
+class ExecutorHandler:
+    # returns whether a transfer of the given size is large; unknown sizes are treated as large
+    @staticmethod
+    def is_large_transfer(size: int | None) -> bool:
+        return size is None or size > settings.LARGE_TRANSFER_MB * 1000 * 1000
+
+    # runs the function on the given pool and waits for its result without blocking the event loop;
+    # it runs in a copy of the caller's context, so what it times is added to the timings of the request
+    @staticmethod
+    async def run(executor: ThreadPoolExecutor, func: Callable, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, context.run, functools.partial(func, *args))
+
+    # runs cheap file system work; index lookups, stats, metadata and deletions
+    @staticmethod
+    async def run_metadata(func: Callable, *args) -> Any:
+        return await ExecutorHandler.run(metadata_executor, func, *args)
+
+    # runs disk reads and writes of a transfer; large transfers get their own pool so they cannot starve small ones
+    @staticmethod
+    async def run_transfer(size: int | None, func: Callable, *args) -> Any:
+        executor = transfer_executor if ExecutorHandler.is_large_transfer(size) else metadata_executor
+        return await ExecutorHandler.run(executor, func, *args)
+
+    # runs hashing of uploaded contents
+    @staticmethod
+    async def run_hashing(func: Callable, *args) -> Any:
+        return await ExecutorHandler.run(hash_executor, func, *args)
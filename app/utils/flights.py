@@ -0,0 +1,46 @@
+import threading
+
+
+# lets the callers working on the same key take turns, so when several of them arrive at the same time only the
+# first does the work, and the others wait for it and then find the work done. used by the uploads: the first
+# upload of some contents writes them, the uploads of the same contents that arrive meanwhile wait for it and
+# only add their filename. callers that arrive once the work is done do not wait at all.
+# it only coalesces the callers of this process; with several workers, the index still keeps a single copy of
+# the contents (see SavedFilesIndex.add_blob), the work is just done more than once
+class FlightHandler:
+    lock: threading.Lock
+    flights: dict[str, threading.Event]  # key -> set once the caller working on it is done
+    wait_count: int  # number of callers that had to wait for another one
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.wait_count = 0
+
+    # waits until no other caller works on the key, then works on it; release() must be called once done,
+    # whether the work succeeded or not. if it did not, the next caller waiting does it
+    def acquire(self, key: str):
+        has_waited = False
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                if flight is None:
+                    self.flights[key] = threading.Event()
+                    return
+                if not has_waited:
+                    self.wait_count += 1
+                    has_waited = True
+
+            flight.wait()
+
+    # lets the callers waiting for the key go
+    def release(self, key: str):
+        with self.lock:
+            flight = self.flights.pop(key, None)
+
+        if flight is not None:
+            flight.set()
+
+
+# uploads that resolve to the same public key
+upload_flights = FlightHandler()
@@ -0,0 +1,68 @@
+import hashlib, threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from app.common import settings
+from app.utils.executors import hash_executor
+
+hash_chunk_size = 1024 * 1024  # size of the reads done while hashing a file on the disk
+hash_process_pool: ProcessPoolExecutor | None = None  # created on first use or at startup when HASH_ENGINE is process
+hash_process_pool_lock = threading.Lock()
+
+
+# hashes the files one after the other as if they were a single file and returns the public key;
+# it is the same sha256 the crypto handler uses, so the keys of every engine are identical.
+# it is a plain function of the module so the worker processes can run it
+def calculate_files_public_key(filepaths: list[str]) -> str:
+    hash = hashlib.sha256()
+    for filepath in filepaths:
+        with open(filepath, "rb") as f:
+            while chunk := f.read(hash_chunk_size):
+                hash.update(chunk)
+
+    return hash.hexdigest()
+
+
+# hashes files that are already on the disk with the engine picked by HASH_ENGINE:
+# thread hashes on the hash pool of this process (hashlib releases the GIL, so uploads are hashed in parallel),
+# process hashes files of at least HASH_PROCESS_MIN_MB in worker processes, so the cores doing the hashing
+# are never the ones serving requests. sha256 cannot be split, so a single file is still hashed on a single core;
+# what is gained is that hashing runs next to the disk and network work instead of in front of it
+class HashingHandler:
+    # returns whether contents of the size are hashed in a worker process
+    @staticmethod
+    def is_offloaded(size: int) -> bool:
+        return settings.HASH_ENGINE == "process" and size >= settings.HASH_PROCESS_MIN_MB * 1000 * 1000
+
+    # returns the process pool, creating it the first time
+    @staticmethod
+    def __get_process_pool() -> ProcessPoolExecutor:
+        global hash_process_pool
+        with hash_process_pool_lock:
+            if hash_process_pool is None:
+                hash_process_pool = ProcessPoolExecutor(max_workers=settings.HASH_PROCESS_COUNT or None)
+
+            return hash_process_pool
+
+    # starts the worker processes ahead of the first upload; called at startup
+    @staticmethod
+    def start():
+        if settings.HASH_ENGINE == "process":
+            HashingHandler.__get_process_pool().submit(calculate_files_public_key, []).result()
+
+    # stops the worker processes; called at shutdown
+    @staticmethod
+    def shutdown():
+        global hash_process_pool
+        with hash_process_pool_lock:
+            if hash_process_pool is not None:
+                hash_process_pool.shutdown()
+                hash_process_pool = None
+
+    # starts hashing the files, size bytes in total, and returns a future of the public key;
+    # the caller can keep working on the files, for example copying them, while they are hashed
+    @staticmethod
+    def submit(filepaths: list[str], size: int) -> Future:
+        if HashingHandler.is_offloaded(size):
+            return HashingHandler.__get_process_pool().submit(calculate_files_public_key, filepaths)
+
+        return hash_executor.submit(calculate_files_public_key, filepaths)
@@ -0,0 +1,167 @@
+import datetime, threading
+
+from app.common import database, settings
+from app.utils.workers import WorkersHandler
+from app.utils.executors import metadata_executor
+
+
+# keeps the used size of every host for the current day in memory so checking and reserving a quota
+# never touches the disk on the request path; the changes are written to the database by flush(),
+# which runs every QUOTA_FLUSH_INTERVAL_SECS and at shutdown. once QUOTA_MAX_UNFLUSHED_MB are unflushed, a flush is
+# started on the metadata pool, so a crash loses about that much accounting (or the last interval's worth, whichever
+# is smaller); the reservation that triggered it does not wait for it, reserving never touches the database.
+# with several worker processes, every reservation is written to the database right away instead,
+# since the counters of one worker do not see what the others reserved
+class QuotaHandler:
+    lock: threading.Lock
+    flush_lock: threading.Lock  # flushes run one at a time, so none refreshes the counters while another writes
+    current_date: str  # the date the counters are kept for
+    used_sizes: dict[str, int]  # host -> size used today, including the changes that are not flushed yet
+    unflushed_sizes: dict[str, int]  # host -> size reserved since the last flush
+    unflushed_total: int  # sum of unflushed_sizes
+    is_flush_started: bool  # whether a flush started by reserve() is running on the metadata pool
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.current_date = ""
+        self.used_sizes = {}
+        self.unflushed_sizes = {}
+        self.unflushed_total = 0
+        self.is_flush_started = False
+
+    # return the daily limit of a host in bytes
+    def get_daily_limit_bytes(self) -> int:
+        daily_limit_mb = settings.DAILY_LIMIT_MB
+        return daily_limit_mb * 1000 * 1000
+
+    # return the maximum size that can be reserved before a flush is forced
+    def __get_max_unflushed_bytes(self) -> int:
+        return settings.QUOTA_MAX_UNFLUSHED_MB * 1000 * 1000
+
+    # if the day changed, drop the counters of the previous day; the limits are reset every day
+    def __clear_hosts_if_outdated(self):
+        current_date = str(datetime.datetime.now().date())
+        if self.current_date != current_date:
+            self.current_date = current_date
+            self.used_sizes = {}
+            self.unflushed_sizes = {}
+            self.unflushed_total = 0
+
+    # make sure the host's used size is in memory; it is read from the database once per host per day
+    def __load_host(self, host: str):
+        with self.lock:
+            self.__clear_hosts_if_outdated()
+            if host in self.used_sizes:
+                return
+
+        used_size = database.get_host_used_size(host)
+        with self.lock:
+            self.used_sizes.setdefault(host, used_size)
+
+    # returns whether reservations are written to the database right away; they are when several workers share it
+    def is_write_through(self) -> bool:
+        return WorkersHandler.is_shared()
+
+    # return how much size the host has remaining for the current day
+    def get_remaining_size(self, host: str) -> int:
+        if self.is_write_through():
+            return self.get_daily_limit_bytes() - database.get_host_used_size(host)
+
+        self.__load_host(host)
+        with self.lock:
+            return self.get_daily_limit_bytes() - self.used_sizes.get(host, 0)
+
+    # atomically check that the size fits in the host's remaining daily size and add it to the host's used size;
+    # return whether the size was reserved and how much size the host had remaining before
+    def reserve(self, host: str, size: int) -> tuple[bool, int]:
+        if self.is_write_through():
+            limit = self.get_daily_limit_bytes()
+            is_reserved, used_size = database.reserve_host_used_size(host, size, limit)
+            return is_reserved, limit - used_size
+
+        self.__load_host(host)
+        with self.lock:
+            self.__clear_hosts_if_outdated()
+            used_size = self.used_sizes.get(host, 0)
+            remaining_size = self.get_daily_limit_bytes() - used_size
+            is_reserved = size <= remaining_size
+            if is_reserved:
+                self.used_sizes[host] = used_size + size
+                self.unflushed_sizes[host] = self.unflushed_sizes.get(host, 0) + size
+                self.unflushed_total += size
+
+            must_flush = self.unflushed_total >= self.__get_max_unflushed_bytes() and not self.is_flush_started
+            if must_flush:
+                self.is_flush_started = True
+
+        if must_flush:
+            metadata_executor.submit(self.__flush_started)
+
+        return is_reserved, remaining_size
+
+    # the flush started by reserve(); if it fails, the sizes are kept and written by the next periodic flush
+    def __flush_started(self):
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                self.is_flush_started = False
+
+    # give back part of a reservation that was not used, e.g. the rest of a block reserved for an upload that ended
+    # before filling it; nothing is given back if the day changed since, the counters started again from zero
+    def release(self, host: str, size: int):
+        if size <= 0:
+            return
+
+        if self.is_write_through():
+            if database.get_host_used_size(host) >= size:
+                database.increment_host_used_size(host, -size)
+            return
+
+        with self.lock:
+            self.__clear_hosts_if_outdated()
+            if host not in self.used_sizes:
+                return
+
+            self.used_sizes[host] = max(0, self.used_sizes[host] - size)
+            self.unflushed_sizes[host] = self.unflushed_sizes.get(host, 0) - size
+            self.unflushed_total -= size
+
+    # write the unflushed sizes to the database in a single transaction, then refresh the counters
+    # with the totals from the database so changes made by other processes are picked up
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.__clear_hosts_if_outdated()
+                unflushed_sizes = self.unflushed_sizes
+                self.unflushed_sizes = {}
+                self.unflushed_total = 0
+
+            try:
+                if unflushed_sizes:
+                    database.increment_hosts_used_size(unflushed_sizes)
+            except:
+                # put the sizes back so they are written by the next flush
+                with self.lock:
+                    for host, size in unflushed_sizes.items():
+                        self.unflushed_sizes[host] = self.unflushed_sizes.get(host, 0) + size
+                        self.unflushed_total += size
+                raise
+
+            hosts: dict = database.get_db()["hosts_info"]["hosts"]
+            with self.lock:
+                for host in self.used_sizes.keys():
+                    stored_used_size = hosts.get(host, {}).get("used_size", 0)
+                    self.used_sizes[host] = stored_used_size + self.unflushed_sizes.get(host, 0)
+
+    # drop every counter and reset the database
+    def reset(self):
+        with self.lock:
+            self.current_date = ""
+            self.__clear_hosts_if_outdated()
+            database.reset_database()
+
+
+# the quota handler shared by the whole process
+quota_handler = QuotaHandler()
@@ -0,0 +1,209 @@
+import os, json, time, shutil, secrets
+from typing import AsyncIterator
+
+from app.common import settings
+from app.common.metrics import hash_duration, disk_write_duration
+from app.utils.executors import ExecutorHandler
+from app.utils.hashing import HashingHandler
+from app.utils.compression import CompressionHandler
+from app.utils.utils import BlobStorage, CryptoHandler, saved_files_index, savepath, upload_chunk_size
+
+sessions_path = os.path.join(savepath, ".sessions")  # where the chunks of unfinished uploads are kept
+completing_suffix = ".completing"  # a session folder is renamed with this suffix while it is being completed
+
+# if the sessions folder does not exist, this will automatically create it
+os.makedirs(sessions_path, exist_ok=True)
+
+
+# raised when an upload session does not exist or was already completed
+class UploadSessionNotFoundError(Exception):
+    pass
+
+
+# raised when a chunk or a request does not match the upload session
+class UploadSessionInvalidError(Exception):
+    pass
+
+
+# the information about an upload session, saved as session.json inside the session folder
+class UploadSession:
+    upload_id: str
+    filename: str
+    size: int  # size of the whole file in bytes
+    chunk_size: int  # size of every chunk in bytes, except the last one which may be smaller
+    created: float
+
+    def __init__(self, upload_id: str, filename: str, size: int, chunk_size: int, created: float) -> None:
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.created = created
+
+    # the number of chunks the file is split in; an empty file is a single empty chunk
+    def get_chunk_count(self) -> int:
+        return max((self.size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    # the size in bytes the chunk with the index must have
+    def get_chunk_size(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+# handles resumable uploads: the client creates a session, uploads numbered chunks in any order and in parallel,
+# asks which chunks were received, and completes the session once every chunk is there.
+# every session is a folder with the session information and one file per received chunk;
+# sessions that receive nothing for UPLOAD_SESSION_EXPIRY_MINS are removed by the clean up task
+class UploadSessionHandler:
+    crypto_handler: CryptoHandler
+
+    def __init__(self) -> None:
+        self.crypto_handler = CryptoHandler()
+
+    # returns the path to the folder of the session; upload ids are validated so they cannot point anywhere else
+    def __get_session_path(self, upload_id: str) -> str:
+        if len(upload_id) != 32 or not all(c in "0123456789abcdef" for c in upload_id):
+            raise UploadSessionNotFoundError()
+
+        return os.path.join(sessions_path, upload_id)
+
+    # creates a new session for a file of the given size and returns it; the size and the number of chunks are
+    # limited, since creating a session costs nothing from the daily limit
+    def create_session(self, filename: str, size: int, chunk_size: int | None = None) -> UploadSession:
+        max_size = settings.UPLOAD_SESSION_MAX_SIZE_MB * 1000 * 1000
+        max_chunk_size = settings.UPLOAD_SESSION_MAX_CHUNK_SIZE_MB * 1000 * 1000
+        chunk_size = chunk_size or settings.UPLOAD_SESSION_CHUNK_SIZE_MB * 1000 * 1000
+        if not filename or size < 0 or size > max_size or chunk_size <= 0 or chunk_size > max_chunk_size:
+            raise UploadSessionInvalidError()
+
+        session = UploadSession(secrets.token_hex(16), filename, size, chunk_size, time.time())
+        if session.get_chunk_count() > settings.UPLOAD_SESSION_MAX_CHUNKS:
+            raise UploadSessionInvalidError()
+
+        session_path = self.__get_session_path(session.upload_id)
+        os.makedirs(session_path)
+        with open(os.path.join(session_path, "session.json"), "w") as f:
+            f.write(json.dumps(vars(session)))
+
+        return session
+
+    # returns the session with the upload id
+    def get_session(self, upload_id: str) -> UploadSession:
+        try:
+            with open(os.path.join(self.__get_session_path(upload_id), "session.json"), "r") as f:
+                return UploadSession(**json.loads(f.read()))
+        except OSError:
+            raise UploadSessionNotFoundError()
+
+    # returns the indexes of the chunks that were received, sorted
+    def get_received_chunks(self, upload_id: str) -> list[int]:
+        try:
+            names = os.listdir(self.__get_session_path(upload_id))
+        except OSError:
+            raise UploadSessionNotFoundError()
+
+        return sorted(int(name) for name in names if name.isdigit())
+
+    # removes the temporary file of a chunk that failed; returns whether the session still exists
+    def __remove_temp_chunk(self, temp_chunk_path: str, session_path: str) -> bool:
+        if os.path.exists(temp_chunk_path):
+            os.remove(temp_chunk_path)
+
+        return os.path.exists(session_path)
+
+    # writes the chunk with the index from the stream; the chunk is written to a temporary file first,
+    # so a chunk that is sent again or that fails half way never replaces a complete one with a partial one.
+    # it runs on the event loop, so every file system call goes to the pools
+    async def write_chunk(self, upload_id: str, index: int, stream: AsyncIterator[bytes]):
+        session = await ExecutorHandler.run_metadata(self.get_session, upload_id)
+        if index < 0 or index >= session.get_chunk_count():
+            raise UploadSessionInvalidError()
+
+        session_path = self.__get_session_path(upload_id)
+        chunk_path = os.path.join(session_path, str(index))
+        temp_chunk_path = os.path.join(session_path, f".{index}-{secrets.token_hex(8)}")
+        chunk_size = session.get_chunk_size(index)
+        received_size = 0
+        try:
+            f = await ExecutorHandler.run_transfer(chunk_size, open, temp_chunk_path, "wb")
+            try:
+                async for data in stream:
+                    received_size += len(data)
+                    if received_size > chunk_size:
+                        raise UploadSessionInvalidError()
+                    await ExecutorHandler.run_transfer(chunk_size, f.write, data)
+            finally:
+                await ExecutorHandler.run_transfer(chunk_size, f.close)
+
+            if received_size != chunk_size:
+                raise UploadSessionInvalidError()
+
+            await ExecutorHandler.run_metadata(os.replace, temp_chunk_path, chunk_path)
+        except BaseException as e:
+            # the body may also stop half way, when the client disconnects or goes over its daily limit
+            is_session_found = await ExecutorHandler.run_metadata(
+                self.__remove_temp_chunk, temp_chunk_path, session_path
+            )
+            if isinstance(e, (OSError, UploadSessionInvalidError)) and not is_session_found:
+                raise UploadSessionNotFoundError()
+            raise
+
+    # joins the chunks in order into a new saved file and removes the session; returns the public and private keys
+    # the chunks are hashed in order by the hashing handler while they are copied, so the public key is the same
+    # as for a regular upload and the hashing and the copy run at the same time
+    def complete_session(self, upload_id: str) -> tuple[str, str]:
+        session = self.get_session(upload_id)
+        received_chunks = self.get_received_chunks(upload_id)
+        if received_chunks != list(range(session.get_chunk_count())):
+            raise UploadSessionInvalidError()
+
+        # renaming the folder makes sure only one request completes the session, even across processes
+        session_path = self.__get_session_path(upload_id)
+        completing_path = session_path + completing_suffix
+        try:
+            os.rename(session_path, completing_path)
+        except OSError:
+            raise UploadSessionNotFoundError()
+
+        chunk_paths = [os.path.join(completing_path, str(index)) for index in received_chunks]
+        fd, temp_filepath = BlobStorage.create_temp_file()
+        try:
+            hashing = HashingHandler.submit(chunk_paths, session.size)
+            with disk_write_duration.time(), open(fd, "wb") as f:
+                for chunk_path in chunk_paths:
+                    with open(chunk_path, "rb") as chunk_file:
+                        shutil.copyfileobj(chunk_file, f, upload_chunk_size)
+
+            with hash_duration.time():  # only the part of the hashing the copy did not hide
+                public_key = hashing.result()
+            encoding = CompressionHandler.compress_file(temp_filepath, session.filename)
+        except:
+            os.remove(temp_filepath)
+            os.rename(completing_path, session_path)  # give the client a chance to try again
+            raise
+
+        saved_files_index.add_blob(public_key, session.filename, session.size, temp_filepath, encoding)
+        shutil.rmtree(completing_path)
+
+        private_key = self.crypto_handler.calculate_private_key(public_key)
+        return public_key, private_key
+
+    # removes the session and every chunk received for it
+    def remove_session(self, upload_id: str):
+        session_path = self.__get_session_path(upload_id)
+        if not os.path.exists(session_path):
+            raise UploadSessionNotFoundError()
+
+        shutil.rmtree(session_path, ignore_errors=True)
+
+    # removes the sessions that did not receive anything for UPLOAD_SESSION_EXPIRY_MINS;
+    # the folder of a session is modified every time a chunk is received.
+    # the temporary files of uploads and completions that were abandoned, e.g. by a worker that was killed,
+    # are removed once they were not written to for as long
+    def clean_up_expired_sessions(self):
+        expiry_time = time.time() - settings.UPLOAD_SESSION_EXPIRY_MINS * 60
+        with os.scandir(sessions_path) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.stat().st_mtime < expiry_time:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+
+        BlobStorage.remove_temp_files(expiry_time)
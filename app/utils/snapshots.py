@@ -0,0 +1,215 @@
+import os, json, zlib, struct, marshal, threading
+
+from app.common import settings
+
+snapshot_folder_path = os.path.join(settings.FOLDER, ".index")  # where the snapshot and journal of the index are kept
+snapshot_path = os.path.join(snapshot_folder_path, "snapshot")
+journal_path = os.path.join(snapshot_folder_path, "journal")
+snapshot_magic = b"FSSIDX04"  # identifies the format of the snapshot; changes whenever the format does
+snapshot_header = struct.Struct("<8sQQI")  # magic, record count, payload size, payload crc32
+
+# if the snapshot folder does not exist, this will automatically create it
+os.makedirs(snapshot_folder_path, exist_ok=True)
+
+# what the snapshot keeps of a saved content: public key -> (filenames, size, last access, encoding, key hash);
+# the key hash is the sha256 of the private key, see BlobStorage.get_key_hash
+SnapshotRecords = dict[str, tuple[list[str], int, float, str, bytes]]
+
+
+# persists the index of the saved files, so starting the server does not have to scan the upload folder.
+# the snapshot is the whole index in a single file, kept as columns (keys, filenames, sizes, ...) with
+# marshal and checked with a crc32; every change made since is appended to the journal as a line of JSON,
+# the full state of the record, its removal or its last access, so replaying a line twice does no harm.
+# the private keys are never persisted, they are what deletes the files; only a hash of them is, which leads a private
+# key to its public key the same way the key files do, so loading the snapshot calculates no private key.
+# the journal is folded into a new snapshot once it grows over INDEX_JOURNAL_MAX_MB.
+# every write happens under the index file lock, so the worker processes share a single snapshot and journal;
+# the journal is also how a worker follows the changes the others make, see SavedFilesIndex.sync_journal
+class SnapshotHandler:
+    lock: threading.Lock
+    journal_fd: int | None  # the journal, opened for appending on first use
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.journal_fd = None
+
+    # returns whether the index is persisted at all
+    def is_enabled(self) -> bool:
+        return settings.INDEX_SNAPSHOT
+
+    # reads the snapshot; returns None if it is missing or does not pass the checks
+    def __read_snapshot(self) -> SnapshotRecords | None:
+        try:
+            with open(snapshot_path, "rb") as f:
+                header = f.read(snapshot_header.size)
+                if len(header) != snapshot_header.size:
+                    return None
+                magic, count, payload_size, checksum = snapshot_header.unpack(header)
+                if magic != snapshot_magic:
+                    return None
+                payload = f.read(payload_size + 1)
+        except FileNotFoundError:
+            return None
+
+        if len(payload) != payload_size or zlib.crc32(payload) != checksum:
+            return None
+
+        try:
+            public_keys_bytes, filenames, sizes, last_accesses, encodings, key_hashes_bytes = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+            return None
+
+        if not len(public_keys_bytes) == len(key_hashes_bytes) == 32 * count == 32 * len(filenames):
+            return None
+        if not len(filenames) == len(sizes) == len(last_accesses) == len(encodings):
+            return None
+
+        public_keys_hex = public_keys_bytes.hex()
+        public_keys = [public_keys_hex[i : i + 64] for i in range(0, len(public_keys_hex), 64)]
+        key_hashes = [key_hashes_bytes[i : i + 32] for i in range(0, len(key_hashes_bytes), 32)]
+        return dict(zip(public_keys, zip(filenames, sizes, last_accesses, encodings, key_hashes)))
+
+    # applies the changes of the journal to the records; lines that are cut short, ex: by a crash in the middle
+    # of a write, are skipped
+    def __replay_journal(self, records: SnapshotRecords):
+        try:
+            with open(journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry[0] == "put":
+                            _, public_key, filenames, size, last_access, encoding, key_hash = entry
+                            records[public_key] = (filenames, size, last_access, encoding, bytes.fromhex(key_hash))
+                        elif entry[0] == "remove":
+                            records.pop(entry[1], None)
+                        elif entry[0] == "access" and entry[1] in records:
+                            filenames, size, _, encoding, key_hash = records[entry[1]]
+                            records[entry[1]] = (filenames, size, entry[2], encoding, key_hash)
+                    except (ValueError, IndexError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+
+    # returns the persisted index, the snapshot with the journal replayed on top of it;
+    # None if there is no snapshot or it does not pass the checks, the upload folder must be scanned then
+    def load(self) -> SnapshotRecords | None:
+        if not self.is_enabled():
+            return None
+
+        records = self.__read_snapshot()
+        if records is not None:
+            self.__replay_journal(records)
+
+        return records
+
+    # writes the records as the new snapshot and empties the journal, whose changes the records include;
+    # the snapshot is written to a temporary file and renamed, so a crash never leaves it half written
+    def save(self, records: SnapshotRecords):
+        if not self.is_enabled():
+            return
+
+        filenames, sizes, last_accesses, encodings, key_hashes = [], [], [], [], []
+        for record_filenames, size, last_access, encoding, key_hash in records.values():
+            filenames.append(record_filenames)
+            sizes.append(size)
+            last_accesses.append(last_access)
+            encodings.append(encoding)
+            key_hashes.append(key_hash)
+        public_keys_bytes = bytes.fromhex("".join(records.keys()))
+        payload = marshal.dumps((public_keys_bytes, filenames, sizes, last_accesses, encodings, b"".join(key_hashes)))
+        header = snapshot_header.pack(snapshot_magic, len(records), len(payload), zlib.crc32(payload))
+
+        temp_path = snapshot_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, snapshot_path)
+
+        with self.lock:
+            with open(journal_path, "w"):
+                pass  # the changes are part of the snapshot now
+
+    # removes the snapshot and the journal, so the next start scans the upload folder
+    def remove(self):
+        with self.lock:
+            if self.journal_fd is not None:
+                os.close(self.journal_fd)
+                self.journal_fd = None
+            for path in (snapshot_path, journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # appends a line to the journal with a single write, so lines of different processes never mix
+    def __append(self, entry: list):
+        if not self.is_enabled():
+            return
+
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+        with self.lock:
+            if self.journal_fd is None:
+                self.journal_fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self.journal_fd, line)
+
+    # records the current state of the record of the public key
+    def append_put(
+        self, public_key: str, filenames: list[str], size: int, last_access: float, encoding: str, key_hash: bytes
+    ):
+        self.__append(["put", public_key, filenames, size, last_access, encoding, key_hash.hex()])
+
+    # records that the contents of the public key were removed
+    def append_remove(self, public_key: str):
+        self.__append(["remove", public_key])
+
+    # records the last access of the contents of the public key; ignored if they were removed since
+    def append_access(self, public_key: str, last_access: float):
+        self.__append(["access", public_key, last_access])
+
+    # returns what identifies the current snapshot; it changes every time a snapshot is saved, which empties the
+    # journal. None if there is no snapshot
+    def get_snapshot_id(self) -> tuple[int, int] | None:
+        try:
+            snapshot_stat = os.stat(snapshot_path)
+        except FileNotFoundError:
+            return None
+
+        return snapshot_stat.st_ino, snapshot_stat.st_mtime_ns
+
+    # returns the size of the journal in bytes
+    def get_journal_size(self) -> int:
+        try:
+            return os.path.getsize(journal_path)
+        except FileNotFoundError:
+            return 0
+
+    # reads the entries of the journal from the offset, at most max_size bytes of them, and returns them along with
+    # the offset to read from next; a line that is not complete yet, ex: being written, is left for the next read
+    def read_journal(self, offset: int, max_size: int) -> tuple[list[list], int]:
+        try:
+            with open(journal_path, "rb") as f:
+                f.seek(offset)
+                data = f.read(max_size)
+        except FileNotFoundError:
+            return [], offset
+
+        data = data[: data.rfind(b"\n") + 1]
+        entries = []
+        for line in data.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+
+        return entries, offset + len(data)
+
+    # returns whether the journal grew large enough to be folded into a new snapshot
+    def is_journal_full(self) -> bool:
+        try:
+            return os.path.getsize(journal_path) >= settings.INDEX_JOURNAL_MAX_MB * 1000 * 1000
+        except FileNotFoundError:
+            return False
+
+
+# the snapshot handler shared by the whole process
+snapshot_handler = SnapshotHandler()
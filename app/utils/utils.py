@@ -1,14 +1,43 @@
-import os, hashlib, hmac, time, pathlib
+import os, gc, json, shutil, hashlib, hmac, time, random, pathlib, tempfile, threading, contextlib
+from typing import AsyncIterator, BinaryIO
 
 from fastapi import UploadFile
-from app.common import settings
+from app.common import settings, database
+from app.common.metrics import index_lookup_duration, hash_duration, disk_write_duration
+from app.utils.executors import ExecutorHandler
+from app.utils.hashing import HashingHandler
+from app.utils.cache import CachedFile, file_cache
+from app.utils.workers import WorkersHandler, index_lock
+from app.utils.eviction import eviction_handler
+from app.utils.snapshots import SnapshotRecords, snapshot_handler
+from app.utils.flights import upload_flights
+from app.utils.compression import CompressionHandler, probe_size
 
 secret_key = settings.SECRET_KEY
 savepath = str(settings.FOLDER)
+upload_chunk_size = settings.UPLOAD_CHUNK_SIZE_KB * 1024  # uploads are read, hashed and written in chunks of this size
+temp_file_prefix = ".upload-"  # prefix of the temporary files used while an upload is still being received
+metadata_suffix = ".json"  # suffix of the files that keep the metadata of the saved contents
+key_suffix = ".key"  # suffix of the files that lead from a private key to its public key, see BlobStorage.write_key
+snapshot_sample_size = 32  # number of files checked against the snapshot of the index before it is trusted
+journal_sync_max_size = 1024 * 1024  # most bytes of the journal read by a single SavedFilesIndex.sync_journal() call
 
 # if the specified folder does not exist, this will automatically create it
 os.makedirs(savepath, exist_ok=True)
 
+# pauses the cyclic garbage collector; building the index creates an object or more per saved file, all of them kept,
+# and the collections they would set off only walk over them again
+@contextlib.contextmanager
+def paused_gc():
+    is_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if is_enabled:
+            gc.enable()
+
+
 # handles the calculation of the public and private keys
 class CryptoHandler:
     # use the contents of the file as bytes to calculate a public key;
@@ -18,6 +47,11 @@ class CryptoHandler:
         public_key = hash.hexdigest()
         return public_key
 
+    # returns an incremental hash object; feeding it the file chunk by chunk produces the same public key
+    # as calculate_public_key does with the whole contents
+    def create_public_key_hash(self):
+        return hashlib.sha256()
+
     # use a message, in this case a public key, to calculate a private key
     # it will also use the SECRET_KEY environment variable to encrypt the public key
     def calculate_private_key(self, message: str) -> str:
@@ -30,47 +64,949 @@ class CryptoHandler:
         return private_key
 
 
+# the metadata of saved contents; the contents are stored once under their public key (the hash of the contents)
+# and every name they were uploaded with is a reference to them. the contents are removed with the last reference
+class SavedFileRecord:
+    public_key: str
+    filenames: list[str]  # the original filenames; the first one is used for downloads
+    size: int  # size of the original contents, whatever they are stored with
+    last_access: float  # access time of the contents when they were scanned; not part of the metadata file
+    encoding: str  # gzip or zstd if the contents are stored compressed (see CompressionHandler); empty otherwise
+
+    def __init__(
+        self, public_key: str, filenames: list[str], size: int, last_access: float = 0.0, encoding: str = ""
+    ) -> None:
+        self.public_key = public_key
+        self.filenames = filenames
+        self.size = size
+        self.last_access = last_access
+        self.encoding = encoding
+
+
+# handles how the saved contents are laid out inside the folder specified in the FOLDER environment variable;
+# every saved content is a file named after its public key plus a small metadata file next to it.
+# the files are spread over two levels of sub folders named after the first characters of the public key
+# (ab/cd/abcd...), so no folder ever holds more than a small share of the files
+class BlobStorage:
+    # returns whether the name is a public key; 64 hexadecimal characters
+    @staticmethod
+    def is_public_key(name: str) -> bool:
+        return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+    # returns whether the name is the name of a shard folder; 2 hexadecimal characters
+    @staticmethod
+    def is_shard_name(name: str) -> bool:
+        return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+    # returns the path to the folder the contents of the public key are saved in
+    @staticmethod
+    def get_shard_path(public_key: str) -> str:
+        return os.path.join(savepath, public_key[:2], public_key[2:4])
+
+    # returns the path to the contents saved under the public key
+    @staticmethod
+    def get_blob_path(public_key: str) -> str:
+        return os.path.join(BlobStorage.get_shard_path(public_key), public_key)
+
+    # returns the path to the metadata of the contents saved under the public key
+    @staticmethod
+    def get_metadata_path(public_key: str) -> str:
+        return os.path.join(BlobStorage.get_shard_path(public_key), public_key + metadata_suffix)
+
+    # creates an empty temporary file inside the upload folder and returns its open file descriptor and path
+    @staticmethod
+    def create_temp_file() -> tuple[int, str]:
+        return tempfile.mkstemp(prefix=temp_file_prefix, dir=savepath)
+
+    # removes the temporary files that were last written before the time; returns how many were removed
+    @staticmethod
+    def remove_temp_files(modified_before: float) -> int:
+        removed_count = 0
+        with os.scandir(savepath) as entries:
+            for entry in entries:
+                if not entry.name.startswith(temp_file_prefix):
+                    continue
+
+                try:
+                    if entry.stat().st_mtime < modified_before:
+                        os.remove(entry.path)
+                        removed_count += 1
+                except FileNotFoundError:
+                    pass  # the upload finished or failed in the meantime
+
+        return removed_count
+
+    # reads a metadata file; returns None if it is missing or corrupted
+    @staticmethod
+    def __read_metadata_file(public_key: str, path: str) -> SavedFileRecord | None:
+        try:
+            with open(path, "r") as f:
+                metadata = json.loads(f.read())
+            filenames, size, encoding = list(metadata["filenames"]), int(metadata["size"]), metadata.get("encoding", "")
+            return SavedFileRecord(public_key, filenames, size, encoding=encoding)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    # reads the metadata of the contents saved under the public key; returns None if it is missing or corrupted
+    @staticmethod
+    def read_record(public_key: str) -> SavedFileRecord | None:
+        return BlobStorage.__read_metadata_file(public_key, BlobStorage.get_metadata_path(public_key))
+
+    # writes the metadata to a temporary file and renames it, so the metadata is never seen half written;
+    # the encoding is only written for contents stored compressed
+    @staticmethod
+    def write_record(record: SavedFileRecord):
+        metadata = {"filenames": record.filenames, "size": record.size}
+        if record.encoding:
+            metadata["encoding"] = record.encoding
+
+        fd, temp_filepath = BlobStorage.create_temp_file()
+        with open(fd, "w") as f:
+            f.write(json.dumps(metadata))
+        os.makedirs(BlobStorage.get_shard_path(record.public_key), exist_ok=True)
+        os.replace(temp_filepath, BlobStorage.get_metadata_path(record.public_key))
+
+    # moves a fully written file to where the contents of the public key are saved
+    @staticmethod
+    def publish_blob(temp_filepath: str, public_key: str):
+        os.makedirs(BlobStorage.get_shard_path(public_key), exist_ok=True)
+        os.replace(temp_filepath, BlobStorage.get_blob_path(public_key))
+
+    # removes the contents saved under the public key along with their metadata
+    @staticmethod
+    def remove_blob(public_key: str):
+        for path in (BlobStorage.get_blob_path(public_key), BlobStorage.get_metadata_path(public_key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # returns the hash of the private key, which is what leads to its public key wherever it is persisted;
+    # the private key cannot be found back from it
+    @staticmethod
+    def get_key_hash(private_key: str) -> bytes:
+        return hashlib.sha256(private_key.encode()).digest()
+
+    # returns the path to the file that leads from the private key to its public key; it is named after a hash of
+    # the private key, so the names in the upload folder never give the private keys away
+    @staticmethod
+    def get_key_path(private_key: str) -> str:
+        key_hash = BlobStorage.get_key_hash(private_key).hex()
+        return os.path.join(BlobStorage.get_shard_path(key_hash), key_hash + key_suffix)
+
+    # records which public key the private key belongs to; the private key cannot be calculated back from the
+    # public key, so with several workers this is how one finds the contents another one saved
+    @staticmethod
+    def write_key(private_key: str, public_key: str):
+        fd, temp_filepath = BlobStorage.create_temp_file()
+        with open(fd, "w") as f:
+            f.write(public_key)
+        key_path = BlobStorage.get_key_path(private_key)
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+        os.replace(temp_filepath, key_path)
+
+    # returns the public key recorded for the private key; empty if none is
+    @staticmethod
+    def read_key(private_key: str) -> str:
+        try:
+            with open(BlobStorage.get_key_path(private_key), "r") as f:
+                public_key = f.read()
+        except OSError:
+            return ""
+
+        return public_key if BlobStorage.is_public_key(public_key) else ""
+
+    # removes the record of the private key, if there is one
+    @staticmethod
+    def remove_key(private_key: str):
+        key_path = BlobStorage.get_key_path(private_key)
+        if os.path.exists(key_path):
+            os.remove(key_path)
+
+    # returns the paths of all the shard folders (ab/cd) inside the upload folder
+    @staticmethod
+    def get_shard_paths() -> list[str]:
+        shard_paths = []
+        with os.scandir(savepath) as entries:
+            for entry in entries:
+                if BlobStorage.is_shard_name(entry.name) and entry.is_dir():
+                    with os.scandir(entry.path) as sub_entries:
+                        for sub_entry in sub_entries:
+                            if BlobStorage.is_shard_name(sub_entry.name) and sub_entry.is_dir():
+                                shard_paths.append(sub_entry.path)
+
+        return shard_paths
+
+    # moves the files saved directly inside the upload folder into the shard folders;
+    # handles both the content-addressed files (public key and metadata) and the older layout (public key + filename)
+    # returns the number of files that were moved or merged
+    @staticmethod
+    def migrate_flat_files() -> int:
+        blob_names, metadata_names, legacy_names = [], [], []
+        with os.scandir(savepath) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(temp_file_prefix) or not entry.is_file():
+                    continue
+
+                if BlobStorage.is_public_key(name):
+                    blob_names.append(name)
+                elif name.endswith(metadata_suffix) and BlobStorage.is_public_key(name[: -len(metadata_suffix)]):
+                    metadata_names.append(name)
+                elif BlobStorage.is_public_key(name[:64]):
+                    legacy_names.append(name)
+
+        for public_key in blob_names:
+            flat_path = os.path.join(savepath, public_key)
+            if os.path.exists(BlobStorage.get_blob_path(public_key)):
+                os.remove(flat_path)  # the same contents are already saved
+            else:
+                BlobStorage.publish_blob(flat_path, public_key)
+
+        for metadata_name in metadata_names:
+            public_key = metadata_name[: -len(metadata_suffix)]
+            flat_path = os.path.join(savepath, metadata_name)
+            flat_record = BlobStorage.__read_metadata_file(public_key, flat_path)
+            record = BlobStorage.read_record(public_key)
+            if flat_record:
+                if record is None:
+                    record = flat_record
+                else:
+                    record.filenames += [f for f in flat_record.filenames if f not in record.filenames]
+                BlobStorage.write_record(record)
+            os.remove(flat_path)
+
+        for legacy_name in legacy_names:
+            public_key, original_filename = legacy_name[:64], legacy_name[64:]
+            flat_path = os.path.join(savepath, legacy_name)
+            record = BlobStorage.read_record(public_key)
+            if record is None or not os.path.exists(BlobStorage.get_blob_path(public_key)):
+                record = SavedFileRecord(public_key, record.filenames if record else [], os.stat(flat_path).st_size)
+                BlobStorage.publish_blob(flat_path, public_key)
+            else:
+                os.remove(flat_path)  # the same contents are already saved
+
+            if original_filename not in record.filenames:
+                record.filenames.append(original_filename)
+            BlobStorage.write_record(record)
+
+        return len(blob_names) + len(metadata_names) + len(legacy_names)
+
+    # scans the shard folders and returns the records of all the saved contents;
+    # files still saved directly inside the upload folder are moved into the shard folders first
+    @staticmethod
+    def scan() -> dict[str, SavedFileRecord]:
+        BlobStorage.migrate_flat_files()
+
+        records: dict[str, SavedFileRecord] = {}
+        for shard_path in BlobStorage.get_shard_paths():
+            blob_stats: dict[str, os.stat_result] = {}
+            metadata_public_keys: list[str] = []
+            with os.scandir(shard_path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if BlobStorage.is_public_key(name):
+                        blob_stats[name] = entry.stat()
+                    elif name.endswith(metadata_suffix) and BlobStorage.is_public_key(name[: -len(metadata_suffix)]):
+                        metadata_public_keys.append(name[: -len(metadata_suffix)])
+
+            for public_key in metadata_public_keys:
+                record = BlobStorage.read_record(public_key)
+                if record and public_key in blob_stats:
+                    record.last_access = blob_stats[public_key].st_atime
+                    records[public_key] = record
+                else:
+                    os.remove(BlobStorage.get_metadata_path(public_key))  # metadata of contents that no longer exist
+
+            for public_key, blob_stat in blob_stats.items():
+                if public_key not in records:
+                    # contents without metadata; the public key is the only name known for them
+                    record = SavedFileRecord(public_key, [public_key], blob_stat.st_size, blob_stat.st_atime)
+                    records[public_key] = record
+                    BlobStorage.write_record(records[public_key])
+
+        return records
+
+    # removes every saved file and every shard folder; temporary files of uploads in progress are kept
+    @staticmethod
+    def remove_all():
+        with os.scandir(savepath) as entries:
+            for entry in entries:
+                if entry.name.startswith(temp_file_prefix):
+                    continue
+
+                if BlobStorage.is_shard_name(entry.name) and entry.is_dir():
+                    shutil.rmtree(entry.path)
+                elif entry.is_file():
+                    os.remove(entry.path)
+
+
 # handles uploaded file
 class FileUploadHandler:
     file: UploadFile
-    file_contents: bytes
+    start_position: int  # where the contents start; the file may have been partially read before it was handed over
+    file_size: int
     public_key: str
     private_key: str
+    encoding: str  # what the contents are stored with once written (see CompressionHandler); empty if uncompressed
     crypto_handler: CryptoHandler
 
     # the constructor receives the uploaded file; initialize class properties; calculate public and private keys
+    # uploads hashed in a worker process (see HashingHandler) get their keys from save_file instead,
+    # once the contents are on the disk where the worker process can read them
     def __init__(self, file: UploadFile):
         self.file = file
-        self.file_contents = file.file.read()  # read the contents of the file
+        self.start_position = file.file.tell()
+        self.file_size = self.__get_size()
         self.private_key = ""
         self.public_key = ""
+        self.encoding = ""
         self.crypto_handler = CryptoHandler()  # handles the calculation of the public and private keys
+        if HashingHandler.is_offloaded(self.file_size):
+            return
+
         self.__calculate_public_key()  # calculate public key and assign it to the public_key property
         self.__calculate_private_key()  # calculate the private key and assign it to the private_key property
 
-    # uses the contents of the file to product the public key
+    # returns the uploaded file positioned at its start
+    def __get_source(self) -> BinaryIO:
+        source = self.file.file
+        source.seek(self.start_position)
+        return source
+
+    # returns the size of the uploaded file without reading it
+    def __get_size(self) -> int:
+        source = self.file.file
+        size = source.seek(0, os.SEEK_END) - self.start_position
+        source.seek(self.start_position)
+        return size
+
+    # reads the uploaded file chunk by chunk and feeds every chunk to the hash,
+    # so only one chunk of the upload is held in memory at a time
     def __calculate_public_key(self):
-        if not self.public_key:
-            file_contents = self.file_contents
-            public_key = self.crypto_handler.calculate_public_key(file_contents)
-            self.public_key = public_key
+        with hash_duration.time():
+            source = self.__get_source()
+            hash = self.crypto_handler.create_public_key_hash()
+            while chunk := source.read(upload_chunk_size):
+                hash.update(chunk)
+
+            self.public_key = hash.hexdigest()
 
     # uses the public key to calculate the private key; crypto handler also uses the SECRET_KEY variable for calculation
     def __calculate_private_key(self):
         if not self.private_key:
-            self.__calculate_public_key()
             public_key = self.public_key
             private_key = self.crypto_handler.calculate_private_key(public_key)
             self.private_key = private_key
 
-    # saves the file with a filename prepended with the public key
+    # copies the uploaded file chunk by chunk into the file
+    def __copy_source(self, file: BinaryIO):
+        source = self.__get_source()
+        while chunk := source.read(upload_chunk_size):
+            file.write(chunk)
+
+    # returns the encoding the upload is compressed with as it is written; empty if it is not compressible
+    def __get_encoding(self) -> str:
+        encoding = CompressionHandler.get_encoding()
+        if encoding and CompressionHandler.is_compressible(self.file.filename, self.__get_source().read(probe_size)):
+            return encoding
+
+        return ""
+
+    # copies the uploaded file chunk by chunk into a temporary file inside the upload folder and returns its path;
+    # with STORAGE_COMPRESSION, compressible uploads are compressed on the way, and copied again as they are
+    # if they did not shrink enough. uploads that are hashed from the temporary file are never compressed
+    def __write_temp_file(self, is_compressed: bool = True) -> str:
+        fd, temp_filepath = BlobStorage.create_temp_file()
+        try:
+            with disk_write_duration.time(), open(fd, "wb") as f:
+                self.encoding = self.__get_encoding() if is_compressed else ""
+                if self.encoding:
+                    with CompressionHandler.open_compressor(self.encoding, f) as compressor:
+                        self.__copy_source(compressor)
+                    if not CompressionHandler.is_worth_it(self.file_size, f.tell()):
+                        self.encoding = ""
+                        f.seek(0)
+                        f.truncate()
+
+                if not self.encoding:
+                    self.__copy_source(f)
+        except:
+            os.remove(temp_filepath)
+            raise
+
+        return temp_filepath
+
+    # saves the file; the contents are only written if no other upload saved the same contents before,
+    # otherwise the uploaded filename is simply added as another reference to the saved contents.
+    # uploads of the same contents that arrive at the same time wait for the first one to write them
+    # uploads hashed in a worker process are always written first and hashed from the temporary file
     def save_file(self):
         uploaded_filename = self.file.filename
-        save_filename = self.public_key + uploaded_filename
-        save_filepath = os.path.join(savepath, save_filename)
+        if not self.public_key:
+            temp_filepath = self.__write_temp_file(is_compressed=False)
+            try:
+                with hash_duration.time():
+                    self.public_key = HashingHandler.submit([temp_filepath], self.file_size).result()
+                self.encoding = CompressionHandler.compress_file(temp_filepath, uploaded_filename)
+            except:
+                os.remove(temp_filepath)
+                raise
+
+            self.__calculate_private_key()
+            saved_files_index.add_blob(
+                self.public_key, uploaded_filename, self.file_size, temp_filepath, self.encoding
+            )
+            return
+
+        upload_flights.acquire(self.public_key)
+        try:
+            if saved_files_index.add_reference(self.public_key, uploaded_filename):
+                return
+
+            temp_filepath = self.__write_temp_file()
+            saved_files_index.add_blob(self.public_key, uploaded_filename, self.file_size, temp_filepath, self.encoding)
+        finally:
+            upload_flights.release(self.public_key)
+
+    # writes the uploaded file to a temporary file unless its contents are already saved, and returns its path;
+    # None if the contents are already saved. used by batches, which add all their uploads to the index at once
+    def write_unsaved_contents(self) -> str | None:
+        if saved_files_index.get_record(self.public_key) is not None:
+            return None
+
+        return self.__write_temp_file()
+
+
+# handles several files uploaded in a single request; every file is hashed and written like a single upload,
+# then all of them are added to the index at once. a file that cannot be saved does not fail the others,
+# every file gets its own status
+class BatchUploadHandler:
+    files: list[UploadFile]
+    results: list[dict]  # the status of every file, in the order the files were uploaded
+
+    def __init__(self, files: list[UploadFile]) -> None:
+        self.files = files
+        self.results = []
+
+    # returns the status of a saved file
+    def __get_saved_result(self, upload_handler: FileUploadHandler) -> dict:
+        return {
+            "filename": upload_handler.file.filename,
+            "status": 200,
+            "publicKey": upload_handler.public_key,
+            "privateKey": upload_handler.private_key,
+        }
+
+    # saves every file and keeps the status of every one of them
+    def save_files(self):
+        self.results = [{}] * len(self.files)
+        pending_uploads: list[tuple[int, FileUploadHandler, str | None]] = []  # (position, handler, temporary file)
+        for i, file in enumerate(self.files):
+            try:
+                upload_handler = FileUploadHandler(file)
+                if upload_handler.public_key:
+                    pending_uploads.append((i, upload_handler, upload_handler.write_unsaved_contents()))
+                else:
+                    upload_handler.save_file()  # hashed in a worker process once it is written; saved on its own
+                    self.results[i] = self.__get_saved_result(upload_handler)
+            except OSError:
+                self.results[i] = {"filename": file.filename, "status": 500, "detail": "The file could not be saved"}
+
+        try:
+            uploads = [
+                (
+                    upload_handler.public_key,
+                    upload_handler.file.filename,
+                    upload_handler.file_size,
+                    temp_filepath,
+                    upload_handler.encoding,
+                )
+                for _, upload_handler, temp_filepath in pending_uploads
+            ]
+            are_saved = saved_files_index.add_uploads(uploads)
+        except:
+            for _, _, temp_filepath in pending_uploads:
+                if temp_filepath is not None and os.path.exists(temp_filepath):
+                    os.remove(temp_filepath)
+            raise
 
-        with open(save_filepath, "wb") as f:
-            f.write(self.file_contents)
+        for (i, upload_handler, _), is_saved in zip(pending_uploads, are_saved):
+            if not is_saved:
+                upload_handler.save_file()  # the contents were removed since they were looked up; write them
+            self.results[i] = self.__get_saved_result(upload_handler)
+
+
+# handles a file uploaded as the raw request body; the body is hashed and written to a temporary file as it arrives,
+# without any multipart decoding and without being spooled anywhere else first.
+# the pieces of the body are gathered into chunks of UPLOAD_CHUNK_SIZE_KB that are hashed and written on the
+# transfer pool, so the event loop only ever holds one chunk and never blocks on the disk.
+# the key is only known once the whole body is written, so with STORAGE_COMPRESSION the file is compressed after that
+class StreamUploadHandler:
+    filename: str
+    expected_size: int | None  # size announced by the client, if any; used to pick the pool the upload runs on
+    file_size: int
+    public_key: str
+    private_key: str
+    crypto_handler: CryptoHandler
+
+    def __init__(self, filename: str, expected_size: int | None = None) -> None:
+        self.filename = filename
+        self.expected_size = expected_size
+        self.file_size = 0
+        self.public_key = ""
+        self.private_key = ""
+        self.crypto_handler = CryptoHandler()
+
+    # reads the stream until it ends, then saves the file and calculates the public and private keys
+    async def save_stream(self, stream: AsyncIterator[bytes]):
+        hash = self.crypto_handler.create_public_key_hash()
+        fd, temp_filepath = await ExecutorHandler.run_metadata(BlobStorage.create_temp_file)
+        durations = [0.0, 0.0]  # time spent hashing and writing, recorded once the whole body is saved
+
+        def write_chunk(chunk: bytes):
+            start = time.perf_counter()
+            hash.update(chunk)
+            hashed_at = time.perf_counter()
+            os.write(fd, chunk)
+            durations[0] += hashed_at - start
+            durations[1] += time.perf_counter() - hashed_at
+
+        try:
+            try:
+                buffer = bytearray()
+                async for data in stream:
+                    buffer += data
+                    self.file_size += len(data)
+                    if len(buffer) >= upload_chunk_size:
+                        await ExecutorHandler.run_transfer(self.expected_size, write_chunk, bytes(buffer))
+                        buffer.clear()
+
+                if buffer:
+                    await ExecutorHandler.run_transfer(self.expected_size, write_chunk, bytes(buffer))
+            finally:
+                os.close(fd)
+        except:
+            os.remove(temp_filepath)
+            raise
+
+        hash_duration.record(durations[0])
+        disk_write_duration.record(durations[1])
+        self.public_key = hash.hexdigest()
+        self.private_key = self.crypto_handler.calculate_private_key(self.public_key)
+        try:
+            encoding = await ExecutorHandler.run_transfer(
+                self.file_size, CompressionHandler.compress_file, temp_filepath, self.filename
+            )
+        except:
+            os.remove(temp_filepath)
+            raise
+
+        await ExecutorHandler.run_metadata(
+            saved_files_index.add_blob, self.public_key, self.filename, self.file_size, temp_filepath, encoding
+        )
+
+
+# keeps track of the saved files in memory so looking up a file does not require scanning the upload folder;
+# maps the public key to the record of the saved contents and the private key to the public key
+# one instance is shared by the whole process; it is built once and updated every time a file is saved or deleted
+# every change of the saved contents goes through the index, under its lock, so the folder and the index agree.
+# the changes are also made under the index file lock, so worker processes sharing the folder never change it at once;
+# with several workers, the index of one worker does not see the changes of the others, so the records are read
+# again from the disk before they are changed, and lookups that miss go to the disk (see sync_record)
+# every change is also appended to the journal of the snapshot handler, so the index is loaded from the snapshot
+# instead of being scanned from the upload folder the next time it is built, by this worker or another one
+class SavedFilesIndex:
+    lock: threading.RLock
+    is_built: bool
+    built_at: float  # when the index was last built, from time.monotonic()
+    snapshot_id: tuple[int, int] | None  # the snapshot the journal offset belongs to
+    journal_offset: int  # how far the journal was read by the index, see sync_journal
+    records: dict[str, SavedFileRecord]
+    public_key_by_key_hash: dict[bytes, str]  # the hash of the private key -> public key, see get_public_key
+    stored_size: int  # size in bytes of all the saved contents
+    crypto_handler: CryptoHandler
+    upload_count: int  # number of uploads saved since the server started
+    dedup_hit_count: int  # number of those uploads whose contents were already saved
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.is_built = False
+        self.built_at = 0.0
+        self.snapshot_id = None
+        self.journal_offset = 0
+        self.records = {}
+        self.public_key_by_key_hash = {}
+        self.stored_size = 0
+        self.crypto_handler = CryptoHandler()
+        self.upload_count = 0
+        self.dedup_hit_count = 0
+
+    # returns the records to save in the snapshot
+    def __get_snapshot_records(self) -> SnapshotRecords:
+        key_hashes = {public_key: key_hash for key_hash, public_key in self.public_key_by_key_hash.items()}
+        return {
+            public_key: (
+                record.filenames,
+                record.size,
+                record.last_access,
+                record.encoding,
+                key_hashes.get(public_key) or self.__get_key_hash(public_key),
+            )
+            for public_key, record in self.records.items()
+        }
+
+    # loads the index from the snapshot and returns whether it could; it cannot if there is no snapshot, if it fails
+    # its checks, if files were saved directly inside the upload folder, or if a sample of the files do not match
+    # their records: missing, or of another size for contents that are not compressed. the lock must be held
+    def __load_snapshot(self) -> bool:
+        snapshot_records = snapshot_handler.load()
+        if snapshot_records is None or BlobStorage.migrate_flat_files() > 0:
+            return False
+
+        sample_size = min(snapshot_sample_size, len(snapshot_records))
+        for public_key in random.sample(list(snapshot_records.keys()), sample_size):
+            _, size, _, encoding, _ = snapshot_records[public_key]
+            try:
+                if os.stat(BlobStorage.get_blob_path(public_key)).st_size != size and not encoding:
+                    return False
+            except FileNotFoundError:
+                return False
+
+        self.records = {}
+        self.public_key_by_key_hash = {}
+        for public_key, (filenames, size, last_access, encoding, key_hash) in snapshot_records.items():
+            self.records[public_key] = SavedFileRecord(public_key, filenames, size, last_access, encoding)
+            self.public_key_by_key_hash[key_hash] = public_key  # checked against the private key when looked up
+
+        if snapshot_handler.is_journal_full():
+            snapshot_handler.save(snapshot_records)
+
+        return True
+
+    # indexes every saved file; the index is loaded from its snapshot if there is one that can be trusted,
+    # otherwise the upload folder is scanned and a new snapshot is saved
+    def build(self):
+        with self.lock, index_lock, paused_gc():
+            if not self.__load_snapshot():
+                self.records = BlobStorage.scan()
+                self.public_key_by_key_hash = {}
+                for public_key in self.records.keys():
+                    self.__add_private_key(public_key)
+                snapshot_handler.save(self.__get_snapshot_records())
+
+            self.stored_size = sum(record.size for record in self.records.values())
+            eviction_handler.reset({pk: (record.size, record.last_access) for pk, record in self.records.items()})
+
+            self.is_built = True
+            self.built_at = time.monotonic()
+            self.snapshot_id = snapshot_handler.get_snapshot_id()
+            self.journal_offset = snapshot_handler.get_journal_size()
+
+    # folds the journal into a new snapshot once it grew over INDEX_JOURNAL_MAX_MB; the snapshot is made of what is
+    # persisted rather than of this index, which may miss the changes of other workers
+    def compact_snapshot(self):
+        if not snapshot_handler.is_journal_full():
+            return
+
+        with self.lock, index_lock:
+            snapshot_records = snapshot_handler.load()
+            if snapshot_records is not None:
+                snapshot_handler.save(snapshot_records)
+
+    # catches up with the contents the other workers saved, removed or downloaded since the last call, so the
+    # eviction sees them: the journal is read from where the last call stopped, at most journal_sync_max_size bytes
+    # per call, so every call takes a bounded time and never waits for the other workers. once a worker folded the
+    # journal into a new snapshot, the snapshot is loaded instead, a single time.
+    # without a snapshot there is no journal to read, so the index is built again every EVICTION_RESCAN_MINS instead
+    def sync_journal(self):
+        if not snapshot_handler.is_enabled():
+            if time.monotonic() - self.built_at >= settings.EVICTION_RESCAN_MINS * 60:
+                self.build()
+            return
+
+        snapshot_id = snapshot_handler.get_snapshot_id()
+        if snapshot_id == self.snapshot_id:
+            entries, journal_offset = snapshot_handler.read_journal(self.journal_offset, journal_sync_max_size)
+            if snapshot_handler.get_snapshot_id() == snapshot_id:  # not read from the journal of a newer snapshot
+                self.journal_offset = journal_offset
+                for entry in entries:
+                    try:
+                        if entry[0] == "put":
+                            eviction_handler.track(entry[1], entry[3], entry[4])
+                        elif entry[0] == "remove":
+                            eviction_handler.remove(entry[1])
+                        elif entry[0] == "access":
+                            eviction_handler.track(entry[1], None, entry[2])
+                    except (IndexError, TypeError):
+                        continue
+                return
+
+        with index_lock:
+            snapshot_records = snapshot_handler.load()
+            self.snapshot_id = snapshot_handler.get_snapshot_id()
+            self.journal_offset = snapshot_handler.get_journal_size()
+
+        if snapshot_records is not None:
+            contents = {pk: (size, last_access) for pk, (_, size, last_access, _, _) in snapshot_records.items()}
+            eviction_handler.sync(contents)
+
+    # builds the index the first time it is used if it was not built at startup
+    def __ensure_built(self):
+        if not self.is_built:
+            with self.lock:
+                if not self.is_built:
+                    self.build()
+
+    # returns the current record of the public key; with several workers it is read from the disk,
+    # since another worker may have changed it. the lock must be held
+    def __get_current_record(self, public_key: str) -> SavedFileRecord | None:
+        if WorkersHandler.is_shared():
+            return self.sync_record(public_key)
+
+        return self.records.get(public_key)
+
+    # reads the record of the public key from the disk into the index and returns it; None if nothing is saved
+    # under it anymore. used with several workers to pick up the files the other workers saved or removed
+    def sync_record(self, public_key: str) -> SavedFileRecord | None:
+        if not BlobStorage.is_public_key(public_key):
+            return None
+
+        with self.lock:
+            self.__ensure_built()
+            record = BlobStorage.read_record(public_key)
+            try:
+                if record is not None:
+                    record.last_access = os.stat(BlobStorage.get_blob_path(public_key)).st_atime
+            except FileNotFoundError:
+                record = None  # being removed
+
+            key_hash = self.__get_key_hash(public_key)
+            previous_record = self.records.get(public_key)
+            if previous_record is not None:
+                self.stored_size -= previous_record.size
+            if record is not None:
+                self.records[public_key] = record
+                self.public_key_by_key_hash[key_hash] = public_key
+                self.stored_size += record.size
+                eviction_handler.add(public_key, record.size, record.last_access)
+            else:
+                self.records.pop(public_key, None)
+                self.public_key_by_key_hash.pop(key_hash, None)
+                file_cache.remove(public_key)
+                eviction_handler.remove(public_key)
+
+            return record
+
+    # returns the hash of the private key of the public key, see BlobStorage.get_key_hash
+    def __get_key_hash(self, public_key: str) -> bytes:
+        return BlobStorage.get_key_hash(self.crypto_handler.calculate_private_key(public_key))
+
+    # indexes the private key of the public key, by its hash, and returns it
+    def __add_private_key(self, public_key: str) -> str:
+        private_key = self.crypto_handler.calculate_private_key(public_key)
+        self.public_key_by_key_hash[BlobStorage.get_key_hash(private_key)] = public_key
+        return private_key
+
+    # writes the record and appends it to the journal of the snapshot
+    def __write_record(self, record: SavedFileRecord):
+        BlobStorage.write_record(record)
+        snapshot_handler.append_put(
+            record.public_key,
+            record.filenames,
+            record.size,
+            record.last_access,
+            record.encoding,
+            self.__get_key_hash(record.public_key),
+        )
+
+    # adds the filename to the record and writes the record
+    def __add_filename(self, record: SavedFileRecord, filename: str):
+        if filename not in record.filenames:
+            record.filenames.append(filename)
+            self.__write_record(record)
+
+    # saves an upload of the contents of the public key; if they are already saved, the temporary file is dropped
+    # and only the filename is added as another reference. returns False, without saving anything, if the contents
+    # are not saved and there is no temporary file (None) to save them from. the lock must be held
+    def __add_upload(
+        self, public_key: str, filename: str, size: int, temp_filepath: str | None, encoding: str = ""
+    ) -> bool:
+        record = self.__get_current_record(public_key)
+        if record is not None:
+            if temp_filepath is not None:
+                os.remove(temp_filepath)
+            eviction_handler.touch(public_key)
+            self.dedup_hit_count += 1
+        elif temp_filepath is None:
+            return False
+        else:
+            BlobStorage.publish_blob(temp_filepath, public_key)
+            # the upload is the first access; it is journaled with the record, so a start that loads the snapshot
+            # does not take the contents for the oldest ones
+            record = SavedFileRecord(public_key, [], size, time.time(), encoding)
+            self.records[public_key] = record
+            self.stored_size += size
+            private_key = self.__add_private_key(public_key)
+            if WorkersHandler.is_shared():
+                BlobStorage.write_key(private_key, public_key)  # so the other workers can find it, see get_public_key
+            eviction_handler.add(public_key, size, record.last_access)
+
+        self.__add_filename(record, filename)
+        self.upload_count += 1
+        return True
+
+    # if the contents of the public key are already saved, add the filename as another reference and return True;
+    # return False if the contents still need to be written
+    def add_reference(self, public_key: str, filename: str) -> bool:
+        with self.lock, index_lock:
+            self.__ensure_built()
+            return self.__add_upload(public_key, filename, 0, None)
+
+    # saves the contents written to the temporary file under the public key; the encoding is the one the temporary
+    # file is compressed with, if any. if the same contents were saved in the meantime, the temporary file is dropped
+    # and only the reference is added
+    def add_blob(self, public_key: str, filename: str, size: int, temp_filepath: str, encoding: str = ""):
+        with self.lock, index_lock:
+            self.__ensure_built()
+            self.__add_upload(public_key, filename, size, temp_filepath, encoding)
+
+    # saves a batch of uploads at once, (public key, filename, size, temporary file, encoding), taking the locks only
+    # once; the temporary file is None for contents that were already saved. returns whether every upload was saved;
+    # the ones whose contents were removed in the meantime are not, their contents must be written first
+    def add_uploads(self, uploads: list[tuple[str, str, int, str | None, str]]) -> list[bool]:
+        with self.lock, index_lock:
+            self.__ensure_built()
+            return [self.__add_upload(*upload) for upload in uploads]
+
+    # removes one reference to the contents of the public key, the oldest filename; the contents are removed along
+    # with the last reference. returns False if nothing is saved under the public key. the lock must be held
+    def __remove_reference(self, public_key: str) -> bool:
+        record = self.__get_current_record(public_key)
+        if record is None:
+            return False
+
+        if record.filenames:
+            record.filenames.pop(0)
+
+        if record.filenames:
+            self.__write_record(record)
+        else:
+            self.__remove_contents(public_key)
+
+        return True
+
+    # removes one reference to the contents of the public key, the oldest filename;
+    # the contents are removed along with the last reference
+    def remove_reference(self, public_key: str):
+        with self.lock, index_lock:
+            self.__ensure_built()
+            self.__remove_reference(public_key)
+
+    # removes one reference to the contents of every public key, taking the locks only once;
+    # returns whether something was saved under every public key
+    def remove_references(self, public_keys: list[str]) -> list[bool]:
+        with self.lock, index_lock:
+            self.__ensure_built()
+            return [self.__remove_reference(public_key) for public_key in public_keys]
+
+    # removes the contents of the public key along with every reference to them; the lock must be held
+    def __remove_contents(self, public_key: str):
+        BlobStorage.remove_blob(public_key)
+        snapshot_handler.append_remove(public_key)
+        file_cache.remove(public_key)
+        eviction_handler.remove(public_key)
+        record = self.records.pop(public_key, None)
+        if record is not None:
+            self.stored_size -= record.size
+        private_key = self.crypto_handler.calculate_private_key(public_key)
+        self.public_key_by_key_hash.pop(BlobStorage.get_key_hash(private_key), None)
+        BlobStorage.remove_key(private_key)
+
+    # removes the contents of the public key along with every reference to them, if they were not accessed after
+    # last_access; returns whether they were removed. used to evict contents nobody downloads anymore
+    def evict(self, public_key: str, last_access: float) -> bool:
+        with self.lock, index_lock:
+            self.__ensure_built()
+            record = self.__get_current_record(public_key)
+            if record is None:
+                return False
+
+            try:
+                disk_last_access = os.stat(BlobStorage.get_blob_path(public_key)).st_atime
+            except FileNotFoundError:
+                disk_last_access = last_access
+            if disk_last_access > last_access + 1:
+                eviction_handler.update(public_key, disk_last_access)  # accessed since; ex: through another worker
+                return False
+
+            self.__remove_contents(public_key)
+            return True
+
+    # removes every file from the index
+    def clear(self):
+        with self.lock:
+            file_cache.clear()
+            eviction_handler.reset({})
+            snapshot_handler.save({})
+            self.records = {}
+            self.public_key_by_key_hash = {}
+            self.stored_size = 0
+            self.is_built = True
+
+    # returns the public keys of all the saved contents
+    def get_public_keys(self) -> list[str]:
+        with self.lock:
+            self.__ensure_built()
+            return list(self.records.keys())
+
+    # returns the record of the contents saved under the public key; None if nothing is saved under it
+    # lookups do not take the lock; reading a dict is atomic, so a lookup never waits for a save or a deletion
+    # that is busy writing to the disk
+    # with several workers, a miss is looked up on the disk, the contents may have been saved by another worker
+    def get_record(self, public_key: str) -> SavedFileRecord | None:
+        with index_lookup_duration.time():
+            self.__ensure_built()
+            record = self.records.get(public_key)
+            if record is None and WorkersHandler.is_shared():
+                record = self.sync_record(public_key)
+
+            return record
+
+    # returns whether the private key is the one calculated from the public key
+    def __is_private_key_of(self, private_key: str, public_key: str) -> bool:
+        return hmac.compare_digest(self.crypto_handler.calculate_private_key(public_key), private_key)
+
+    # returns the public key that belongs to the private key; if nothing matches, return an empty string
+    # the public key cannot be calculated back from the private key, so the index finds it by the hash of the private
+    # key, and with several workers a miss reads the key file the worker that saved the contents wrote, and the record
+    # it leads to; a single lookup on the disk, whatever the private key. either way, the public key is only trusted
+    # if the private key is calculated back from it
+    def get_public_key(self, private_key: str) -> str:
+        with index_lookup_duration.time():
+            self.__ensure_built()
+            public_key = self.public_key_by_key_hash.get(BlobStorage.get_key_hash(private_key), "")
+            if public_key and not self.__is_private_key_of(private_key, public_key):
+                public_key = ""
+            elif not public_key and WorkersHandler.is_shared():
+                public_key = BlobStorage.read_key(private_key)
+                if public_key:
+                    if not self.__is_private_key_of(private_key, public_key) or self.sync_record(public_key) is None:
+                        public_key = ""
+
+            return public_key
+
+    # returns how many uploads were saved and how many of them were already saved contents
+    def get_dedup_counts(self) -> tuple[int, int]:
+        with self.lock:
+            return self.upload_count, self.dedup_hit_count
+
+    # returns how many contents are saved and their size in bytes
+    def get_stored_counts(self) -> tuple[int, int]:
+        with self.lock:
+            return len(self.records), self.stored_size
+
+
+# the index shared by all the handlers in this process
+saved_files_index = SavedFilesIndex()
 
 
 # handles the saved files
@@ -80,46 +1016,64 @@ class SavedFilesHandler:
     def __init__(self) -> None:
         self.crypto_handler = CryptoHandler()  # initialize the cryto handler
 
-    # returns the list of all the files inside the folder specified in the FOLDER environment variable
+    # returns the names of all the saved contents; the contents are saved under their public key
     def get_saved_filenames(self) -> list[str]:
-        filenames = [f for f in os.listdir(savepath) if os.path.isfile(os.path.join(savepath, f))]
-        return filenames
+        return saved_files_index.get_public_keys()
 
     # returns the path to the file referred using the public key; if no file is found, return an empty string
     def get_filepath_using_public_key(self, public_key) -> str:
-        saved_filenames = self.get_saved_filenames()
-        for filename in saved_filenames:
-            file_public_key = filename[:64]
-            if public_key == file_public_key:
-                return os.path.join(savepath, filename)
+        if saved_files_index.get_record(public_key):
+            return BlobStorage.get_blob_path(public_key)
 
         return ""
 
-    # get the name of the file using the private key; if nothing matches, return an empty string
+    # get the name of the saved file using the private key; if nothing matches, return an empty string
     def get_filename_using_private_key(self, private_key) -> str:
-        saved_filenames = self.get_saved_filenames()
-        for filename in saved_filenames:  # loop through all the filenames
-            file_public_key = filename[:64]  # the first 64 characters is the public key
+        # the index already knows which public key the private key was calculated from
+        return saved_files_index.get_public_key(private_key)
 
-            # use the crypto handler to calculate the private key using the public key;
-            # if the private key matches, return the name of the file
-            file_private_key = self.crypto_handler.calculate_private_key(file_public_key)
-            if private_key == file_private_key:
-                return filename
+    # saved files are named after their public key; the filenames they were uploaded with are kept in the metadata
+    # and the oldest one is used as the original filename
+    def get_original_filename(self, filepath: str) -> str:
+        public_key = pathlib.Path(filepath).name[:64]
+        record = saved_files_index.get_record(public_key)
+        if record and record.filenames:
+            return record.filenames[0]
 
         return ""
 
-    # names of the saved files are (public key + original filename)
-    # public keys are 64 characters long, so to get the original filename, cut of the first 64 characters
-    def get_original_filename(self, filepath: str) -> str:
-        filename = pathlib.Path(filepath).name[64:]
-        return filename
+    # looks up what a download of the public key needs: the path to the file, its original filename and its
+    # contents if they are cached; the path is empty if nothing is saved under the public key.
+    # with a single worker the lookup never touches the disk, so it runs right away on the event loop; with several,
+    # a miss reads the disk under the index lock and a cached file is checked on the disk, so it runs on the pool
+    async def find_download(self, public_key: str, is_counted: bool = True) -> tuple[str, str, CachedFile | None]:
+        if WorkersHandler.is_shared():
+            return await ExecutorHandler.run_metadata(self.__find_download, public_key, is_counted)
+
+        return self.__find_download(public_key, is_counted)
+
+    def __find_download(self, public_key: str, is_counted: bool) -> tuple[str, str, CachedFile | None]:
+        filepath = self.get_filepath_using_public_key(public_key)
+        if not filepath:
+            return "", "", None
 
-    # delete saved file using the filename
+        return filepath, self.get_original_filename(filepath), file_cache.get(public_key, is_counted)
+
+    # delete saved file using the filename; this removes one reference to the contents,
+    # the contents themselves are only deleted when no reference is left
     def delete_saved_file(self, filename: str):
-        filepath = os.path.join(savepath, filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        saved_files_index.remove_reference(filename)
+
+    # delete the saved files of the private keys at once, one reference for every private key;
+    # returns whether a file was found for every private key
+    def delete_saved_files(self, private_keys: list[str]) -> list[bool]:
+        # private keys are always 64 characters long; the others are not even looked up
+        filenames = [
+            self.get_filename_using_private_key(private_key) if len(private_key) == 64 else ""
+            for private_key in private_keys
+        ]
+        are_deleted = iter(saved_files_index.remove_references([filename for filename in filenames if filename]))
+        return [next(are_deleted) if filename else False for filename in filenames]
 
     # get the file's size using a filepath; if the file does not exist, return 0
     def get_file_size(self, filepath) -> int:
@@ -130,23 +1084,69 @@ class SavedFilesHandler:
 
         return 0
 
-    # removes all the files specified in the FOLDER environment variable
+    # removes the least recently used contents when they expired (FILE_TTL_MINS) or when the saved contents go over
+    # STORAGE_BUDGET_MB; at most EVICTION_BATCH_SIZE contents are removed per call, so every call takes a bounded time.
+    # returns the number of contents removed
+    # with several workers, the journal of the index is read first to track what the others saved
+    def evict_files(self) -> int:
+        if WorkersHandler.is_shared():
+            saved_files_index.sync_journal()
+
+        batch_size = settings.EVICTION_BATCH_SIZE
+        evicted_count = 0
+        for _ in range(batch_size):
+            candidate = eviction_handler.pop_candidate(max_pops=batch_size)
+            if candidate is None:
+                break
+
+            public_key, last_access = candidate
+            try:
+                is_evicted = saved_files_index.evict(public_key, last_access)
+            except:
+                eviction_handler.update(public_key, last_access)  # try again on the next call
+                raise
+
+            if is_evicted:
+                evicted_count += 1
+
+        eviction_handler.evicted_count += evicted_count
+        return evicted_count
+
+    # saves the downloads recorded by the eviction handler as the access times of the files, and in the journal of
+    # the snapshot since a start that loads the snapshot does not read them; the other workers and the next start
+    # of the server see them. the journal is appended to under the index file lock like every other change, so a
+    # worker folding it into a new snapshot at the same time cannot drop the accesses
+    def save_accesses(self):
+        last_accesses = eviction_handler.save_accesses(
+            BlobStorage.get_blob_path, max_count=settings.EVICTION_BATCH_SIZE * 10
+        )
+        if not last_accesses:
+            return
+
+        with index_lock:
+            for public_key, last_access in last_accesses.items():
+                snapshot_handler.append_access(public_key, last_access)
+
+    # removes all the files specified in the FOLDER environment variable;
+    # the folder itself is scanned so files the index does not know about are removed as well
     def clean_up_files(self):
-        filenames = self.get_saved_filenames()
-        for filename in filenames:  # loop through all the filenames and delete each file
-            self.delete_saved_file(filename)
+        with saved_files_index.lock, index_lock:
+            BlobStorage.remove_all()
+            saved_files_index.clear()
 
 
-# a global variable to store time of the last activity
+# a global variable to store time of the last activity of this process
 LAST_ACTIVITY: float = time.time()
 
 # this handles settings, getting and calculating time of last activity
+# every process keeps its own last activity; flush_last_activity() writes it to the database,
+# where the last activity of all the worker processes is kept
 class ActivityHandler:
-    # simply returns the value of the last activity
+    # simply returns the value of the last activity; the latest of this process and of the database
     @staticmethod
     def get_last_activity() -> float:
         global LAST_ACTIVITY
-        return LAST_ACTIVITY
+        return max(LAST_ACTIVITY, database.get_last_activity())
 
     # update the value of last activity to the current time
     @staticmethod
@@ -154,11 +1154,16 @@ class ActivityHandler:
         global LAST_ACTIVITY
         LAST_ACTIVITY = time.time()
 
+    # write the last activity of this process to the database
+    @staticmethod
+    def flush_last_activity():
+        global LAST_ACTIVITY
+        database.update_last_activity(LAST_ACTIVITY)
+
     # calculate the time in minutes from the last activity
     @staticmethod
     def get_mins_from_last_activity() -> int:
-        global LAST_ACTIVITY
         current_time = time.time()
-        time_diff = current_time - LAST_ACTIVITY
+        time_diff = current_time - ActivityHandler.get_last_activity()
         time_diff_mins = time_diff / 60
         return int(time_diff_mins)
@@ -0,0 +1,90 @@
+import os, fcntl, threading
+
+from app.common import settings
+
+locks_path = os.path.join(settings.FOLDER, ".locks")  # where the lock files shared by the worker processes are kept
+
+# if the locks folder does not exist, this will automatically create it
+os.makedirs(locks_path, exist_ok=True)
+
+
+# a lock shared by every process using the same upload folder; a lock file locked with flock.
+# it is reentrant and also locks out the other threads of the process. the operating system releases it
+# when the process holding it dies, so a crashed worker never leaves it locked
+class FileLock:
+    path: str
+    thread_lock: threading.RLock
+    fd: int | None  # the lock file, opened on first use
+    depth: int  # how many times the current owner acquired the lock
+    is_held: bool  # whether the process took the lock for good with hold()
+
+    def __init__(self, name: str) -> None:
+        self.path = os.path.join(locks_path, name + ".lock")
+        self.thread_lock = threading.RLock()
+        self.fd = None
+        self.depth = 0
+        self.is_held = False
+
+    # returns the open lock file; the lock must be held by the thread
+    def __get_fd(self) -> int:
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        return self.fd
+
+    # waits until no other thread or process holds the lock and takes it
+    def acquire(self):
+        self.thread_lock.acquire()
+        try:
+            if self.depth == 0:
+                fcntl.flock(self.__get_fd(), fcntl.LOCK_EX)
+        except:
+            self.thread_lock.release()
+            raise
+
+        self.depth += 1
+
+    # releases the lock once it was released as many times as it was acquired
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.__get_fd(), fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    # takes the lock for the rest of the life of the process if no other process holds it;
+    # returns whether this process holds it. used to elect a single process among the workers
+    def hold(self) -> bool:
+        with self.thread_lock:
+            if not self.is_held:
+                try:
+                    fcntl.flock(self.__get_fd(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.is_held = True
+                except BlockingIOError:
+                    pass
+
+            return self.is_held
+
+
+# tells how the app is deployed; with several worker processes, every worker keeps its own index of the saved files,
+# file cache and counters, so whatever all of them must agree on is kept in the database and the upload folder
+class WorkersHandler:
+    # returns whether other worker processes serve the same upload folder
+    @staticmethod
+    def is_shared() -> bool:
+        return settings.WORKERS != 1
+
+    # returns the number of worker processes to start; WORKERS=0 starts one per CPU
+    @staticmethod
+    def get_worker_count() -> int:
+        return settings.WORKERS or os.cpu_count() or 1
+
+
+index_lock = FileLock("index")  # held while the saved files are changed, so the workers never change them at once
+cleanup_lock = FileLock("cleanup")  # held by the worker elected to run the clean up
@@ -0,0 +1,91 @@
+# runs a suite of benchmarks, each in its own process, and merges their results into a single JSON report that
+# records the commit it was run on, so the reports of two commits can be compared side by side.
+# the quick suite takes a few minutes; the full one runs every benchmark with its own defaults
+#
+# usage: python -m benchmarks --suite quick --output results.json
+#        python -m benchmarks --suite full --only load,micro
+import os, sys, json, argparse, platform, subprocess, tempfile, time
+
+quick_load_args = "--sizes 4KB,1MB --concurrency 1,16 --stored-files 0,10000 --hosts 1,10000 --requests 50".split()
+
+# benchmark -> arguments, for every suite
+suites = {
+    "quick": {
+        "load": quick_load_args,
+        "load_uvicorn": ["--target", "uvicorn", *quick_load_args],
+        "micro": "--stored-files 1000,10000 --hosts 1,10000 --sizes 1KB,1MB --seconds 0.2".split(),
+        "middleware_throughput": "--requests 500".split(),
+        "lookup_latency": "--counts 1000 10000 --requests 100".split(),
+        "upload_memory": "--sizes 10MB 100MB".split(),
+        "storage_compression": "--count 5".split(),
+        "bandwidth_shaping": "--seconds 2".split(),
+    },
+    "full": {
+        "load": [],
+        "load_uvicorn": ["--target", "uvicorn"],
+        "micro": [],
+        "middleware_throughput": [],
+        "lookup_latency": [],
+        "storage_scale": [],
+        "index_startup": [],
+        "storage_compression": [],
+        "bandwidth_shaping": [],
+        "upload_memory": [],
+        "upload_raw_vs_multipart": [],
+        "download_zero_copy": [],
+        "hashing_engines": [],
+    },
+}
+
+# benchmarks listed under another name in the suites, to run the same module with other arguments
+modules = {"load_uvicorn": "load"}
+
+
+# returns the commit the benchmarks run on; empty outside of a git checkout
+def get_commit() -> str:
+    try:
+        command = ["git", "rev-parse", "--short", "HEAD"]
+        return subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suite", choices=suites.keys(), default="quick")
+    parser.add_argument("--only", default="", help="comma separated benchmarks of the suite to run")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    benchmarks = suites[args.suite]
+    names = args.only.split(",") if args.only else list(benchmarks.keys())
+
+    report = {
+        "suite": args.suite,
+        "commit": get_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "benchmarks": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="fss-bench-results-") as results_dir:
+        for name in names:
+            output = os.path.join(results_dir, name + ".json")
+            command = [sys.executable, "-m", f"benchmarks.{modules.get(name, name)}", *benchmarks[name]]
+            print(f"running {name}", file=sys.stderr)
+            start = time.perf_counter()
+            subprocess.run(command + ["--output", output], check=True, stdout=subprocess.DEVNULL)
+            with open(output) as f:
+                report["benchmarks"][name] = json.load(f)
+            report["benchmarks"][name]["seconds"] = round(time.perf_counter() - start, 2)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# compares downloading a batch of files one GET /files/{public_key} at a time with downloading them as a single
+# archive from POST /files/archive, against the number of files in the batch; the requests go straight to the
+# ASGI app, so the difference is what the app spends per request and not the network round trips it also saves
+#
+# usage: python -m benchmarks.archive_download --counts 50,200 --size 64KB --repeat 5
+import os, json, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request, build_multipart_body
+
+
+async def run_benchmark(counts: list[int], size: int, repeat: int) -> list[dict]:
+    from app import app
+    from app.utils import SavedFilesHandler, quota_handler
+
+    results = []
+    for count in counts:
+        SavedFilesHandler().clean_up_files()
+        quota_handler.reset()
+        public_keys = []
+        for i in range(count):
+            body, content_type = build_multipart_body(f"file{i}.bin", os.urandom(size))
+            result = await asgi_request(app, "POST", "/files/", body, {"content-type": content_type}, keep_body=True)
+            public_keys.append(json.loads(result.body)["publicKey"])
+
+        single_seconds = []
+        archive_seconds = {"zip": [], "tar": []}
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for public_key in public_keys:
+                result = await asgi_request(app, "GET", f"/files/{public_key}")
+                assert result.status == 200, result.status
+            single_seconds.append(time.perf_counter() - start)
+
+            for format, seconds in archive_seconds.items():
+                body = json.dumps({"publicKeys": public_keys, "format": format}).encode()
+                start = time.perf_counter()
+                result = await asgi_request(app, "POST", "/files/archive", body, {"content-type": "application/json"})
+                assert result.status == 200 and result.body_size > count * size, result.status
+                seconds.append(time.perf_counter() - start)
+
+        results.append(
+            {
+                "files": count,
+                "file_size_bytes": size,
+                "single_requests_seconds": round(min(single_seconds), 4),
+                "zip_archive_seconds": round(min(archive_seconds["zip"]), 4),
+                "tar_archive_seconds": round(min(archive_seconds["tar"]), 4),
+            }
+        )
+
+    SavedFilesHandler().clean_up_files()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="50,200")
+    parser.add_argument("--size", default="64KB")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    counts = [int(count) for count in args.counts.split(",")]
+    results = asyncio.run(run_benchmark(counts, parse_size(args.size), args.repeat))
+    write_results("archive_download", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
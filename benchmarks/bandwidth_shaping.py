@@ -0,0 +1,132 @@
+# measures what bandwidth shaping (BANDWIDTH_HOST_KB_PER_SEC, BANDWIDTH_GLOBAL_KB_PER_SEC) does to the p50/p99
+# latency of small downloads from many hosts while one host downloads large files as fast as it can, and how fast
+# the large downloads go, with shaping off, with only the host buckets and with the host and global buckets.
+# the requests go straight to the ASGI app, so without shaping the large downloads are only bound by the disk and CPU
+#
+# usage: python -m benchmarks.bandwidth_shaping --large-size 16MB --large-count 4 --host-rate 8MB --global-rate 16MB
+import os, json, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request, build_multipart_body
+from benchmarks.common import get_host_address, summarize_latencies
+
+
+# downloads the large file from one host with large_count requests at a time, and the small files from
+# small_hosts other hosts one request at a time each, for the given seconds; returns the latencies of the small
+# downloads, and the bytes of the large downloads with the time they took
+async def run_downloads(
+    app, large_key: str, small_keys: list[str], large_count: int, small_hosts: int, seconds: float
+) -> tuple[list[float], int, float]:
+    start = time.perf_counter()
+    stop = start + seconds
+    latencies = []
+    large_bytes = 0
+
+    async def download_large(port: int):
+        nonlocal large_bytes
+        while time.perf_counter() < stop:
+            result = await asgi_request(app, "GET", f"/files/{large_key}", client=(get_host_address(0), port))
+            assert result.status == 200, result.status
+            large_bytes += result.body_size
+
+    async def download_small(index: int):
+        i = 0
+        while time.perf_counter() < stop:
+            public_key = small_keys[i % len(small_keys)]
+            request_start = time.perf_counter()
+            result = await asgi_request(app, "GET", f"/files/{public_key}", client=(get_host_address(index), 50000))
+            assert result.status == 200, result.status
+            latencies.append(time.perf_counter() - request_start)
+            i += 1
+            await asyncio.sleep(0.001)  # a request every millisecond or so, like a client would send them
+
+    tasks = [download_large(50000 + i) for i in range(large_count)]
+    tasks += [download_small(1 + i) for i in range(small_hosts)]
+    await asyncio.gather(*tasks)
+    return latencies, large_bytes, time.perf_counter() - start
+
+
+async def run_benchmark(
+    large_size: int,
+    large_count: int,
+    small_size: int,
+    small_hosts: int,
+    host_rate: int,
+    global_rate: int,
+    seconds: float,
+) -> list[dict]:
+    from app import app
+    from app.common import settings
+    from app.utils import SavedFilesHandler, bandwidth_handler, quota_handler
+
+    SavedFilesHandler().clean_up_files()
+    quota_handler.reset()
+
+    async def upload(filename: str, contents: bytes) -> str:
+        body, content_type = build_multipart_body(filename, contents)
+        result = await asgi_request(app, "POST", "/files/", body, {"content-type": content_type}, keep_body=True)
+        return json.loads(result.body)["publicKey"]
+
+    large_key = await upload("large.bin", os.urandom(large_size))
+    small_keys = [await upload(f"small{i}.bin", os.urandom(small_size)) for i in range(10)]
+
+    # shaping -> (host rate, global rate) in KB per second
+    scenarios = {
+        "off": (0, 0),
+        "host": (host_rate // 1024, 0),
+        "host_and_global": (host_rate // 1024, global_rate // 1024),
+    }
+    results = []
+    for shaping, (host_kb_per_sec, global_kb_per_sec) in scenarios.items():
+        settings.BANDWIDTH_HOST_KB_PER_SEC = host_kb_per_sec
+        settings.BANDWIDTH_GLOBAL_KB_PER_SEC = global_kb_per_sec
+        for count in (0, large_count):
+            bandwidth_handler.reset()
+            latencies, large_bytes, elapsed = await run_downloads(
+                app, large_key, small_keys, count, small_hosts, seconds
+            )
+            results.append(
+                {
+                    "shaping": shaping,
+                    "large_downloads": count,
+                    "large_file_size_bytes": large_size,
+                    "small_file_size_bytes": small_size,
+                    "small_hosts": small_hosts,
+                    "small_requests": len(latencies),
+                    **{f"small_{key}": value for key, value in summarize_latencies(latencies).items()},
+                    "large_mb_per_sec": round(large_bytes / elapsed / (1024 * 1024), 2),
+                }
+            )
+
+    SavedFilesHandler().clean_up_files()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--large-size", default="16MB")
+    parser.add_argument("--large-count", type=int, default=4, help="large downloads of the same host at a time")
+    parser.add_argument("--small-size", default="4KB")
+    parser.add_argument("--small-hosts", type=int, default=8)
+    parser.add_argument("--host-rate", default="8MB", help="BANDWIDTH_HOST_KB_PER_SEC of the shaped runs, per second")
+    parser.add_argument("--global-rate", default="16MB", help="BANDWIDTH_GLOBAL_KB_PER_SEC of the shaped runs")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    results = asyncio.run(
+        run_benchmark(
+            parse_size(args.large_size),
+            args.large_count,
+            parse_size(args.small_size),
+            args.small_hosts,
+            parse_size(args.host_rate),
+            parse_size(args.global_rate),
+            args.seconds,
+        )
+    )
+    write_results("bandwidth_shaping", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# compares uploading and deleting a batch of small files one request per file with POST /files/batch and
+# DELETE /files/batch, against the number of files in the batch; the requests go straight to the ASGI app
+#
+# usage: python -m benchmarks.batch_requests --counts 10,100,1000 --size 4KB
+import os, json, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request
+from benchmarks.common import build_multipart_body, build_multipart_batch_body
+
+
+async def run_benchmark(counts: list[int], size: int) -> list[dict]:
+    from app import app
+    from app.utils import SavedFilesHandler, quota_handler
+
+    results = []
+    for count in counts:
+        SavedFilesHandler().clean_up_files()
+        quota_handler.reset()
+        files = [(f"file{i}.bin", os.urandom(size)) for i in range(count)]
+
+        start = time.perf_counter()
+        private_keys = []
+        for filename, contents in files:
+            body, content_type = build_multipart_body(filename, contents)
+            result = await asgi_request(app, "POST", "/files/", body, {"content-type": content_type}, keep_body=True)
+            private_keys.append(json.loads(result.body)["privateKey"])
+        single_upload_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for private_key in private_keys:
+            result = await asgi_request(app, "DELETE", f"/files/{private_key}")
+            assert result.status == 200, result.status
+        single_delete_seconds = time.perf_counter() - start
+
+        body, content_type = build_multipart_batch_body(files)
+        start = time.perf_counter()
+        result = await asgi_request(app, "POST", "/files/batch", body, {"content-type": content_type}, keep_body=True)
+        batch_upload_seconds = time.perf_counter() - start
+        private_keys = [item["privateKey"] for item in json.loads(result.body)["files"]]
+
+        body = json.dumps({"privateKeys": private_keys}).encode()
+        start = time.perf_counter()
+        result = await asgi_request(app, "DELETE", "/files/batch", body, {"content-type": "application/json"})
+        batch_delete_seconds = time.perf_counter() - start
+        assert result.status == 200, result.status
+
+        results.append(
+            {
+                "files": count,
+                "file_size_bytes": size,
+                "single_upload_seconds": round(single_upload_seconds, 4),
+                "batch_upload_seconds": round(batch_upload_seconds, 4),
+                "single_delete_seconds": round(single_delete_seconds, 4),
+                "batch_delete_seconds": round(batch_delete_seconds, 4),
+            }
+        )
+
+    SavedFilesHandler().clean_up_files()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="10,100,1000")
+    parser.add_argument("--size", default="4KB")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    counts = [int(count) for count in args.counts.split(",")]
+    results = asyncio.run(run_benchmark(counts, parse_size(args.size)))
+    write_results("batch_requests", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
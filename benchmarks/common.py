@@ -0,0 +1,228 @@
+import os, sys, json, time, resource, tempfile
+from typing import Iterable
+
+# the app reads its settings from the environment as soon as it is imported;
+# benchmarks default to a throwaway upload folder so they never touch real files
+def configure_environment():
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("FOLDER", tempfile.mkdtemp(prefix="fss-bench-"))
+    os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(prefix="fss-bench-db-"), "db.sqlite3"))
+    os.environ.setdefault("HOST", "127.0.0.1")
+    os.environ.setdefault("PORT", "8000")
+    os.environ.setdefault("DAILY_LIMIT_MB", str(10**9))
+    os.environ.setdefault("CLEANUP_AFTER_MINS_INACTIVITY", str(10**6))
+
+
+# returns the peak resident set size of the current process in bytes
+def get_peak_rss() -> int:
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss_kb * 1024
+
+
+# converts sizes like 10MB, 1GB or 512KB to bytes
+def parse_size(size: str) -> int:
+    units = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+    size = size.upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * multiplier)
+
+    return int(size)
+
+
+# creates a file of the given size filled with pseudo random data, written in chunks to keep memory flat
+def create_sample_file(path: str, size: int, chunk_size: int = 1024 * 1024):
+    block = os.urandom(chunk_size)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[: min(chunk_size, remaining)])
+            remaining -= chunk_size
+
+
+# writes count small files straight into the upload folder, without going through the app, and returns their
+# public keys; the store is emptied first. the index must be built again to see them
+def fill_store(count: int) -> list[str]:
+    from app.utils import BlobStorage, CryptoHandler, SavedFileRecord, SavedFilesHandler, snapshot_handler
+
+    crypto_handler = CryptoHandler()
+    SavedFilesHandler().clean_up_files()
+    public_keys = []
+    for i in range(count):
+        contents = str(i).encode()
+        public_key = crypto_handler.calculate_public_key(contents)
+        public_keys.append(public_key)
+        BlobStorage.write_record(SavedFileRecord(public_key, [f"file{i}.txt"], len(contents)))
+        with open(BlobStorage.get_blob_path(public_key), "wb") as f:
+            f.write(contents)
+
+    snapshot_handler.remove()  # the files were not saved through the index, so it must scan them
+    return public_keys
+
+
+# returns the ip address of the nth host; the whole 127.0.0.0/8 block is loopback, so clients can send from any of them
+def get_host_address(index: int) -> str:
+    index += 1
+    return f"127.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}"
+
+
+# resets the quota database and adds count hosts that used a byte today, the first count of get_host_address
+def fill_hosts(count: int):
+    from app.common import database
+    from app.utils import quota_handler
+
+    quota_handler.reset()
+    database.increment_hosts_used_size({get_host_address(i): 1 for i in range(count)})
+
+
+# prints the results as JSON; also writes them to a file when an output path is given
+def write_results(name: str, results: list[dict], output: str = ""):
+    report = {"benchmark": name, "timestamp": time.time(), "python": sys.version.split()[0], "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+
+
+# builds a multipart/form-data body with a single file field, the same way a browser or requests would
+def build_multipart_body(filename: str, contents: bytes, field: str = "file") -> tuple[bytes, str]:
+    boundary = "benchmarkboundary" + os.urandom(8).hex()
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    return head + contents + tail, f"multipart/form-data; boundary={boundary}"
+
+
+# builds a multipart/form-data body with one file field for every (filename, contents), all under the same field name
+def build_multipart_batch_body(files: list[tuple[str, bytes]], field: str = "files") -> tuple[bytes, str]:
+    boundary = "benchmarkboundary" + os.urandom(8).hex()
+    parts = []
+    for filename, contents in files:
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        parts.append(head + contents + b"\r\n")
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+# yields size bytes of the block repeated, in pieces of the block's size
+def generate_body(block: bytes, size: int):
+    remaining = size
+    while remaining > 0:
+        yield block[: min(len(block), remaining)]
+        remaining -= len(block)
+
+
+# yields a multipart/form-data body with a single file field around the generated contents
+def generate_multipart_body(block: bytes, size: int, boundary: str):
+    yield (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    yield from generate_body(block, size)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+# the outcome of a request sent straight to an ASGI app
+class ASGIResult:
+    status: int
+    headers: dict[str, str]
+    body_size: int
+    body: bytes
+
+    def __init__(self) -> None:
+        self.status = 0
+        self.headers = {}
+        self.body_size = 0
+        self.body = b""
+
+
+# sends one request straight to an ASGI app, without a server or a socket in between;
+# the body is delivered in chunks like a server would, and the response body is only kept when keep_body is set
+# the body can also be an iterable of chunks, so large bodies never have to be held in memory; the caller then
+# passes the content-length header if the app needs it
+async def asgi_request(
+    app,
+    method: str,
+    path: str,
+    body: bytes | Iterable[bytes] = b"",
+    headers: dict[str, str] = {},
+    client: tuple[str, int] = ("127.0.0.1", 50000),
+    chunk_size: int = 64 * 1024,
+    keep_body: bool = False,
+    extensions: dict = {},
+) -> ASGIResult:
+    import asyncio
+
+    if isinstance(body, bytes):
+        headers = {"content-length": str(len(body)), **headers}
+        body = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+    headers = {"host": "testserver", **headers}
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+        "client": client,
+        "server": ("testserver", 80),
+        "extensions": extensions,
+    }
+
+    chunks = iter(body)
+    next_chunk = next(chunks, b"")
+    is_body_complete = False
+    disconnected = asyncio.Event()  # the client stays connected until the response is complete
+
+    async def receive():
+        nonlocal next_chunk, is_body_complete
+        if not is_body_complete:
+            chunk, next_chunk = next_chunk, next(chunks, None)
+            is_body_complete = next_chunk is None
+            return {"type": "http.request", "body": chunk, "more_body": not is_body_complete}
+
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    result = ASGIResult()
+    body_parts = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            result.status = message["status"]
+            result.headers = {key.decode(): value.decode() for key, value in message["headers"]}
+        elif message["type"] == "http.response.body":
+            result.body_size += len(message.get("body", b""))
+            if keep_body:
+                body_parts.append(message.get("body", b""))
+        elif message["type"] == "http.response.zerocopysend":
+            result.body_size += message.get("count") or 0
+
+    await app(scope, receive, send)
+    disconnected.set()
+    result.body = b"".join(body_parts)
+    return result
+
+
+# returns the median and 99th percentile of latencies (in seconds) as milliseconds
+def summarize_latencies(latencies: list[float]) -> dict:
+    import statistics
+
+    latencies = sorted(latencies)
+    p99_index = min(len(latencies) - 1, int(len(latencies) * 0.99))
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[p99_index] * 1000, 3),
+    }
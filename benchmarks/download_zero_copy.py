@@ -0,0 +1,92 @@
+# compares CPU time and throughput of downloads sent in chunks with downloads handed to the server through the
+# http.response.zerocopysend extension; the benchmark plays the server and writes every byte to /dev/null,
+# with os.write for body messages and os.sendfile for zero-copy messages
+#
+# usage: python -m benchmarks.download_zero_copy --size 1GB --repeat 3
+import os, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, create_sample_file, write_results
+
+
+# sends one download of the public key to the app and copies the body to the sink like a server would
+async def download(app, public_key: str, sink: int, zero_copy: bool) -> int:
+    sent_size = 0
+
+    async def receive():
+        await asyncio.Event().wait()  # the client never disconnects
+
+    async def send(message):
+        nonlocal sent_size
+        if message["type"] == "http.response.body":
+            sent_size += os.write(sink, message.get("body", b"")) if message.get("body") else 0
+        elif message["type"] == "http.response.zerocopysend":
+            offset, count = message["offset"], message["count"]
+            while count > 0:
+                written = os.sendfile(sink, message["file"].fileno(), offset, count)
+                offset += written
+                count -= written
+                sent_size += written
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": f"/files/{public_key}",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("127.0.0.1", 50000),
+        "extensions": {"http.response.zerocopysend": {}} if zero_copy else {},
+    }
+    await app(scope, receive, send)
+    return sent_size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="1GB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    from fastapi import UploadFile
+    from app import app
+    from app.common import settings
+    from app.utils import FileUploadHandler, SavedFilesHandler, quota_handler
+
+    source_path = os.path.join(settings.FOLDER, ".benchmark-source")
+    create_sample_file(source_path, parse_size(args.size))
+    with open(source_path, "rb") as f:
+        upload_handler = FileUploadHandler(UploadFile(file=f, filename="download.bin"))
+        upload_handler.save_file()
+    os.remove(source_path)
+
+    results = []
+    sink = os.open(os.devnull, os.O_WRONLY)
+    for zero_copy in (False, True):
+        for _ in range(args.repeat):
+            quota_handler.reset()
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            sent_size = asyncio.run(download(app, upload_handler.public_key, sink, zero_copy))
+            cpu_seconds, wall_seconds = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+            gigabytes = sent_size / (1024**3)
+            results.append(
+                {
+                    "path": "zerocopysend" if zero_copy else "chunked",
+                    "size_bytes": sent_size,
+                    "wall_seconds": round(wall_seconds, 4),
+                    "cpu_seconds": round(cpu_seconds, 4),
+                    "cpu_seconds_per_gb": round(cpu_seconds / gigabytes, 4),
+                    "throughput_mb_s": round(sent_size / (1024 * 1024) / wall_seconds, 2),
+                }
+            )
+    os.close(sink)
+
+    SavedFilesHandler().clean_up_files()
+    write_results("download_zero_copy", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# compares the latency of multipart uploads to POST /files/ hashed by the thread engine (the hash pool)
+# and by the process engine (worker processes), against the file size and the number of concurrent uploads;
+# the bodies are generated on the fly so they are never held in memory
+#
+# usage: python -m benchmarks.hashing_engines --sizes 64MB,256MB,1GB --concurrency 1,4
+import os, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request
+from benchmarks.common import generate_multipart_body
+
+
+# sends one multipart upload of the size and returns its latency in seconds
+async def upload(app, size: int) -> float:
+    block = os.urandom(64 * 1024)  # new contents for every upload so nothing is deduplicated
+    boundary = "benchmarkboundary" + os.urandom(8).hex()
+    content_length = size + sum(len(part) for part in generate_multipart_body(b"", 0, boundary))
+    headers = {"content-type": f"multipart/form-data; boundary={boundary}", "content-length": str(content_length)}
+
+    start = time.perf_counter()
+    result = await asgi_request(app, "POST", "/files/", generate_multipart_body(block, size, boundary), headers)
+    assert result.status == 200, result.status
+    return time.perf_counter() - start
+
+
+# sends the uploads at the same time and returns their latencies
+async def upload_concurrently(app, size: int, concurrency: int) -> list[float]:
+    return await asyncio.gather(*(upload(app, size) for _ in range(concurrency)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="64MB,256MB,1GB")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    from app import app
+    from app.common import settings
+    from app.utils import SavedFilesHandler, HashingHandler, quota_handler
+
+    settings.HASH_PROCESS_MIN_MB = 0  # with the process engine, every upload of the benchmark is hashed in a process
+
+    results = []
+    for engine in ("thread", "process"):
+        settings.HASH_ENGINE = engine
+        HashingHandler.start()
+        for size in [parse_size(size) for size in args.sizes.split(",")]:
+            for concurrency in [int(concurrency) for concurrency in args.concurrency.split(",")]:
+                SavedFilesHandler().clean_up_files()
+                quota_handler.reset()
+
+                wall_start = time.perf_counter()
+                latencies = asyncio.run(upload_concurrently(app, size, concurrency))
+                wall_seconds = time.perf_counter() - wall_start
+
+                results.append(
+                    {
+                        "engine": engine,
+                        "size_bytes": size,
+                        "concurrency": concurrency,
+                        "mean_latency_seconds": round(sum(latencies) / len(latencies), 4),
+                        "max_latency_seconds": round(max(latencies), 4),
+                        "throughput_mb_s": round(size * concurrency / (1024 * 1024) / wall_seconds, 2),
+                    }
+                )
+
+    HashingHandler.shutdown()
+    SavedFilesHandler().clean_up_files()
+    write_results("hashing_engines", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
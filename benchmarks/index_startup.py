@@ -0,0 +1,76 @@
+# measures how long building the index takes when the server starts, against the number of stored files:
+# scanning the upload folder, scanning it and saving the snapshot, which is what the first start does,
+# and loading the index back from the snapshot, which is what every later start does
+#
+# usage: python -m benchmarks.index_startup --counts 100000,1000000 --journal 10000
+import io, os, argparse, time
+
+from benchmarks.common import configure_environment, write_results, fill_store
+
+
+def run_benchmark(counts: list[int], journal_count: int) -> list[dict]:
+    from fastapi import UploadFile
+    from app.common import settings
+    from app.utils import SavedFilesHandler, FileUploadHandler, saved_files_index, snapshot_handler
+    from app.utils.snapshots import snapshot_path, journal_path
+
+    results = []
+    for count in counts:
+        fill_store(count)
+
+        settings.INDEX_SNAPSHOT = False
+        start = time.perf_counter()
+        saved_files_index.build()
+        scan_seconds = time.perf_counter() - start
+
+        settings.INDEX_SNAPSHOT = True
+        start = time.perf_counter()
+        saved_files_index.build()
+        scan_and_save_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        saved_files_index.build()
+        load_seconds = time.perf_counter() - start
+        snapshot_size = os.path.getsize(snapshot_path)
+
+        # changes made after the snapshot was saved are replayed from the journal
+        for i in range(journal_count):
+            upload_file = UploadFile(file=io.BytesIO(b"journal %d" % i), filename=f"journal{i}.txt")
+            FileUploadHandler(upload_file).save_file()
+        start = time.perf_counter()
+        saved_files_index.build()
+        load_with_journal_seconds = time.perf_counter() - start
+        assert len(saved_files_index.records) == count + journal_count
+
+        results.append(
+            {
+                "stored_files": count,
+                "scan_seconds": round(scan_seconds, 3),
+                "scan_and_save_seconds": round(scan_and_save_seconds, 3),
+                "snapshot_load_seconds": round(load_seconds, 3),
+                "snapshot_size_bytes": snapshot_size,
+                "journal_entries": journal_count,
+                "journal_size_bytes": os.path.getsize(journal_path),
+                "snapshot_and_journal_load_seconds": round(load_with_journal_seconds, 3),
+            }
+        )
+
+    SavedFilesHandler().clean_up_files()
+    snapshot_handler.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="100000,1000000")
+    parser.add_argument("--journal", type=int, default=10000, help="changes made after the snapshot was saved")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    counts = [int(count) for count in args.counts.split(",")]
+    write_results("index_startup", run_benchmark(counts, args.journal), args.output)
+
+
+if __name__ == "__main__":
+    main()
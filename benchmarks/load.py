@@ -0,0 +1,244 @@
+# load test of the file server: throughput, p50/p99 latency and peak RSS of multipart uploads and of downloads,
+# and how they scale with the number of stored files, the number of hosts in the quota database, the file size
+# and the number of concurrent clients. every dimension is swept on its own, starting from a baseline made of
+# the first value of every list. every run starts from a fresh store in its own process, and sends the requests
+# either straight to the ASGI app in that process or over HTTP to a local uvicorn server it starts
+#
+# usage: python -m benchmarks.load --target asgi --sizes 4KB,1MB,16MB --concurrency 1,8,32
+#        python -m benchmarks.load --target uvicorn --stored-files 0,100000 --hosts 1,100000
+import os, sys, json, socket, argparse, asyncio, subprocess, threading, time, http.client
+
+from benchmarks.common import configure_environment, get_peak_rss, parse_size, write_results, asgi_request
+from benchmarks.common import build_multipart_body, summarize_latencies, fill_store, fill_hosts, get_host_address
+
+
+# returns the body of the nth upload; the first bytes differ between uploads so nothing is deduplicated
+def make_upload_body(block: bytes, index: int) -> tuple[bytes, str]:
+    return build_multipart_body(f"load{index}.bin", index.to_bytes(16, "big") + block[16:])
+
+
+# sends count requests from concurrency clients to the ASGI app; every client sends from its own host.
+# send(client, index) sends one request. returns the latencies and the wall time in seconds
+async def run_asgi_clients(send, count: int, concurrency: int) -> tuple[list[float], float]:
+    latencies = []
+    next_index = 0
+
+    async def run_client(client: int):
+        nonlocal next_index
+        while next_index < count:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            await send(client, index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(client) for client in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+# sends count requests from concurrency client threads, every one with its own keep-alive connection from its own
+# host; send(connection, index) sends one request. returns the latencies and the wall time in seconds
+def run_http_clients(port: int, hosts: int, send, count: int, concurrency: int) -> tuple[list[float], float]:
+    latencies = []
+    lock = threading.Lock()
+    next_index = 0
+
+    def run_client(client: int):
+        nonlocal next_index
+        source_address = (get_host_address(client % hosts), 0)
+        connection = http.client.HTTPConnection("127.0.0.1", port, source_address=source_address)
+        while True:
+            with lock:
+                index = next_index
+                next_index += 1
+            if index >= count:
+                break
+            start = time.perf_counter()
+            send(connection, index)
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    threads = [threading.Thread(target=run_client, args=(client,)) for client in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+# runs the uploads and then the downloads against the ASGI app; returns the latencies and wall times of both
+# and the peak RSS of this process
+def run_asgi(config: dict) -> tuple[tuple[list[float], float], tuple[list[float], float], int]:
+    from app import app
+    from app.utils import saved_files_index
+
+    saved_files_index.build()
+    block = os.urandom(config["size"])
+    public_keys = [""] * config["requests"]
+
+    async def upload(client: int, index: int):
+        body, content_type = make_upload_body(block, index)
+        client_address = (get_host_address(client % config["hosts"]), 50000)
+        headers = {"content-type": content_type}
+        result = await asgi_request(app, "POST", "/files/", body, headers, client_address, keep_body=True)
+        assert result.status == 200, result.status
+        public_keys[index] = json.loads(result.body)["publicKey"]
+
+    async def download(client: int, index: int):
+        client_address = (get_host_address(client % config["hosts"]), 50000)
+        result = await asgi_request(app, "GET", f"/files/{public_keys[index]}", client=client_address)
+        assert result.status == 200 and result.body_size == config["size"], result.status
+
+    uploads = asyncio.run(run_asgi_clients(upload, config["requests"], config["concurrency"]))
+    downloads = asyncio.run(run_asgi_clients(download, config["requests"], config["concurrency"]))
+    return uploads, downloads, get_peak_rss()
+
+
+# returns a port nothing listens on
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# returns the peak resident set size of another process in bytes; 0 where /proc is not available
+def get_process_peak_rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+# starts a uvicorn server on the app and waits until it answers; it builds the index of the filled store at startup
+def start_server(port: int) -> subprocess.Popen:
+    command = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port)]
+    server = subprocess.Popen(command + ["--log-level", "warning"], env=os.environ)
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/metrics")
+            connection.getresponse().read()
+            connection.close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("the server stopped before answering")
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("the server did not answer in time")
+
+
+# runs the uploads and then the downloads against a local uvicorn server; returns the latencies and wall times
+# of both and the peak RSS of the server
+def run_uvicorn(config: dict) -> tuple[tuple[list[float], float], tuple[list[float], float], int]:
+    port = get_free_port()
+    server = start_server(port)
+    block = os.urandom(config["size"])
+    public_keys = [""] * config["requests"]
+
+    def upload(connection: http.client.HTTPConnection, index: int):
+        body, content_type = make_upload_body(block, index)
+        connection.request("POST", "/files/", body, {"content-type": content_type})
+        response = connection.getresponse()
+        response_body = response.read()
+        assert response.status == 200, response.status
+        public_keys[index] = json.loads(response_body)["publicKey"]
+
+    def download(connection: http.client.HTTPConnection, index: int):
+        connection.request("GET", f"/files/{public_keys[index]}")
+        response = connection.getresponse()
+        assert response.status == 200 and len(response.read()) == config["size"], response.status
+
+    try:
+        uploads = run_http_clients(port, config["hosts"], upload, config["requests"], config["concurrency"])
+        downloads = run_http_clients(port, config["hosts"], download, config["requests"], config["concurrency"])
+        peak_rss = get_process_peak_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return uploads, downloads, peak_rss
+
+
+# runs a single configuration in this process and prints the measurements as JSON
+def run_single(config: dict):
+    configure_environment()
+
+    from app.utils import SavedFilesHandler
+
+    fill_store(config["stored_files"])
+    fill_hosts(config["hosts"])
+    run = run_uvicorn if config["target"] == "uvicorn" else run_asgi
+    (upload_latencies, upload_seconds), (download_latencies, download_seconds), peak_rss = run(config)
+    SavedFilesHandler().clean_up_files()
+
+    transferred_mb = config["size"] * config["requests"] / (1024 * 1024)
+    result = {
+        **config,
+        "upload_throughput_mb_s": round(transferred_mb / upload_seconds, 2),
+        "upload_rps": round(config["requests"] / upload_seconds, 1),
+        "upload_latency": summarize_latencies(upload_latencies),
+        "download_throughput_mb_s": round(transferred_mb / download_seconds, 2),
+        "download_rps": round(config["requests"] / download_seconds, 1),
+        "download_latency": summarize_latencies(download_latencies),
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 2),
+    }
+    print(json.dumps(result))
+
+
+# returns the configurations to run: the baseline, then every other value of every dimension on its own
+def get_configs(args) -> list[dict]:
+    dimensions = {
+        "size": [parse_size(size) for size in args.sizes.split(",")],
+        "concurrency": [int(concurrency) for concurrency in args.concurrency.split(",")],
+        "stored_files": [int(count) for count in args.stored_files.split(",")],
+        "hosts": [int(count) for count in args.hosts.split(",")],
+    }
+    baseline = {name: values[0] for name, values in dimensions.items()}
+    baseline.update({"target": args.target, "requests": args.requests})
+
+    configs = [{"dimension": "baseline", **baseline}]
+    for name, values in dimensions.items():
+        for value in values[1:]:
+            configs.append({"dimension": name, **baseline, name: value})
+
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--sizes", default="4KB,1MB,16MB")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--stored-files", default="0,10000,100000")
+    parser.add_argument("--hosts", default="1,1000,100000")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--output", default="")
+    parser.add_argument("--single", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(json.loads(args.single))
+        return
+
+    configure_environment()
+    results = []
+    for config in get_configs(args):
+        command = [sys.executable, "-m", "benchmarks.load", "--single", json.dumps(config)]
+        output = subprocess.run(command, check=True, capture_output=True, text=True, env=os.environ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    write_results("load", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# measures the latency of GET and DELETE requests on /files against the number of stored files;
+# the store is filled with small files written straight into the upload folder before the index is built
+#
+# usage: python -m benchmarks.lookup_latency --counts 1000 10000 50000 --requests 200
+import argparse, time
+
+from benchmarks.common import configure_environment, write_results, summarize_latencies, fill_store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", nargs="+", type=int, default=[1000, 10000, 50000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    from fastapi.testclient import TestClient
+    from app import app
+    from app.utils import SavedFilesHandler, saved_files_index, quota_handler
+
+    client = TestClient(app)
+    files_handler = SavedFilesHandler()
+
+    results = []
+    for count in args.counts:
+        public_keys = fill_store(count)
+
+        start = time.perf_counter()
+        saved_files_index.build()
+        build_seconds = time.perf_counter() - start
+
+        get_latencies = []
+        delete_latencies = []
+        for i in range(args.requests):
+            quota_handler.reset()  # keep the daily limit out of the way
+            public_key = public_keys[(i * 7919) % count]
+
+            start = time.perf_counter()
+            client.get(f"/files/{public_key}")
+            get_latencies.append(time.perf_counter() - start)
+
+            # delete a key that does not exist; this is the worst case for a scan since nothing matches
+            start = time.perf_counter()
+            client.delete(f"/files/{'0' * 64}")
+            delete_latencies.append(time.perf_counter() - start)
+
+        results.append(
+            {
+                "stored_files": count,
+                "index_build_seconds": round(build_seconds, 4),
+                "get": summarize_latencies(get_latencies),
+                "delete": summarize_latencies(delete_latencies),
+            }
+        )
+
+    files_handler.clean_up_files()
+    write_results("lookup_latency", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# micro-benchmarks of the pieces every request goes through: SavedFilesHandler lookups against the number of
+# stored files, Database.get_db against the number of hosts in the quota database, and CryptoHandler against
+# the size of the contents. every call is repeated for at least --seconds and reported in microseconds
+#
+# usage: python -m benchmarks.micro --stored-files 1000,100000 --hosts 1,1000,100000 --sizes 1KB,1MB,16MB
+import os, argparse, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, fill_store, fill_hosts
+
+
+# calls the function over and over for at least min_seconds and returns the mean time of a call in microseconds
+def measure(func, min_seconds: float) -> float:
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            func()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return round(elapsed / calls * 1000 * 1000, 3)
+        batch *= 2
+
+
+# lookups of SavedFilesHandler, the ones the download and delete routes make, for hits and misses
+def benchmark_saved_files_handler(stored_files: list[int], min_seconds: float) -> list[dict]:
+    from app.utils import SavedFilesHandler, CryptoHandler, BlobStorage, saved_files_index
+
+    crypto_handler = CryptoHandler()
+    files_handler = SavedFilesHandler()
+    results = []
+    for count in stored_files:
+        public_keys = fill_store(count)
+        saved_files_index.build()
+        public_key = public_keys[count // 2]
+        private_key = crypto_handler.calculate_private_key(public_key)
+        filepath = BlobStorage.get_blob_path(public_key)
+        missing_key = "0" * 64
+
+        lookups = {
+            "get_filepath_using_public_key": lambda: files_handler.get_filepath_using_public_key(public_key),
+            "get_filepath_using_public_key_miss": lambda: files_handler.get_filepath_using_public_key(missing_key),
+            "get_filename_using_private_key": lambda: files_handler.get_filename_using_private_key(private_key),
+            "get_original_filename": lambda: files_handler.get_original_filename(filepath),
+            "get_file_size": lambda: files_handler.get_file_size(filepath),
+        }
+        for name, lookup in lookups.items():
+            us = measure(lookup, min_seconds)
+            results.append({"function": f"SavedFilesHandler.{name}", "stored_files": count, "us": us})
+
+    files_handler.clean_up_files()
+    return results
+
+
+# Database.get_db reads every host of the current day; the quota handler calls it on every flush
+def benchmark_database(hosts: list[int], min_seconds: float) -> list[dict]:
+    from app.common import database
+
+    results = []
+    for count in hosts:
+        fill_hosts(count)
+        results.append({"function": "Database.get_db", "hosts": count, "us": measure(database.get_db, min_seconds)})
+
+    fill_hosts(0)
+    return results
+
+
+# the public key is a hash of the contents; the private key is a hmac of the public key
+def benchmark_crypto_handler(sizes: list[int], min_seconds: float) -> list[dict]:
+    from app.utils import CryptoHandler
+
+    crypto_handler = CryptoHandler()
+    results = []
+    for size in sizes:
+        contents = os.urandom(size)
+        us = measure(lambda: crypto_handler.calculate_public_key(contents), min_seconds)
+        throughput_mb_s = round(size / (1024 * 1024) / (us / (1000 * 1000)), 2)
+        results.append(
+            {
+                "function": "CryptoHandler.calculate_public_key",
+                "size_bytes": size,
+                "us": us,
+                "throughput_mb_s": throughput_mb_s,
+            }
+        )
+
+    public_key = crypto_handler.calculate_public_key(b"")
+    us = measure(lambda: crypto_handler.calculate_private_key(public_key), min_seconds)
+    results.append({"function": "CryptoHandler.calculate_private_key", "us": us})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stored-files", default="1000,100000")
+    parser.add_argument("--hosts", default="1,1000,100000")
+    parser.add_argument("--sizes", default="1KB,1MB,16MB")
+    parser.add_argument("--seconds", type=float, default=0.5)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    results = []
+    results += benchmark_saved_files_handler([int(count) for count in args.stored_files.split(",")], args.seconds)
+    results += benchmark_database([int(count) for count in args.hosts.split(",")], args.seconds)
+    results += benchmark_crypto_handler([parse_size(size) for size in args.sizes.split(",")], args.seconds)
+    write_results("micro", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# measures requests per second for small downloads and for uploads against the ASGI app directly;
+# the "base_http" stack adds two pass-through BaseHTTPMiddleware layers on top of the app, which is what the
+# activity and limits middlewares cost before they were rewritten as plain ASGI middlewares
+#
+# usage: python -m benchmarks.middleware_throughput --requests 2000 --concurrency 32
+import os, json, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, write_results, asgi_request, build_multipart_body
+
+
+# sends the requests produced by make_request with the given concurrency and returns the requests per second
+async def measure_rps(make_request, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i: int):
+        async with semaphore:
+            result = await make_request(i)
+            assert result.status == 200, result.status
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(i) for i in range(requests)])
+    return requests / (time.perf_counter() - start)
+
+
+async def run_benchmark(requests: int, concurrency: int, download_size: int, upload_size: int) -> list[dict]:
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from app import app
+    from app.utils import SavedFilesHandler, quota_handler
+
+    async def pass_through(request, call_next):
+        return await call_next(request)
+
+    stacks = {
+        "asgi": app,
+        "base_http": BaseHTTPMiddleware(BaseHTTPMiddleware(app, dispatch=pass_through), dispatch=pass_through),
+    }
+
+    # upload the file that is downloaded over and over
+    body, content_type = build_multipart_body("small.bin", os.urandom(download_size))
+    result = await asgi_request(app, "POST", "/files/", body, {"content-type": content_type}, keep_body=True)
+    public_key = json.loads(result.body)["publicKey"]
+
+    upload_bodies = [build_multipart_body(f"upload{i}.bin", os.urandom(upload_size)) for i in range(16)]
+
+    results = []
+    for name, stack in stacks.items():
+        quota_handler.reset()
+
+        async def download(i: int):
+            return await asgi_request(stack, "GET", f"/files/{public_key}")
+
+        async def upload(i: int):
+            body, content_type = upload_bodies[i % len(upload_bodies)]
+            return await asgi_request(stack, "POST", "/files/", body, {"content-type": content_type})
+
+        download_rps = await measure_rps(download, requests, concurrency)
+        upload_rps = await measure_rps(upload, requests // 4, concurrency)
+        results.append({"stack": name, "download_rps": round(download_rps, 1), "upload_rps": round(upload_rps, 1)})
+
+    SavedFilesHandler().clean_up_files()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--download-size", type=int, default=4 * 1024)
+    parser.add_argument("--upload-size", type=int, default=64 * 1024)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    results = asyncio.run(run_benchmark(args.requests, args.concurrency, args.download_size, args.upload_size))
+    write_results("middleware_throughput", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
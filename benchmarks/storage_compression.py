@@ -0,0 +1,119 @@
+# measures what compression at rest (STORAGE_COMPRESSION) saves and costs: the room the saved contents take on the
+# disk, and the CPU time of uploads and of downloads, sent as they are to clients that take the encoding or
+# decompressed for those that do not, for text, CSV, JSON, logs and random bytes that do not compress.
+# zstd is only measured if the zstandard package is installed
+#
+# usage: python -m benchmarks.storage_compression --encodings none,gzip,zstd --count 20 --size 1MB
+import os, sys, json, random, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request, build_multipart_body
+
+
+# returns contents of about size bytes of the kind; the seed makes every file different
+def generate_contents(kind: str, size: int, seed: int) -> bytes:
+    generator = random.Random(seed)
+    levels = ["INFO", "INFO", "INFO", "WARNING", "ERROR"]
+    words = "the file was saved under its public key and downloaded again by another client".split()
+    lines = []
+    length = 0
+    while length < size:
+        if kind == "csv":
+            line = f"{generator.randrange(10**9)},10.0.{generator.randrange(256)}.{generator.randrange(256)},"
+            line += f"{generator.choice(['GET', 'POST', 'DELETE'])},{generator.randrange(100, 600)},"
+            line += f"{generator.random():.6f}"
+        elif kind == "json":
+            record = {"id": generator.randrange(10**9), "name": " ".join(generator.sample(words, 3))}
+            record["score"] = round(generator.random(), 4)
+            line = json.dumps(record)
+        elif kind == "log":
+            line = f"2024-01-{generator.randrange(1, 29):02d} "
+            line += f"{generator.randrange(24):02d}:{generator.randrange(60):02d}"
+            line += f" {generator.choice(levels)} worker-{generator.randrange(8)} "
+            line += " ".join(generator.sample(words, 6))
+        else:
+            return generator.randbytes(size)
+        lines.append(line)
+        length += len(line) + 1
+
+    return "\n".join(lines).encode()[:size]
+
+
+async def run_benchmark(encodings: list[str], kinds: list[str], count: int, size: int) -> list[dict]:
+    from app import app
+    from app.common import settings
+    from app.utils import BlobStorage, SavedFilesHandler, file_cache, quota_handler
+
+    file_cache.clear()
+    settings.FILE_CACHE_MB = 0  # every download reads the disk
+    results = []
+    for encoding in encodings:
+        settings.STORAGE_COMPRESSION = encoding
+        for kind in kinds:
+            SavedFilesHandler().clean_up_files()
+            quota_handler.reset()
+            files = [generate_contents(kind, size, seed) for seed in range(count)]
+
+            start, start_cpu = time.perf_counter(), time.process_time()
+            public_keys = []
+            for i, contents in enumerate(files):
+                body, content_type = build_multipart_body(f"file{i}.{kind}", contents)
+                headers = {"content-type": content_type}
+                result = await asgi_request(app, "POST", "/files/", body, headers, keep_body=True)
+                public_keys.append(json.loads(result.body)["publicKey"])
+            upload_seconds, upload_cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+
+            stored_size = sum(os.path.getsize(BlobStorage.get_blob_path(public_key)) for public_key in public_keys)
+
+            download_cpu_seconds = {}
+            for accept_encoding in (encoding, "identity"):
+                start_cpu = time.process_time()
+                for public_key in public_keys:
+                    headers = {"accept-encoding": accept_encoding}
+                    result = await asgi_request(app, "GET", f"/files/{public_key}", headers=headers)
+                    assert result.status == 200, result.status
+                download_cpu_seconds[accept_encoding] = time.process_time() - start_cpu
+
+            original_mb = count * size / (1024 * 1024)
+            encoded_cpu_seconds, identity_cpu_seconds = download_cpu_seconds[encoding], download_cpu_seconds["identity"]
+            results.append(
+                {
+                    "encoding": encoding,
+                    "contents": kind,
+                    "files": count,
+                    "file_size_bytes": size,
+                    "stored_bytes": stored_size,
+                    "saving_percent": round(100 - stored_size / (count * size) * 100, 1),
+                    "upload_seconds": round(upload_seconds, 3),
+                    "upload_cpu_ms_per_mb": round(upload_cpu_seconds / original_mb * 1000, 2),
+                    "download_encoded_cpu_ms_per_mb": round(encoded_cpu_seconds / original_mb * 1000, 2),
+                    "download_identity_cpu_ms_per_mb": round(identity_cpu_seconds / original_mb * 1000, 2),
+                }
+            )
+
+    SavedFilesHandler().clean_up_files()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encodings", default="none,gzip,zstd")
+    parser.add_argument("--contents", default="csv,json,log,random")
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--size", default="1MB")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+    from app.utils.compression import zstandard
+
+    encodings = args.encodings.split(",")
+    if "zstd" in encodings and zstandard is None:
+        print("zstandard is not installed, zstd is skipped", file=sys.stderr)
+        encodings.remove("zstd")
+
+    results = asyncio.run(run_benchmark(encodings, args.contents.split(","), args.count, parse_size(args.size)))
+    write_results("storage_compression", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# fills the store with a large number of small files and measures how the sharded layout copes:
+# building the index, looking up files, uploading new files and cleaning up the whole store
+#
+# usage: python -m benchmarks.storage_scale --count 1000000 --samples 1000
+import io, argparse, asyncio, random, time
+
+from benchmarks.common import configure_environment, write_results, summarize_latencies, asgi_request
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    from fastapi import UploadFile
+    from app import app
+    from app.utils import BlobStorage, CryptoHandler, FileUploadHandler, SavedFileRecord, SavedFilesHandler
+    from app.utils import saved_files_index, quota_handler, snapshot_handler
+
+    crypto_handler = CryptoHandler()
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    # write the files straight into the layout; this is not what is being measured
+    start = time.perf_counter()
+    public_keys = []
+    for i in range(args.count):
+        contents = str(i).encode()
+        public_key = crypto_handler.calculate_public_key(contents)
+        public_keys.append(public_key)
+        BlobStorage.write_record(SavedFileRecord(public_key, [f"file{i}.txt"], len(contents)))
+        with open(BlobStorage.get_blob_path(public_key), "wb") as f:
+            f.write(contents)
+    fill_seconds = time.perf_counter() - start
+    snapshot_handler.remove()  # the index scans the files rather than loading the snapshot of the empty store
+
+    start = time.perf_counter()
+    saved_files_index.build()
+    build_seconds = time.perf_counter() - start
+
+    sample_keys = random.sample(public_keys, min(args.samples, len(public_keys)))
+
+    lookup_latencies = []
+    for public_key in sample_keys:
+        start = time.perf_counter()
+        files_handler.get_filepath_using_public_key(public_key)
+        lookup_latencies.append(time.perf_counter() - start)
+
+    async def download_all() -> list[float]:
+        latencies = []
+        for public_key in sample_keys:
+            start = time.perf_counter()
+            await asgi_request(app, "GET", f"/files/{public_key}")
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    quota_handler.reset()
+    download_latencies = asyncio.run(download_all())
+
+    upload_latencies = []
+    for i in range(args.samples):
+        upload_file = UploadFile(file=io.BytesIO(f"new file {i}".encode()), filename=f"new{i}.txt")
+        start = time.perf_counter()
+        FileUploadHandler(upload_file).save_file()
+        upload_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    files_handler.clean_up_files()
+    cleanup_seconds = time.perf_counter() - start
+
+    results = [
+        {
+            "stored_files": args.count,
+            "fill_seconds": round(fill_seconds, 2),
+            "index_build_seconds": round(build_seconds, 3),
+            "lookup": summarize_latencies(lookup_latencies),
+            "download": summarize_latencies(download_latencies),
+            "upload": summarize_latencies(upload_latencies),
+            "cleanup_seconds": round(cleanup_seconds, 2),
+        }
+    ]
+    write_results("storage_scale", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# measures peak memory and throughput of FileUploadHandler for uploads of different sizes;
+# every size runs in its own process so the peak RSS of one run does not leak into the next
+#
+# usage: python -m benchmarks.upload_memory --sizes 10MB 1GB 5GB --output upload_memory.json
+import os, sys, json, argparse, subprocess, tempfile, time
+
+from benchmarks.common import configure_environment, get_peak_rss, parse_size, create_sample_file, write_results
+
+
+# runs a single upload of the sample file and prints the measurements as JSON
+def run_single(path: str):
+    configure_environment()
+
+    from fastapi import UploadFile
+    from app.utils import FileUploadHandler, SavedFilesHandler
+
+    baseline_rss = get_peak_rss()
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        upload_handler = FileUploadHandler(UploadFile(file=f, filename="benchmark.bin"))
+        upload_handler.save_file()
+        elapsed = time.perf_counter() - start
+
+    SavedFilesHandler().clean_up_files()
+
+    size = upload_handler.file_size
+    result = {
+        "size_bytes": size,
+        "seconds": round(elapsed, 4),
+        "throughput_mb_s": round(size / (1024 * 1024) / elapsed, 2),
+        "baseline_rss_mb": round(baseline_rss / (1024 * 1024), 2),
+        "peak_rss_mb": round(get_peak_rss() / (1024 * 1024), 2),
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["10MB", "1GB", "5GB"])
+    parser.add_argument("--output", default="")
+    parser.add_argument("--single", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single)
+        return
+
+    configure_environment()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="fss-bench-src-") as source_dir:
+        for size in args.sizes:
+            path = os.path.join(source_dir, "sample.bin")
+            create_sample_file(path, parse_size(size))
+
+            command = [sys.executable, "-m", "benchmarks.upload_memory", "--single", path]
+            output = subprocess.run(command, check=True, capture_output=True, text=True, env=os.environ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["size"] = size
+            results.append(result)
+            os.remove(path)
+
+    write_results("upload_memory", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# compares throughput and CPU time per GB of uploads sent as the raw body of PUT /files/{filename}
+# with the same uploads sent as multipart to POST /files/; the body is streamed to the app in 64 KB pieces
+# like a server would deliver it, and is generated on the fly so it is never held in memory
+#
+# usage: python -m benchmarks.upload_raw_vs_multipart --size 1GB --repeat 2
+import os, argparse, asyncio, time
+
+from benchmarks.common import configure_environment, parse_size, write_results, asgi_request
+from benchmarks.common import generate_body, generate_multipart_body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="1GB")
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    configure_environment()
+
+    from app import app
+    from app.utils import SavedFilesHandler, quota_handler
+
+    size = parse_size(args.size)
+    results = []
+    for mode in ("multipart", "raw"):
+        for _ in range(args.repeat):
+            SavedFilesHandler().clean_up_files()
+            quota_handler.reset()
+            block = os.urandom(64 * 1024)  # new contents every run so nothing is deduplicated
+
+            if mode == "raw":
+                body = generate_body(block, size)
+                request = asgi_request(app, "PUT", "/files/upload.bin", body, {"content-length": str(size)})
+            else:
+                boundary = "benchmarkboundary" + os.urandom(8).hex()
+                body = generate_multipart_body(block, size, boundary)
+                content_length = size + sum(len(part) for part in generate_multipart_body(b"", 0, boundary))
+                headers = {"content-type": f"multipart/form-data; boundary={boundary}", "content-length": str(content_length)}
+                request = asgi_request(app, "POST", "/files/", body, headers)
+
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            result = asyncio.run(request)
+            cpu_seconds, wall_seconds = time.process_time() - cpu_start, time.perf_counter() - wall_start
+            assert result.status == 200, result.status
+
+            results.append(
+                {
+                    "mode": mode,
+                    "size_bytes": size,
+                    "wall_seconds": round(wall_seconds, 4),
+                    "cpu_seconds": round(cpu_seconds, 4),
+                    "cpu_seconds_per_gb": round(cpu_seconds / (size / 1024**3), 4),
+                    "throughput_mb_s": round(size / (1024 * 1024) / wall_seconds, 2),
+                }
+            )
+
+    SavedFilesHandler().clean_up_files()
+    write_results("upload_raw_vs_multipart", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import time
+
+from app.utils import BlobStorage, snapshot_handler
+
+if __name__ == "__main__":
+    # moves the files saved directly inside the upload folder into the sharded layout (ab/cd/<public key>);
+    # run it once, with the server stopped, before starting a server on a folder created by an older version
+    start = time.time()
+    moved_count = BlobStorage.migrate_flat_files()
+    snapshot_handler.remove()  # the next start scans the folder, so the index sees the files that were moved
+    print(f"Moved {moved_count} files in {round(time.time() - start, 2)} seconds")
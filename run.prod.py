@@ -0,0 +1,27 @@
+import os, importlib.util
+
+import uvicorn
+
+from app.common import settings
+
+
+# returns whether the package is installed; uvloop and httptools are used when they are, they are faster
+# than the event loop and the http parser uvicorn falls back to
+def is_installed(package: str) -> bool:
+    return importlib.util.find_spec(package) is not None
+
+
+if __name__ == "__main__":
+    # this runs the production server only if this file is being run and not imported
+    # it starts WORKERS worker processes (one per CPU if WORKERS is 0) listening on the same port;
+    # the workers share the daily limits and the last activity through the database and the saved files
+    # through the upload folder, and only one of them at a time runs the clean up
+    uvicorn.run(
+        "app:app",
+        host=settings.HOST,  # use the host specified in the environment variable
+        port=settings.PORT,  # use the port specified in the environment variable
+        workers=settings.WORKERS or os.cpu_count() or 1,
+        loop="uvloop" if is_installed("uvloop") else "asyncio",
+        http="httptools" if is_installed("httptools") else "h11",
+        log_level="info",
+    )
@@ -1,8 +1,12 @@
-import os
+import io, os, time, asyncio, hashlib, threading, multiprocessing
 
 from fastapi import UploadFile
-from app.common import settings
-from app.utils import FileUploadHandler, SavedFilesHandler
+from app.common import settings, database
+from app.database import Database
+from app.metrics import MetricsRegistry, format_server_timing
+from app.utils import FileUploadHandler, SavedFilesHandler, CryptoHandler, QuotaHandler, BlobStorage, saved_files_index
+from app.utils import ExecutorHandler, HashingHandler, FileCache, FileLock, SavedFileRecord, eviction_handler
+from app.utils import snapshot_handler, BandwidthHandler, UploadSessionHandler, index_lock
 
 # path to some sample files to be used for testing
 sample_files_dir = os.path.join(os.path.dirname(__file__), "sample_files")
@@ -48,15 +52,14 @@ def test_file_upload_handler():
             assert len(private_key) == 64
 
             upload_handler.save_file()
-            saved_filename = public_key + filename
-            saved_filepath = os.path.join(upload_dir, saved_filename)
+            saved_filepath = BlobStorage.get_blob_path(public_key)  # contents are saved under their public key
 
             # check if the file is successfully saved
             assert os.path.exists(saved_filepath) and os.path.isfile(saved_filepath)
 
             # check if the saved file matches the contents of the uploaded file
             with open(saved_filepath, mode) as saved_file:
-                assert len(upload_handler.file_contents) == len(saved_file.read())
+                assert upload_handler.file_size == len(saved_file.read())
 
 
 def test_saved_files_handler():
@@ -83,8 +86,8 @@ def test_saved_files_handler():
 
             # do a file upload
             upload_handler.save_file()
-            saved_filename = public_key + filename
-            saved_filepath = os.path.join(upload_dir, saved_filename)
+            saved_filename = public_key  # contents are saved under their public key
+            saved_filepath = BlobStorage.get_blob_path(saved_filename)
 
             saved_filenames = files_handler.get_saved_filenames()
             saved_filepath_pub_key = files_handler.get_filepath_using_public_key(public_key)
@@ -97,7 +100,7 @@ def test_saved_files_handler():
             assert saved_filepath == saved_filepath_pub_key
             assert saved_filename == saved_filename_priv_key
             assert original_filename == filename
-            assert filesize == len(upload_handler.file_contents)
+            assert filesize == upload_handler.file_size
 
             assert os.path.exists(saved_filepath) and os.path.isfile(saved_filepath)
             files_handler.delete_saved_file(saved_filename)  # check if deleting a file works
@@ -108,6 +111,7 @@ def test_saved_files_handler():
 
         # upload the sample files again without deleting
         for filename, file in files:
+            file.seek(0)
             upload_file = UploadFile(file=file, filename=filename)
             upload_handler = FileUploadHandler(upload_file)
             upload_handler.save_file()
@@ -117,3 +121,680 @@ def test_saved_files_handler():
 
         # do a final clean up
         files_handler.clean_up_files()
+
+
+# test that an upload read in many small chunks produces the same keys and contents as the original file
+def test_file_upload_handler_chunked(monkeypatch):
+    from app.utils import utils
+
+    monkeypatch.setattr(utils, "upload_chunk_size", 4096)  # force the upload to be read in a lot of chunks
+
+    mode = "rb"
+    with open(sample_music, mode) as music_file:
+        contents = music_file.read()
+        music_file.seek(0)
+
+        upload_file = UploadFile(file=music_file, filename="sample.mp3")
+        upload_handler = FileUploadHandler(upload_file)
+
+        # the public key is the hash of the whole file, no matter how it was read
+        assert upload_handler.public_key == hashlib.sha256(contents).hexdigest()
+        assert upload_handler.file_size == len(contents)
+
+        upload_handler.save_file()
+        saved_filepath = BlobStorage.get_blob_path(upload_handler.public_key)
+        with open(saved_filepath, mode) as saved_file:
+            assert saved_file.read() == contents
+
+        # no temporary files should be left behind once the file is saved
+        assert not [f for f in os.listdir(upload_dir) if os.path.isfile(os.path.join(upload_dir, f))]
+
+        SavedFilesHandler().clean_up_files()
+
+
+# test that the index picks up files already inside the upload folder and follows deletions
+def test_saved_files_index():
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    crypto_handler = CryptoHandler()
+    public_key = crypto_handler.calculate_public_key(b"indexed contents")
+    private_key = crypto_handler.calculate_private_key(public_key)
+    legacy_filename = public_key + "indexed.txt"
+    with open(os.path.join(upload_dir, legacy_filename), "wb") as f:  # a file saved with the previous layout
+        f.write(b"indexed contents")
+
+    saved_files_index.build()
+    saved_filename = public_key  # the file is moved to the sharded, content-addressed layout
+    saved_filepath = BlobStorage.get_blob_path(saved_filename)
+    assert not os.path.exists(os.path.join(upload_dir, legacy_filename))
+    assert files_handler.get_filepath_using_public_key(public_key) == saved_filepath
+    assert files_handler.get_filename_using_private_key(private_key) == saved_filename
+    assert files_handler.get_original_filename(saved_filepath) == "indexed.txt"
+
+    files_handler.delete_saved_file(saved_filename)
+    assert files_handler.get_filepath_using_public_key(public_key) == ""
+    assert files_handler.get_filename_using_private_key(private_key) == ""
+    assert saved_filename not in files_handler.get_saved_filenames()
+
+
+# test that the index is loaded back from its snapshot and journal, and scanned again if the snapshot is damaged
+def test_index_snapshot(monkeypatch):
+    monkeypatch.setattr(settings, "FILE_TTL_MINS", 60)  # so the accesses are tracked
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    public_keys = []
+    for i in range(3):
+        upload_handler = FileUploadHandler(UploadFile(file=io.BytesIO(b"snapshot %d" % i), filename=f"{i}.txt"))
+        upload_handler.save_file()
+        public_keys.append(upload_handler.public_key)
+    saved_files_index.build()  # scans the folder and saves a snapshot
+
+    # these changes only go to the journal
+    upload_handler = FileUploadHandler(UploadFile(file=io.BytesIO(b"snapshot 0"), filename="copy.txt"))
+    upload_handler.save_file()
+    upload_handler = FileUploadHandler(UploadFile(file=io.BytesIO(b"snapshot 3"), filename="3.txt"))
+    upload_handler.save_file()
+    public_keys.append(upload_handler.public_key)
+    files_handler.delete_saved_file(public_keys[1])
+    eviction_handler.touch(public_keys[2], time.time() + 60)
+    files_handler.save_accesses()
+
+    expected_records = {pk: (r.filenames, r.size) for pk, r in BlobStorage.scan().items()}
+    last_access = os.stat(BlobStorage.get_blob_path(public_keys[2])).st_atime
+
+    # loading the snapshot calculates no private key; the snapshot keeps their hashes
+    def calculate_private_key(message: str) -> str:
+        raise AssertionError("a private key was calculated")
+
+    with monkeypatch.context() as context:
+        context.setattr(saved_files_index.crypto_handler, "calculate_private_key", calculate_private_key)
+        saved_files_index.build()
+    assert {pk: (r.filenames, r.size) for pk, r in saved_files_index.records.items()} == expected_records
+    assert saved_files_index.records[public_keys[0]].filenames == ["0.txt", "copy.txt"]
+    assert saved_files_index.get_record(public_keys[2]).last_access == last_access
+    assert saved_files_index.get_record(public_keys[3]).last_access > time.time() - 60  # uploaded since the snapshot
+    private_key = CryptoHandler().calculate_private_key(public_keys[0])
+    assert files_handler.get_filename_using_private_key(private_key) == public_keys[0]
+
+    # the private keys delete the files; only their hashes are persisted
+    for name in ("snapshot", "journal"):
+        with open(os.path.join(upload_dir, ".index", name), "rb") as f:
+            persisted = f.read()
+        assert private_key.encode() not in persisted and bytes.fromhex(private_key) not in persisted
+
+    # a private key is only trusted if it is calculated back from the public key its hash leads to
+    saved_files_index.public_key_by_key_hash[BlobStorage.get_key_hash("1" * 64)] = public_keys[0]
+    assert files_handler.get_filename_using_private_key("1" * 64) == ""
+
+    # the journal is folded into the snapshot once it is too large
+    monkeypatch.setattr(settings, "INDEX_JOURNAL_MAX_MB", 0)
+    saved_files_index.compact_snapshot()
+    monkeypatch.setattr(settings, "INDEX_JOURNAL_MAX_MB", 64)
+    assert not snapshot_handler.is_journal_full()
+    assert set(snapshot_handler.load().keys()) == set(expected_records.keys())
+
+    # a damaged snapshot is ignored and the folder is scanned
+    snapshot_path = os.path.join(upload_dir, ".index", "snapshot")
+    with open(snapshot_path, "r+b") as f:
+        f.seek(-4, os.SEEK_END)
+        f.write(b"\0\0\0\0")
+    assert snapshot_handler.load() is None
+    saved_files_index.build()
+    assert set(saved_files_index.records.keys()) == set(expected_records.keys())
+    assert snapshot_handler.load() is not None  # saved again after the scan
+
+    files_handler.clean_up_files()
+    saved_files_index.build()
+    assert saved_files_index.records == {}
+
+
+# increments the same host many times from a separate process
+def increment_in_process(path: str, increments: int):
+    database = Database(path)
+    for _ in range(increments):
+        database.increment_host_used_size("shared_host", 1)
+
+
+# tries to take the lock from a separate process; the exit code tells whether it got it
+def hold_in_process(name: str):
+    os._exit(0 if FileLock(name).hold() else 1)
+
+
+# test that a lock held by one process cannot be taken by another, and that it is reentrant within the process
+def test_file_lock():
+    lock = FileLock("test")
+    context = multiprocessing.get_context("spawn")
+
+    with lock, lock:
+        process = context.Process(target=hold_in_process, args=("test",))
+        process.start()
+        process.join()
+        assert process.exitcode == 1  # held by this process
+
+    assert lock.hold() and lock.hold()  # once held, it stays held
+    process = context.Process(target=hold_in_process, args=("test",))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+
+# test that the last activity kept in the database only ever moves forward
+def test_database_last_activity(tmp_path):
+    database = Database(str(tmp_path / "db.sqlite3"))
+    assert database.get_last_activity() == 0
+
+    database.update_last_activity(200.0)
+    database.update_last_activity(100.0)  # another process that was idle for longer
+    assert database.get_last_activity() == 200.0
+
+
+# test that with several workers the index follows the files other workers save, change and remove
+def test_saved_files_index_shared(monkeypatch):
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+    monkeypatch.setattr(settings, "WORKERS", 2)
+
+    # another worker saves a file along with its key file; this worker's index does not know about it
+    crypto_handler = CryptoHandler()
+    public_key = crypto_handler.calculate_public_key(b"shared contents")
+    private_key = crypto_handler.calculate_private_key(public_key)
+    fd, temp_filepath = BlobStorage.create_temp_file()
+    with open(fd, "wb") as f:
+        f.write(b"shared contents")
+    BlobStorage.publish_blob(temp_filepath, public_key)
+    BlobStorage.write_record(SavedFileRecord(public_key, ["first.txt"], 15))
+    BlobStorage.write_key(private_key, public_key)
+
+    # a private key this worker does not know is looked up through the key file, never by rescanning the folder
+    def build():
+        raise AssertionError("the index was rebuilt")
+
+    monkeypatch.setattr(saved_files_index, "build", build)
+    assert files_handler.get_filename_using_private_key(private_key) == public_key
+    assert files_handler.get_filename_using_private_key("0" * 64) == ""
+    BlobStorage.write_key("1" * 64, public_key)  # a key file that does not match its private key is not trusted
+    assert files_handler.get_filename_using_private_key("1" * 64) == ""
+    BlobStorage.remove_key("1" * 64)
+    assert files_handler.get_filepath_using_public_key(public_key) == BlobStorage.get_blob_path(public_key)
+
+    # another worker adds a reference; deleting one here must not lose it
+    BlobStorage.write_record(SavedFileRecord(public_key, ["first.txt", "second.txt"], 15))
+    files_handler.delete_saved_file(public_key)
+    assert BlobStorage.read_record(public_key).filenames == ["second.txt"]
+
+    # the lookup of a download may read the disk, so it runs on the metadata pool instead of the event loop
+    thread_names = []
+    get_record = saved_files_index.get_record
+
+    def get_record_on_thread(public_key: str):
+        thread_names.append(threading.current_thread().name)
+        return get_record(public_key)
+
+    monkeypatch.setattr(saved_files_index, "get_record", get_record_on_thread)
+    filepath, filename, _ = asyncio.run(files_handler.find_download(public_key))
+    assert (filepath, filename) == (BlobStorage.get_blob_path(public_key), "second.txt")
+    assert thread_names and all(name.startswith("metadata") for name in thread_names)
+
+    # another worker removes the file
+    BlobStorage.remove_blob(public_key)
+    assert saved_files_index.sync_record(public_key) is None
+    assert files_handler.get_filepath_using_public_key(public_key) == ""
+
+    # this worker writes the key files of what it saves for the others, and removes them with the contents
+    upload_handler = FileUploadHandler(UploadFile(file=io.BytesIO(b"shared upload"), filename="upload.txt"))
+    upload_handler.save_file()
+    assert BlobStorage.read_key(upload_handler.private_key) == upload_handler.public_key
+    files_handler.delete_saved_file(upload_handler.public_key)
+    assert BlobStorage.read_key(upload_handler.private_key) == ""
+
+    files_handler.clean_up_files()
+
+
+# test that increments from many threads and processes sharing the database file are never lost
+def test_database_concurrent_increments(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    database = Database(path)
+    increments = 200
+
+    def increment_in_thread():
+        for _ in range(increments):
+            database.increment_host_used_size("shared_host", 1)
+
+    threads = [threading.Thread(target=increment_in_thread) for _ in range(4)]
+    context = multiprocessing.get_context("spawn")  # worker processes never share a connection with the parent
+    processes = [context.Process(target=increment_in_process, args=(path, increments)) for _ in range(2)]
+    for worker in threads + processes:
+        worker.start()
+    for worker in threads + processes:
+        worker.join()
+
+    assert database.get_host_used_size("shared_host") == increments * (len(threads) + len(processes))
+    assert database.get_db()["hosts_info"]["hosts"]["shared_host"]["used_size"] == increments * 6
+
+
+# test that a reservation never lets a host go over the limit, even when requests race each other
+def test_database_reserve_host_used_size(tmp_path):
+    database = Database(str(tmp_path / "db.sqlite3"))
+    limit = 100
+    results = []
+
+    def reserve():
+        for _ in range(50):
+            results.append(database.reserve_host_used_size("racing_host", 1, limit)[0])
+
+    threads = [threading.Thread(target=reserve) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == limit
+    assert database.get_host_used_size("racing_host") == limit
+
+
+# test that the quota handler reserves sizes in memory and only writes them to the database when flushed
+def test_quota_handler():
+    database.reset_database()
+    quota = QuotaHandler()
+    limit_bytes = quota.get_daily_limit_bytes()
+
+    is_reserved, remaining_size = quota.reserve("quota_host", 1000)
+    assert is_reserved and remaining_size == limit_bytes
+    assert database.get_host_used_size("quota_host") == 0  # nothing is written until the next flush
+
+    is_reserved, remaining_size = quota.reserve("quota_host", limit_bytes)
+    assert not is_reserved and remaining_size == limit_bytes - 1000
+
+    quota.flush()
+    assert database.get_host_used_size("quota_host") == 1000
+
+    # changes made by another process are picked up by the next flush
+    database.increment_host_used_size("quota_host", 500)
+    quota.flush()
+    assert quota.get_remaining_size("quota_host") == limit_bytes - 1500
+
+    database.reset_database()
+
+
+# test that reaching QUOTA_MAX_UNFLUSHED_MB starts a flush on the metadata pool instead of flushing in reserve()
+def test_quota_handler_forced_flush(monkeypatch):
+    database.reset_database()
+    quota = QuotaHandler()
+    monkeypatch.setattr(settings, "QUOTA_MAX_UNFLUSHED_MB", 0)
+
+    increment_hosts_used_size = database.increment_hosts_used_size
+
+    def slow_increment_hosts_used_size(sizes: dict[str, int]):
+        time.sleep(0.5)
+        increment_hosts_used_size(sizes)
+
+    monkeypatch.setattr(database, "increment_hosts_used_size", slow_increment_hosts_used_size)
+    quota.get_remaining_size("quota_host")  # the host is read from the database once, before
+    start = time.perf_counter()
+    assert quota.reserve("quota_host", 1000)[0]
+    assert time.perf_counter() - start < 0.25  # did not wait for the flush
+
+    deadline = time.monotonic() + 5
+    while database.get_host_used_size("quota_host") != 1000 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert database.get_host_used_size("quota_host") == 1000
+    assert quota.get_remaining_size("quota_host") == quota.get_daily_limit_bytes() - 1000
+
+    database.reset_database()
+
+
+# test that a host transferring more than its burst waits, and that the first bytes of a request are not held back
+# because other hosts emptied the bucket of the server
+def test_bandwidth_handler(monkeypatch):
+    monkeypatch.setattr(settings, "BANDWIDTH_HOST_KB_PER_SEC", 100)
+    monkeypatch.setattr(settings, "BANDWIDTH_HOST_BURST_KB", 64)
+    monkeypatch.setattr(settings, "BANDWIDTH_GLOBAL_KB_PER_SEC", 200)
+    monkeypatch.setattr(settings, "BANDWIDTH_GLOBAL_BURST_KB", 128)
+    bandwidth = BandwidthHandler()
+    kb = 1024
+
+    # the burst goes through right away, what comes after it waits for the bucket to refill
+    assert bandwidth.take("download", "host_a", 64 * kb, 0) == 0
+    assert 0.45 < bandwidth.take("download", "host_a", 50 * kb, 64 * kb) <= 0.5
+    assert bandwidth.take("upload", "host_a", 64 * kb, 0) == 0  # uploads have buckets of their own
+
+    # host_a left 14 KB in the bucket of the server; the first bytes of host_b go through anyway,
+    # the next ones wait for the server's bucket, which is emptier than host_b's own
+    assert bandwidth.take("download", "host_b", 16 * kb, 0) == 0
+    assert 0.3 < bandwidth.take("download", "host_b", 64 * kb, 16 * kb) <= 0.33
+
+    # hosts that refilled their buckets are dropped
+    monkeypatch.setattr(settings, "BANDWIDTH_HOST_KB_PER_SEC", 1000 * 1000)
+    bandwidth.pruned_at = 0
+    time.sleep(0.01)
+    bandwidth.take("download", "host_c", 1, 0)
+    assert list(bandwidth.host_buckets) == [("download", "host_c")]
+
+
+# test that the same contents uploaded under different names are saved once and removed with the last reference
+def test_deduplicated_storage():
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+    upload_count, dedup_hit_count = saved_files_index.get_dedup_counts()
+
+    filenames = ["first.jpg", "second.jpg", "third.jpg"]
+    with open(sample_image, "rb") as image_file:
+        for filename in filenames:
+            image_file.seek(0)
+            upload_handler = FileUploadHandler(UploadFile(file=image_file, filename=filename))
+            upload_handler.save_file()
+
+    public_key = upload_handler.public_key
+    saved_filepath = files_handler.get_filepath_using_public_key(public_key)
+    assert files_handler.get_saved_filenames() == [public_key]
+    assert files_handler.get_original_filename(saved_filepath) == "first.jpg"
+    assert saved_files_index.get_dedup_counts() == (upload_count + 3, dedup_hit_count + 2)
+
+    # the contents stay until the last reference is deleted
+    for filename in filenames:
+        assert os.path.exists(saved_filepath)
+        assert files_handler.get_original_filename(saved_filepath) == filename
+        files_handler.delete_saved_file(public_key)
+
+    assert not os.path.exists(saved_filepath)
+    assert files_handler.get_filepath_using_public_key(public_key) == ""
+    assert not os.listdir(BlobStorage.get_shard_path(public_key))
+
+
+# test that uploads of the same contents at the same time write them once, and all of them get the same keys
+def test_concurrent_uploads_of_same_contents(monkeypatch):
+    from app.utils import utils, upload_flights
+
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    write_temp_file = utils.FileUploadHandler._FileUploadHandler__write_temp_file
+    write_count = 0
+
+    # a slow disk, so the uploads overlap
+    def slow_write_temp_file(self):
+        nonlocal write_count
+        write_count += 1
+        time.sleep(0.2)
+        return write_temp_file(self)
+
+    monkeypatch.setattr(utils.FileUploadHandler, "_FileUploadHandler__write_temp_file", slow_write_temp_file)
+    wait_count = upload_flights.wait_count
+
+    upload_handlers = [
+        FileUploadHandler(UploadFile(file=io.BytesIO(b"same contents"), filename=f"{i}.txt")) for i in range(5)
+    ]
+    threads = [threading.Thread(target=upload_handler.save_file) for upload_handler in upload_handlers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    public_key = upload_handlers[0].public_key
+    assert write_count == 1
+    assert upload_flights.wait_count == wait_count + 4
+    assert {(u.public_key, u.private_key) for u in upload_handlers} == {(public_key, upload_handlers[0].private_key)}
+    assert sorted(BlobStorage.read_record(public_key).filenames) == [f"{i}.txt" for i in range(5)]
+    assert not upload_flights.flights
+    assert not [f for f in os.listdir(upload_dir) if os.path.isfile(os.path.join(upload_dir, f))]  # no temp files
+
+    files_handler.clean_up_files()
+
+
+# test that files saved directly inside the upload folder are moved into the shard folders
+def test_migrate_flat_files():
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    crypto_handler = CryptoHandler()
+    public_key = crypto_handler.calculate_public_key(b"flat contents")
+    with open(os.path.join(upload_dir, public_key), "wb") as f:  # content-addressed but not sharded
+        f.write(b"flat contents")
+    with open(os.path.join(upload_dir, public_key + ".json"), "w") as f:
+        f.write('{"filenames": ["flat.txt"], "size": 13}')
+    with open(os.path.join(upload_dir, public_key + "legacy.txt"), "wb") as f:  # the same contents, older layout
+        f.write(b"flat contents")
+
+    assert BlobStorage.migrate_flat_files() == 3
+    assert [f for f in os.listdir(upload_dir) if os.path.isfile(os.path.join(upload_dir, f))] == []
+    assert BlobStorage.get_blob_path(public_key) == os.path.join(upload_dir, public_key[:2], public_key[2:4], public_key)
+    assert BlobStorage.read_record(public_key).filenames == ["flat.txt", "legacy.txt"]
+
+    snapshot_handler.remove()  # what migrate_storage.py does, so the index is not loaded from the empty snapshot
+    saved_files_index.build()
+    assert files_handler.get_filepath_using_public_key(public_key) == BlobStorage.get_blob_path(public_key)
+
+    files_handler.clean_up_files()
+    assert [f for f in os.listdir(upload_dir) if not f.startswith(".")] == []
+
+
+# test that the clean up removes the temporary files of abandoned uploads, but not those of uploads in progress
+def test_clean_up_temp_files():
+    abandoned_fd, abandoned_path = BlobStorage.create_temp_file()
+    in_progress_fd, in_progress_path = BlobStorage.create_temp_file()
+    os.close(abandoned_fd)
+    os.close(in_progress_fd)
+    modified_time = time.time() - settings.UPLOAD_SESSION_EXPIRY_MINS * 60 - 1
+    os.utime(abandoned_path, (modified_time, modified_time))
+
+    UploadSessionHandler().clean_up_expired_sessions()
+    assert not os.path.exists(abandoned_path)
+    assert os.path.exists(in_progress_path)
+    os.remove(in_progress_path)
+
+
+# test that large transfers run on their own pool while small ones share the metadata pool
+def test_executor_handler():
+    large_size = settings.LARGE_TRANSFER_MB * 1000 * 1000 + 1
+
+    async def get_thread_names() -> list[str]:
+        get_name = lambda: threading.current_thread().name
+        return [
+            await ExecutorHandler.run_transfer(large_size, get_name),
+            await ExecutorHandler.run_transfer(None, get_name),  # unknown sizes are treated as large
+            await ExecutorHandler.run_transfer(1, get_name),
+            await ExecutorHandler.run_metadata(get_name),
+            await ExecutorHandler.run_hashing(get_name),
+        ]
+
+    prefixes = [name.split("_")[0] for name in asyncio.run(get_thread_names())]
+    assert prefixes == ["transfer", "transfer", "metadata", "metadata", "hash"]
+
+
+# test that uploads hashed in a worker process get the same keys as uploads hashed in the request's thread
+def test_process_hashing_engine(monkeypatch):
+    monkeypatch.setattr(settings, "HASH_ENGINE", "process")
+    monkeypatch.setattr(settings, "HASH_PROCESS_MIN_MB", 0)
+    SavedFilesHandler().clean_up_files()
+
+    with open(sample_document, "rb") as document_file:
+        contents = document_file.read()
+        document_file.seek(0)
+
+        try:
+            upload_handler = FileUploadHandler(UploadFile(file=document_file, filename="sample.pdf"))
+            assert upload_handler.public_key == ""  # the keys are calculated once the file is saved
+            upload_handler.save_file()
+        finally:
+            HashingHandler.shutdown()
+
+    assert upload_handler.public_key == CryptoHandler().calculate_public_key(contents)
+    assert upload_handler.private_key == CryptoHandler().calculate_private_key(upload_handler.public_key)
+    with open(BlobStorage.get_blob_path(upload_handler.public_key), "rb") as saved_file:
+        assert saved_file.read() == contents
+
+    SavedFilesHandler().clean_up_files()
+
+
+# test that the file cache keeps the most recently used files within its budget and skips large files
+def test_file_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "FILE_CACHE_MB", 1)
+    monkeypatch.setattr(settings, "FILE_CACHE_MAX_FILE_KB", 512)
+    cache = FileCache()
+
+    filepaths = {}
+    for name, size in [("first", 400 * 1024), ("second", 400 * 1024), ("third", 400 * 1024), ("large", 600 * 1024)]:
+        filepaths[name] = str(tmp_path / name)
+        with open(filepaths[name], "wb") as f:
+            f.write(os.urandom(size))
+
+    assert cache.load("large", filepaths["large"]) is None  # over FILE_CACHE_MAX_FILE_KB
+    assert cache.load("first", filepaths["first"]) is not None
+    assert cache.load("second", filepaths["second"]) is not None
+    assert cache.get("first") is not None  # first becomes the most recently used
+    assert cache.load("third", filepaths["third"]) is not None  # over the budget; drops second
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None and cache.get("third") is not None
+    assert cache.cached_size == 800 * 1024
+    assert cache.get_hit_counts() == (3, 1)
+
+    cache.remove("first")
+    assert cache.get("first") is None and cache.cached_size == 400 * 1024
+    cache.clear()
+    assert cache.get("third") is None and cache.cached_size == 0
+
+
+# test that the least recently used contents are evicted in bounded batches once expired or over the storage budget
+def test_evict_files(monkeypatch):
+    monkeypatch.setattr(settings, "FILE_TTL_MINS", 60)
+    monkeypatch.setattr(settings, "EVICTION_BATCH_SIZE", 2)
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+
+    public_keys = []
+    for i in range(5):
+        upload_handler = FileUploadHandler(UploadFile(file=io.BytesIO(b"x" * 400_000 + bytes([i])), filename=f"{i}.txt"))
+        upload_handler.save_file()
+        public_keys.append(upload_handler.public_key)
+
+    # nothing expired yet and there is no budget
+    assert files_handler.evict_files() == 0
+    assert eviction_handler.get_stored_size() == 5 * 400_001
+
+    # the first three were uploaded two hours ago; the second one was downloaded since
+    two_hours_ago = time.time() - 2 * 60 * 60
+    for public_key in public_keys[:3]:
+        blob_path = BlobStorage.get_blob_path(public_key)
+        os.utime(blob_path, (two_hours_ago, two_hours_ago))
+    snapshot_handler.remove()  # the access times were changed outside of the server, so the index must scan them
+    saved_files_index.build()
+    eviction_handler.touch(public_keys[1])
+
+    assert files_handler.evict_files() == 2  # at most EVICTION_BATCH_SIZE per call
+    assert files_handler.evict_files() == 0
+    remaining_public_keys = files_handler.get_saved_filenames()
+    assert sorted(remaining_public_keys) == sorted(public_keys[1:2] + public_keys[3:])
+
+    # the accesses are saved as the access times of the files, so a rebuild keeps them; they are journaled under
+    # the index file lock, like every other change
+    append_access = snapshot_handler.append_access
+
+    def append_access_locked(public_key: str, last_access: float):
+        assert index_lock.depth > 0
+        append_access(public_key, last_access)
+
+    monkeypatch.setattr(snapshot_handler, "append_access", append_access_locked)
+    files_handler.save_accesses()
+    saved_files_index.build()
+    assert files_handler.evict_files() == 0
+
+    # over the budget, the least recently used go first, expired or not
+    monkeypatch.setattr(settings, "STORAGE_BUDGET_MB", 1)  # two of the files fit
+    eviction_handler.touch(public_keys[3], time.time() + 120)
+    eviction_handler.touch(public_keys[1], time.time() + 240)
+    assert files_handler.evict_files() == 1
+    assert sorted(files_handler.get_saved_filenames()) == sorted([public_keys[1], public_keys[3]])
+
+    files_handler.clean_up_files()
+
+
+# test that with several workers the clean up tracks what the others save, download and remove through the journal,
+# without building the index again
+def test_evict_files_shared(monkeypatch):
+    monkeypatch.setattr(settings, "FILE_TTL_MINS", 60)
+    files_handler = SavedFilesHandler()
+    files_handler.clean_up_files()
+    saved_files_index.build()
+    monkeypatch.setattr(settings, "WORKERS", 2)
+
+    def build():
+        raise AssertionError("the index was rebuilt")
+
+    monkeypatch.setattr(saved_files_index, "build", build)
+
+    # another worker saves contents that expired, and downloads other contents since
+    crypto_handler = CryptoHandler()
+    two_hours_ago = time.time() - 2 * 60 * 60
+    public_keys = [crypto_handler.calculate_public_key(f"shared {i}".encode()) for i in range(3)]
+    for public_key in public_keys:
+        fd, temp_filepath = BlobStorage.create_temp_file()
+        os.close(fd)
+        BlobStorage.publish_blob(temp_filepath, public_key)
+        os.utime(BlobStorage.get_blob_path(public_key), (two_hours_ago, two_hours_ago))
+        BlobStorage.write_record(SavedFileRecord(public_key, ["shared.txt"], 0, two_hours_ago))
+        snapshot_handler.append_put(public_key, ["shared.txt"], 0, two_hours_ago, "", b"\0" * 32)
+    snapshot_handler.append_access(public_keys[1], time.time())
+    os.utime(BlobStorage.get_blob_path(public_keys[1]))
+
+    # and removes one of them
+    BlobStorage.remove_blob(public_keys[2])
+    snapshot_handler.append_remove(public_keys[2])
+
+    assert files_handler.evict_files() == 1
+    assert not os.path.exists(BlobStorage.get_blob_path(public_keys[0]))
+    assert eviction_handler.get_stored_size() == 0
+
+    # another worker folds the journal into a new snapshot, which is loaded a single time
+    snapshot_records = {
+        public_keys[1]: (["shared.txt"], 0, time.time(), "", b"\0" * 32),
+        "0" * 64: ([], 5, time.time(), "", b"\1" * 32),
+    }
+    snapshot_handler.save(snapshot_records)
+    assert files_handler.evict_files() == 0
+    assert eviction_handler.get_stored_size() == 5
+    assert saved_files_index.journal_offset == 0
+
+    monkeypatch.undo()
+    files_handler.clean_up_files()
+
+
+# test that the registry renders its metrics in the prometheus text format and collects the request timings
+def test_metrics_registry():
+    metrics = MetricsRegistry(is_enabled=True)
+    counter = metrics.counter("test_bytes_total", "Bytes.", ("route",))
+    histogram = metrics.histogram("test_duration_seconds", "Durations.", timing_name="hash")
+    metrics.gauge("test_files", "Files.", lambda: 3)
+
+    counter.inc(10, ("files",))
+    counter.inc(5, ("files",))
+    histogram.observe(0.002)
+    histogram.observe(100)
+    lines = metrics.render().splitlines()
+    assert 'test_bytes_total{route="files"} 15' in lines
+    assert 'test_duration_seconds_bucket{le="0.001"} 0' in lines
+    assert 'test_duration_seconds_bucket{le="0.0025"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="60.0"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert "test_duration_seconds_count 2" in lines
+    assert "test_files 3" in lines
+
+    # timings recorded in threads running a copy of the context are added to the request's timings
+    async def run_request():
+        timings = metrics.start_request_timings()
+        await ExecutorHandler.run_hashing(histogram.record, 0.01)
+        with histogram.time():
+            pass
+        return timings
+
+    timings = asyncio.run(run_request())
+    assert [name for name, _ in timings] == ["hash", "hash"]
+    assert format_server_timing([("hash", 0.01), ("hash", 0.002)], 0.02) == "hash;dur=12.0, total;dur=20.0"
+
+    # a disabled registry ignores everything
+    disabled_metrics = MetricsRegistry(is_enabled=False)
+    disabled_counter = disabled_metrics.counter("test_total", "Total.")
+    disabled_counter.inc()
+    assert disabled_metrics.render() == "# HELP test_total Total.\n# TYPE test_total counter\n"
@@ -1,7 +1,8 @@
-import os, re
+import io, os, re, time, asyncio, hashlib, tarfile, zipfile
 
 from app import app
-from app.common import settings, database
+from app.common import settings, metrics
+from app.utils import quota_handler, file_cache
 
 from fastapi import status
 from fastapi.testclient import TestClient
@@ -16,9 +17,9 @@ sample_image = os.path.join(sample_files_dir, "sample_image.jpg")
 sample_document = os.path.join(sample_files_dir, "sample_document.pdf")
 sample_music = os.path.join(sample_files_dir, "sample_music.mp3")
 
-# reset the contents of the "database"
+# reset the contents of the "database" and the used sizes kept in memory
 def reset_db():
-    database.reset_database()
+    quota_handler.reset()
 
 
 # assert if all the sample files exist
@@ -256,3 +257,480 @@ def test_delete_file():
             # if the file was successfully deleted, then calling another delete operation will return a 404 not found error
             response = client.delete(url)
             assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+# test conditional requests and range requests on the download API
+def test_download_conditional_and_ranges():
+    reset_db()
+
+    with open(sample_document, "rb") as document_file:
+        document_bytes = document_file.read()
+
+    response = client.post("/files/", files={"file": ("sample.pdf", document_bytes)})
+    public_key = response.json()["publicKey"]
+    url = f"/files/{public_key}"
+
+    # the public key is used as a strong entity tag
+    response = client.get(url)
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+    assert response.status_code == status.HTTP_200_OK
+    assert etag == f'"{public_key}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["accept-ranges"] == "bytes"
+
+    # a client that already has the file gets a 304 without the body
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b""
+    response = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    # single range
+    response = client.get(url, headers={"Range": "bytes=10-109"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.content == document_bytes[10:110]
+    assert response.headers["content-range"] == f"bytes 10-109/{len(document_bytes)}"
+
+    # suffix range
+    response = client.get(url, headers={"Range": "bytes=-50"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.content == document_bytes[-50:]
+
+    # multiple ranges are sent as multipart/byteranges
+    response = client.get(url, headers={"Range": "bytes=0-9,100-119"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.headers["content-type"].startswith("multipart/byteranges")
+    assert document_bytes[0:10] in response.content
+    assert document_bytes[100:120] in response.content
+    assert int(response.headers["content-length"]) == len(response.content)
+
+    # a range that starts after the end of the file cannot be satisfied
+    response = client.get(url, headers={"Range": f"bytes={len(document_bytes)}-"})
+    assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    response = client.get(url, headers={"Range": f"bytes={len(document_bytes) + 1}-"})
+    assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+    response = client.get(url, headers={"Range": f"bytes={len(document_bytes) + 100}-{len(document_bytes) + 200}"})
+    assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+
+    # If-Range with an outdated entity tag gets the whole file
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"outdated"'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == document_bytes
+
+
+# test that only the bytes actually served are charged against the daily limit
+def test_download_charges_served_bytes():
+    reset_db()
+
+    with open(sample_document, "rb") as document_file:
+        document_bytes = document_file.read()
+
+    response = client.post("/files/", files={"file": ("sample.pdf", document_bytes)})
+    upload_size = int(response.request.headers["content-length"])
+    url = f"/files/{response.json()['publicKey']}"
+    host = "testclient"  # the host the test client uses
+
+    client.get(url, headers={"Range": "bytes=0-99"})
+    assert quota_handler.get_remaining_size(host) == quota_handler.get_daily_limit_bytes() - upload_size - 100
+
+    client.get(url, headers={"If-None-Match": f'"{response.json()["publicKey"]}"'})
+    assert quota_handler.get_remaining_size(host) == quota_handler.get_daily_limit_bytes() - upload_size - 100
+
+
+# test that servers supporting the zero-copy send extension get the file descriptor instead of the contents
+def test_download_zero_copy(monkeypatch):
+    reset_db()
+    monkeypatch.setattr(settings, "FILE_CACHE_MB", 0)  # cached files are sent from memory instead
+
+    with open(sample_image, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    response = client.post("/files/", files={"file": ("sample.jpg", image_bytes)})
+    path = f"/files/{response.json()['publicKey']}"
+
+    messages = []
+    sent_bytes = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message["type"])
+        if message["type"] == "http.response.zerocopysend":
+            # do what the server would do with os.sendfile
+            sent_bytes.append(os.pread(message["file"].fileno(), message["count"], message["offset"]))
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"range", b"bytes=100-")],
+        "client": ("zerocopyclient", 1234),
+        "extensions": {"http.response.zerocopysend": {}},
+    }
+    asyncio.run(app(scope, receive, send))
+
+    assert "http.response.zerocopysend" in messages
+    assert b"".join(sent_bytes) == image_bytes[100:]
+
+
+# test a resumable upload sent in chunks out of order, with one chunk sent again
+def test_resumable_upload():
+    reset_db()
+
+    with open(sample_music, "rb") as music_file:
+        music_bytes = music_file.read()
+
+    chunk_size = 256 * 1024
+    response = client.post("/uploads/", json={"filename": "sample.mp3", "size": len(music_bytes), "chunkSize": chunk_size})
+    assert response.status_code == status.HTTP_200_OK
+    session = response.json()
+    upload_id = session["uploadId"]
+    chunks = [music_bytes[i : i + chunk_size] for i in range(0, len(music_bytes), chunk_size)]
+    assert session["chunkCount"] == len(chunks)
+    assert session["missingChunks"] == [[0, len(chunks) - 1]]
+
+    for index in reversed(range(1, len(chunks))):
+        response = client.put(f"/uploads/{upload_id}/chunks/{index}", data=chunks[index])
+        assert response.status_code == status.HTTP_200_OK
+
+    # a chunk of the wrong size is rejected
+    response = client.put(f"/uploads/{upload_id}/chunks/0", data=chunks[0][:10])
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    # the upload cannot be completed while a chunk is missing
+    session = client.get(f"/uploads/{upload_id}").json()
+    assert session["receivedChunks"] == [[1, len(chunks) - 1]]
+    assert session["missingChunks"] == [[0, 0]]
+    assert (session["receivedCount"], session["missingCount"]) == (len(chunks) - 1, 1)
+    assert client.post(f"/uploads/{upload_id}/complete").status_code == status.HTTP_409_CONFLICT
+
+    client.put(f"/uploads/{upload_id}/chunks/0", data=chunks[0])
+    client.put(f"/uploads/{upload_id}/chunks/1", data=chunks[1])  # sending a chunk again replaces it
+    response = client.post(f"/uploads/{upload_id}/complete")
+    assert response.status_code == status.HTTP_200_OK
+
+    # the keys are the same as a regular upload of the file would return
+    response_regular = client.post("/files/", files={"file": ("sample.mp3", music_bytes)})
+    assert response.json() == response_regular.json()
+
+    response = client.get(f"/files/{response.json()['publicKey']}")
+    assert response.content == music_bytes
+
+    # the session is gone once completed
+    assert client.get(f"/uploads/{upload_id}").status_code == status.HTTP_404_NOT_FOUND
+    assert client.post(f"/uploads/{upload_id}/complete").status_code == status.HTTP_404_NOT_FOUND
+
+    # sessions for files too large, or split in too many chunks, are not created
+    response = client.post("/uploads/", json={"filename": "large.bin", "size": 10**14})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.post("/uploads/", json={"filename": "large.bin", "size": 10**9, "chunkSize": 1})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+# test the upload API that takes the file as the raw request body
+def test_upload_raw_file():
+    reset_db()
+
+    with open(sample_image, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    response = client.put("/files/sample.jpg", data=image_bytes)
+    assert response.status_code == status.HTTP_200_OK
+    response_json = dict(response.json())
+    assert "privateKey" in response_json.keys()
+    assert "publicKey" in response_json.keys()
+
+    # the keys are the same as a multipart upload of the file would return
+    response_multipart = client.post("/files/", files={"file": ("sample.jpg", image_bytes)})
+    assert response_multipart.json() == response_json
+
+    response = client.get(f"/files/{response_json['publicKey']}")
+    filename = re.findall('filename="(.+)"', response.headers["content-disposition"])[0]
+    assert response.content == image_bytes
+    assert filename == "sample.jpg"
+
+
+# test that small files are downloaded from the file cache, that they are only cached when their contents are sent
+# and that deleting them drops them from it
+def test_download_cached_file():
+    reset_db()
+
+    with open(sample_image, "rb") as image_file:
+        image_bytes = image_file.read() + os.urandom(16)  # contents no other test saved, so one delete removes them
+
+    response_json = client.post("/files/", files={"file": ("cached.jpg", image_bytes)}).json()
+    public_key = response_json["publicKey"]
+    file_cache.remove(public_key)
+    hit_count, miss_count = file_cache.get_hit_counts()
+
+    # a not modified response has no body, so the file is not read into the cache for it
+    response = client.get(f"/files/{public_key}", headers={"If-None-Match": f'"{public_key}"'})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert file_cache.get(public_key, is_counted=False) is None
+
+    for _ in range(3):
+        response = client.get(f"/files/{public_key}", headers={"range": "bytes=10-19"})
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert response.content == image_bytes[10:20]
+
+    assert file_cache.get_hit_counts() == (hit_count + 2, miss_count + 2)  # the 304 was a miss too
+    assert file_cache.get(public_key, is_counted=False).contents == image_bytes
+
+    client.delete(f"/files/{response_json['privateKey']}")
+    assert file_cache.get(public_key, is_counted=False) is None
+    assert client.get(f"/files/{public_key}").status_code == status.HTTP_404_NOT_FOUND
+
+
+# test that the phases of a request are sent back in the Server-Timing header and counted in /metrics
+def test_metrics_and_server_timing(monkeypatch):
+    reset_db()
+    monkeypatch.setattr(metrics, "is_timing_enabled", True)
+
+    with open(sample_document, "rb") as document_file:
+        document_bytes = document_file.read() + os.urandom(16)
+
+    response = client.post("/files/", files={"file": ("timed.pdf", document_bytes)})
+    assert response.status_code == status.HTTP_200_OK
+    phases = [timing.split(";")[0] for timing in response.headers["server-timing"].split(", ")]
+    assert "quota" in phases and "hash" in phases and "write" in phases
+    assert phases[-1] == "total"
+
+    response = client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert 'file_server_request_duration_seconds_count{route="files",method="POST"}' in response.text
+    assert 'file_server_received_bytes_total{route="files"}' in response.text
+    assert "file_server_stored_files " in response.text
+    assert "file_server_uploads_total " in response.text
+
+    monkeypatch.setattr(metrics, "is_timing_enabled", False)
+    assert "server-timing" not in client.get("/metrics").headers
+
+
+# test that several files are downloaded as a single zip or tar archive with their original filenames,
+# and that the whole archive is charged at once
+def test_download_archive():
+    reset_db()
+
+    contents = {"a.txt": b"first file" + os.urandom(16), "b.jpg": b"second file" + os.urandom(16)}
+    public_keys = [client.post("/files/", files={"file": item}).json()["publicKey"] for item in contents.items()]
+    public_keys.append(public_keys[0])  # the same file twice gets two names
+    host = "testclient"  # the host the test client uses
+    remaining_size = quota_handler.get_remaining_size(host)
+
+    response = client.post("/files/archive", json={"publicKeys": public_keys})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.namelist() == ["a.txt", "b.jpg", "a (1).txt"]
+        assert archive.read("a.txt") == contents["a.txt"]
+        assert archive.read("b.jpg") == contents["b.jpg"]
+    archive_size = sum(len(file_contents) for file_contents in contents.values()) + len(contents["a.txt"])
+    assert quota_handler.get_remaining_size(host) == remaining_size - archive_size
+
+    response = client.post("/files/archive", json={"publicKeys": public_keys[:2], "format": "tar"})
+    assert response.status_code == status.HTTP_200_OK
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as archive:
+        assert archive.getnames() == ["a.txt", "b.jpg"]
+        assert archive.extractfile("b.jpg").read() == contents["b.jpg"]
+
+    # nothing is sent or charged if any file is missing
+    remaining_size = quota_handler.get_remaining_size(host)
+    response = client.post("/files/archive", json={"publicKeys": [public_keys[0], "0" * 64]})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()["detail"]["publicKeys"] == ["0" * 64]
+    assert quota_handler.get_remaining_size(host) == remaining_size
+
+    # nor if the request is not valid
+    assert client.post("/files/archive", json={"publicKeys": []}).status_code == 422
+    assert client.post("/files/archive", json={"publicKeys": public_keys, "format": "rar"}).status_code == 422
+    assert quota_handler.get_remaining_size(host) == remaining_size
+
+
+# test that several files are uploaded and deleted in a single request each, with a status for every file,
+# and that the whole upload is charged at once
+def test_batch_upload_and_delete():
+    reset_db()
+
+    contents = [os.urandom(64), os.urandom(128)]
+    files = [
+        ("files", ("one.bin", contents[0])),
+        ("files", ("two.bin", contents[1])),
+        ("files", ("copy.bin", contents[0])),
+    ]
+    response = client.post("/files/batch", files=files)
+    assert response.status_code == status.HTTP_200_OK
+    results = response.json()["files"]
+    assert [result["filename"] for result in results] == ["one.bin", "two.bin", "copy.bin"]
+    assert all(result["status"] == status.HTTP_200_OK for result in results)
+    assert results[0]["publicKey"] == results[2]["publicKey"]  # the same contents are only saved once
+
+    upload_size = int(response.request.headers["content-length"])
+    remaining_size = quota_handler.get_remaining_size("testclient")
+    assert remaining_size == quota_handler.get_daily_limit_bytes() - upload_size
+
+    for result, file_contents in zip(results, contents):
+        assert client.get(f"/files/{result['publicKey']}").content == file_contents
+
+    # the copy keeps the contents around until its own reference is deleted too
+    private_keys = [results[0]["privateKey"], results[1]["privateKey"], "0" * 64, "short"]
+    response = client.delete("/files/batch", json={"privateKeys": private_keys})
+    assert response.status_code == status.HTTP_200_OK
+    assert [result["status"] for result in response.json()["files"]] == [200, 200, 404, 404]
+    assert client.get(f"/files/{results[0]['publicKey']}").status_code == status.HTTP_200_OK
+    assert client.get(f"/files/{results[1]['publicKey']}").status_code == status.HTTP_404_NOT_FOUND
+
+    response = client.delete("/files/batch", json={"privateKeys": [results[2]["privateKey"]]})
+    assert response.json()["files"][0]["status"] == status.HTTP_200_OK
+    assert client.get(f"/files/{results[0]['publicKey']}").status_code == status.HTTP_404_NOT_FOUND
+
+    assert client.delete("/files/batch", json={"privateKeys": []}).status_code == 422
+
+
+# test that compressible uploads are stored compressed, under the hash of the original contents, and sent
+# as they are to clients that take the encoding and decompressed to the others
+def test_compressed_storage(monkeypatch):
+    from app.utils import BlobStorage
+
+    monkeypatch.setattr(settings, "STORAGE_COMPRESSION", "gzip")
+    reset_db()
+
+    contents = b"time,host,status\n" + b"".join(b"%d,10.0.0.%d,200\n" % (i, i % 256) for i in range(5000))
+    response = client.post("/files/", files={"file": ("log.csv", contents)})
+    public_key = response.json()["publicKey"]
+    assert public_key == hashlib.sha256(contents).hexdigest()
+    compressed_size = os.path.getsize(BlobStorage.get_blob_path(public_key))
+    assert compressed_size < len(contents) / 2
+    assert BlobStorage.read_record(public_key).encoding == "gzip"
+
+    # the client takes gzip; the stored bytes are sent, the client decodes them
+    response = client.get(f"/files/{public_key}", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "accept-encoding"
+    assert response.headers["etag"] == f'"{public_key}-gzip"'
+    assert int(response.headers["content-length"]) == compressed_size
+    assert response.content == contents
+
+    # ranges are ranges of the stored bytes then
+    response = client.get(f"/files/{public_key}", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.headers["content-range"] == f"bytes 0-9/{compressed_size}"
+
+    # the client does not take gzip; the contents are decompressed on the fly, whole
+    for headers in ({"Accept-Encoding": "identity"}, {"Accept-Encoding": "gzip;q=0, *"}):
+        response = client.get(f"/files/{public_key}", headers={**headers, "Range": "bytes=0-9"})
+        assert response.status_code == status.HTTP_200_OK
+        assert "content-encoding" not in response.headers
+        assert response.headers["etag"] == f'"{public_key}"'
+        assert int(response.headers["content-length"]) == len(contents)
+        assert response.content == contents
+
+    response = client.post("/files/archive", json={"publicKeys": [public_key], "format": "tar"})
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as archive:
+        assert archive.extractfile("log.csv").read() == contents
+
+    # raw uploads are compressed once they are complete
+    public_key = client.put("/files/notes.txt", data=contents[::-1]).json()["publicKey"]
+    assert BlobStorage.read_record(public_key).encoding == "gzip"
+    assert client.get(f"/files/{public_key}", headers={"Accept-Encoding": "identity"}).content == contents[::-1]
+
+    # contents that are compressed already, or that do not shrink, are stored as they are
+    with open(sample_image, "rb") as image_file:
+        public_key = client.post("/files/", files={"file": ("image.jpg", image_file)}).json()["publicKey"]
+    assert BlobStorage.read_record(public_key).encoding == ""
+    public_key = client.put("/files/random.txt", data=os.urandom(4096)).json()["publicKey"]
+    assert BlobStorage.read_record(public_key).encoding == ""
+    response = client.get(f"/files/{public_key}")
+    assert "content-encoding" not in response.headers and "vary" not in response.headers
+
+
+# test that uploads are charged by the bytes of their body as they arrive, and cut short once over the daily limit
+def test_upload_quota_on_body_stream():
+    reset_db()
+    host = "testclient"  # the host the test client uses
+    limit_bytes = quota_handler.get_daily_limit_bytes()
+
+    def count_stored_files() -> int:
+        return sum(len(filenames) for _, _, filenames in os.walk(settings.FOLDER))
+
+    def split(contents: bytes, chunk_size: int = 64 * 1000):
+        for i in range(0, len(contents), chunk_size):
+            yield contents[i : i + chunk_size]
+
+    # a chunked upload has no Content-Length; exactly its body is charged
+    contents = os.urandom(300 * 1000)
+    response = client.put("/files/chunked.bin", data=split(contents))
+    assert "content-length" not in response.request.headers
+    assert response.status_code == status.HTTP_200_OK
+    assert quota_handler.get_remaining_size(host) == limit_bytes - len(contents)
+    assert client.get(f"/files/{response.json()['publicKey']}").content == contents
+
+    # a host going over its limit half way is cut off; only the bytes it had room for are charged, nothing is kept
+    reset_db()
+    quota_handler.reserve(host, limit_bytes - 100 * 1000)
+    stored_file_count = count_stored_files()
+    response = client.put("/files/over.bin", data=split(os.urandom(1000 * 1000)))
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert "You only have" in response.json()["details"]
+    assert quota_handler.get_remaining_size(host) == 100 * 1000 - 64 * 1000
+    assert count_stored_files() == stored_file_count
+
+    # an upload declaring more than the host has remaining is rejected before its body is read
+    response = client.put("/files/declared.bin", data=os.urandom(100 * 1000))
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert response.json()["details"].startswith("Upload size is 0.1 MB")
+    assert quota_handler.get_remaining_size(host) == 100 * 1000 - 64 * 1000
+
+
+# test that the uploads and downloads of a host are paced once it transferred its burst, zero-copy ones included
+def test_bandwidth_shaping(monkeypatch):
+    from app.utils import bandwidth_handler
+    from app.middlewares.bandwidth import max_zero_copy_size
+
+    reset_db()
+    bandwidth_handler.reset()
+    monkeypatch.setattr(settings, "FILE_CACHE_MB", 0)  # cached files are sent from memory instead
+    monkeypatch.setattr(settings, "BANDWIDTH_HOST_KB_PER_SEC", 2048)
+    monkeypatch.setattr(settings, "BANDWIDTH_HOST_BURST_KB", 64)
+
+    with open(sample_music, "rb") as music_file:
+        music_bytes = music_file.read()
+    paced_secs = (len(music_bytes) - 64 * 1024) / (2048 * 1024)
+
+    start = time.perf_counter()
+    response = client.put("/files/sample.mp3", data=music_bytes)
+    assert response.status_code == status.HTTP_200_OK
+    assert time.perf_counter() - start >= paced_secs * 0.9
+
+    pieces = []
+    sent_bytes = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            pieces.append(message["count"])
+            sent_bytes.append(os.pread(message["file"].fileno(), message["count"], message["offset"]))
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": f"/files/{response.json()['publicKey']}",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("testclient", 1234),
+        "extensions": {"http.response.zerocopysend": {}},
+    }
+    start = time.perf_counter()
+    asyncio.run(app(scope, receive, send))
+    assert time.perf_counter() - start >= paced_secs * 0.9
+
+    # the file was handed to the server in pieces, so every one of them could be paced
+    assert len(pieces) > 1 and all(count <= max_zero_copy_size for count in pieces)
+    assert b"".join(sent_bytes) == music_bytes
+    bandwidth_handler.reset()